@@ -0,0 +1,190 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Token budget admission control for the prediction servers.
+
+Token budget admission control for the prediction servers.
+"""
+import collections
+import contextlib
+import math
+import threading
+import time
+
+from absl import flags
+
+import instrumentation
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    "max_inflight_tokens", 32768,
+    "Token budget of the requests processed concurrently by a worker. A "
+    "request costs its input tokens plus the tokens it may generate. 0 "
+    "disables admission control.")
+flags.DEFINE_integer(
+    "max_queued_tokens", 65536,
+    "Token budget of the requests waiting for admission in a worker. Requests "
+    "beyond it are rejected with 429.")
+flags.DEFINE_float(
+    "admission_timeout", 30,
+    "Seconds a request waits for admission before it is rejected with 429.")
+
+# Window over which the processing rate is measured for Retry-After.
+_RATE_WINDOW_SECONDS = 30.0
+_MAX_RETRY_AFTER_SECONDS = 60
+
+
+class AdmissionRejected(Exception):
+  """Raised when a request does not fit into the queue or timed out."""
+
+  def __init__(self, reason: str, retry_after: int):
+    super().__init__(f"Server overloaded ({reason}), retry after "
+                     f"{retry_after}s.")
+    self.reason = reason
+    self.retry_after = retry_after
+
+
+class AdmissionController:
+  """Admits requests while their total cost fits a token budget.
+
+  Requests that do not fit wait in FIFO order while the tokens of the waiting
+  requests fit `max_queued_tokens`. Requests beyond that, or waiting longer
+  than `timeout_seconds`, are rejected with an estimate of when to retry,
+  based on the recent processing rate.
+  """
+
+  def __init__(self, max_inflight_tokens: int, max_queued_tokens: int,
+               timeout_seconds: float):
+    """Creates the controller.
+
+    Args:
+      max_inflight_tokens: Budget of the admitted requests. 0 admits all
+        requests.
+      max_queued_tokens: Budget of the waiting requests.
+      timeout_seconds: Maximum time a request waits for admission.
+    """
+    self._max_inflight = max_inflight_tokens
+    self._max_queued = max_queued_tokens
+    self._timeout = timeout_seconds
+    self._cond = threading.Condition()
+    self._inflight = 0
+    self._queued = 0
+    self._waiting = collections.deque()
+    self._released = collections.deque()
+
+  @property
+  def enabled(self) -> bool:
+    return self._max_inflight > 0
+
+  @contextlib.contextmanager
+  def admit(self, cost: int):
+    """Holds `cost` tokens of the budget while the block runs.
+
+    Args:
+      cost: Estimated cost of the request in tokens.
+
+    Raises:
+      AdmissionRejected: If the request was not admitted.
+    """
+    granted = self.acquire(cost)
+    try:
+      yield
+    finally:
+      self.release(granted)
+
+  def acquire(self, cost: int) -> int:
+    """Waits until `cost` tokens fit the budget and reserves them.
+
+    A request larger than the whole budget is admitted alone.
+
+    Args:
+      cost: Estimated cost of the request in tokens.
+
+    Returns:
+      The reserved number of tokens, to pass to release().
+
+    Raises:
+      AdmissionRejected: If the request was not admitted.
+    """
+    if not self.enabled:
+      return 0
+    cost = min(max(cost, 1), self._max_inflight)
+    with self._cond:
+      if not self._waiting and self._inflight + cost <= self._max_inflight:
+        self._inflight += cost
+        self._update_gauges()
+        return cost
+      if self._queued + cost > self._max_queued:
+        self._reject("queue_full")
+
+      ticket = object()
+      self._waiting.append(ticket)
+      self._queued += cost
+      self._update_gauges()
+      deadline = time.monotonic() + self._timeout
+      try:
+        while (self._waiting[0] is not ticket or
+               self._inflight + cost > self._max_inflight):
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            self._reject("timeout")
+          self._cond.wait(remaining)
+        self._inflight += cost
+      finally:
+        self._waiting.remove(ticket)
+        self._queued -= cost
+        self._update_gauges()
+        self._cond.notify_all()
+    return cost
+
+  def release(self, cost: int):
+    """Returns tokens reserved by acquire() to the budget."""
+    if not cost:
+      return
+    with self._cond:
+      self._inflight -= cost
+      self._released.append((time.monotonic(), cost))
+      self._update_gauges()
+      self._cond.notify_all()
+
+  def _reject(self, reason):
+    instrumentation.count_rejection(reason)
+    raise AdmissionRejected(reason, self._retry_after())
+
+  def _retry_after(self) -> int:
+    """Estimates the seconds until the current backlog is processed."""
+    now = time.monotonic()
+    while self._released and self._released[0][0] < now - _RATE_WINDOW_SECONDS:
+      self._released.popleft()
+    if not self._released:
+      return 1
+    elapsed = max(now - self._released[0][0], 1.0)
+    rate = sum(cost for _, cost in self._released) / elapsed
+    backlog = self._inflight + self._queued
+    return min(max(math.ceil(backlog / rate), 1), _MAX_RETRY_AFTER_SECONDS)
+
+  def _update_gauges(self):
+    instrumentation.set_admission_state(len(self._waiting), self._queued,
+                                        self._inflight)
+
+
+def from_flags() -> AdmissionController:
+  """Creates an AdmissionController configured by the flags."""
+  return AdmissionController(FLAGS.max_inflight_tokens, FLAGS.max_queued_tokens,
+                             FLAGS.admission_timeout)
+
+
+def rejection_response(e: AdmissionRejected):
+  """Returns the Flask 429 response of a rejected request."""
+  return {"error": str(e)}, 429, {"Retry-After": str(e.retry_after)}
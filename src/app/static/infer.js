@@ -3,12 +3,15 @@ var btn = document.getElementById("submit");
 btn.addEventListener('click', async function(event) {
     event.preventDefault();
     var input = document.getElementById("prompt").value;
+    var responseElement = document.getElementById("response")
 
     if (!document.getElementById("rawInputCheckbox").checked) {
         input = {"instances":[input]}
+        if (await inferStream(input, responseElement)) {
+            return;
+        }
     }
 
-    var responseElement = document.getElementById("response")
     var responsePromise = fetch('/infer?metrics=true', {
         method: 'POST',
         body: JSON.stringify(input),
@@ -30,11 +33,58 @@ btn.addEventListener('click', async function(event) {
         var metricsElement = document.getElementById("response-metrics")
         metricsElement.innerHTML = JSON.stringify(responseJson["metrics"], null, 2);
     }
-    
+
     responseElement.value = JSON.stringify(predictions, null, 2);
     responseElement.dispatchEvent(new Event("input"))
 });
 
+// Renders tokens from /infer_stream as they arrive. Returns false if the
+// server does not support streaming, so the caller can fall back to /infer.
+async function inferStream(input, responseElement) {
+    var response = await fetch('/infer_stream', {
+        method: 'POST',
+        body: JSON.stringify(input),
+        headers: {
+            "Content-Type": "application/json",
+        },
+        cache: "no-cache",
+    });
+    if (response.status == 404 || response.status == 405 || response.body == null) {
+        return false;
+    }
+
+    var reader = response.body.getReader();
+    var decoder = new TextDecoder();
+    var buffer = "";
+    var text = "";
+    responseElement.value = "";
+    while (true) {
+        var { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        var lines = buffer.split("\n");
+        buffer = lines.pop();
+        for (var line of lines) {
+            if (line.trim() == "") {
+                continue;
+            }
+            var message = JSON.parse(line);
+            if (message["token"] != null) {
+                text += message["token"];
+                responseElement.value = text;
+            } else if (message["predictions"] != null) {
+                responseElement.value = JSON.stringify(message["predictions"][0], null, 2);
+            } else if (message["error"] != null) {
+                responseElement.value = JSON.stringify(message, null, 2);
+            }
+            responseElement.dispatchEvent(new Event("input"))
+        }
+    }
+    return true;
+}
+
 $(function () {
     $('[data-toggle="tooltip"]').tooltip()
-  })
\ No newline at end of file
+  })
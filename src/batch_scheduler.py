@@ -0,0 +1,161 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Dynamic micro-batching for the prediction servers.
+
+Merges instances from concurrent requests into a single batch.
+"""
+from concurrent.futures import Future
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from absl import logging
+
+import instrumentation
+
+
+class _PendingRequest:
+  """Instances of a single caller waiting to be batched."""
+
+  def __init__(self, instances, config):
+    self.instances = instances
+    self.config = config
+    self.future = Future()
+    self.enqueue_time = time.perf_counter()
+
+
+class BatchScheduler:
+  """Merges pending requests from many callers into one batch.
+
+  Requests are grouped by their generation config, since a batch can only be
+  generated with a single config. A batch is dispatched once it holds
+  `max_batch_size` instances or once its oldest request waited `max_wait_ms`.
+  Each caller receives its own slice of the batch output through a future.
+  """
+
+  def __init__(
+      self,
+      process_fn: Callable[[List[Any], Dict[str, Any]], List[Any]],
+      max_batch_size: int = 8,
+      max_wait_ms: float = 5.0,
+  ):
+    """Creates the scheduler and starts its worker thread.
+
+    Args:
+      process_fn: Called as process_fn(instances, config) from the worker
+        thread. Must return one output per instance, in order.
+      max_batch_size: Maximum number of instances in a merged batch. A single
+        request larger than this is processed as its own batch.
+      max_wait_ms: Maximum time a request waits for other requests to join
+        its batch.
+    """
+    self._process_fn = process_fn
+    self._max_batch_size = max_batch_size
+    self._max_wait = max_wait_ms / 1000.0
+    self._pending: List[_PendingRequest] = []
+    self._cond = threading.Condition()
+    self._closed = False
+    self._worker = threading.Thread(
+        target=self._run, name="batch-scheduler", daemon=True)
+    self._worker.start()
+
+  def submit(self, instances: List[Any],
+             config: Optional[Dict[str, Any]] = None) -> Future:
+    """Queues instances for batched processing.
+
+    Args:
+      instances: Inputs of a single request.
+      config: Generation config overrides of the request.
+
+    Returns:
+      A future resolving to the list of outputs for `instances`.
+    """
+    pending = _PendingRequest(list(instances), config or {})
+    if not pending.instances:
+      pending.future.set_result([])
+      return pending.future
+    with self._cond:
+      if self._closed:
+        raise RuntimeError("BatchScheduler is closed.")
+      self._pending.append(pending)
+      self._cond.notify()
+    return pending.future
+
+  def close(self):
+    """Stops the worker once all pending requests are processed."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._worker.join()
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      self._process(batch)
+
+  def _next_batch(self) -> Optional[List[_PendingRequest]]:
+    """Blocks until a batch is ready to be dispatched."""
+    with self._cond:
+      while True:
+        if not self._pending:
+          if self._closed:
+            return None
+          self._cond.wait()
+          continue
+
+        head = self._pending[0]
+        key = _config_key(head.config)
+        batch = [head]
+        size = len(head.instances)
+        for pending in self._pending[1:]:
+          if size >= self._max_batch_size:
+            break
+          if (_config_key(pending.config) == key and
+              size + len(pending.instances) <= self._max_batch_size):
+            batch.append(pending)
+            size += len(pending.instances)
+
+        remaining = head.enqueue_time + self._max_wait - time.perf_counter()
+        if size >= self._max_batch_size or remaining <= 0 or self._closed:
+          for pending in batch:
+            self._pending.remove(pending)
+          return batch
+        self._cond.wait(remaining)
+
+  def _process(self, batch: List[_PendingRequest]):
+    now = time.perf_counter()
+    for pending in batch:
+      instrumentation.observe("queue_wait", now - pending.enqueue_time)
+    instances = [x for pending in batch for x in pending.instances]
+    logging.info("Dispatching batch of %d instances from %d requests",
+                 len(instances), len(batch))
+    try:
+      outputs = self._process_fn(instances, batch[0].config)
+    except Exception as e:  # pylint: disable=broad-except
+      for pending in batch:
+        pending.future.set_exception(e)
+      return
+
+    offset = 0
+    for pending in batch:
+      end = offset + len(pending.instances)
+      pending.future.set_result(list(outputs[offset:end]))
+      offset = end
+
+
+def _config_key(config: Dict[str, Any]) -> str:
+  return json.dumps(config, sort_keys=True, default=str)
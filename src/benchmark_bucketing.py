@@ -0,0 +1,132 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the padding and latency saved by length bucketing.
+
+Builds a mixed-length request from the articles of a payload file such as
+predict_payload.json: a few full articles among many short prefixes of them.
+Without --model_path it runs offline on a tiny locally built T5 model and a
+whitespace tokenizer:
+
+  python benchmark_bucketing.py --payload=../predict_payload.json
+"""
+import json
+import random
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+import torch
+from transformers import AutoModelForSeq2SeqLM
+from transformers import AutoTokenizer
+
+from benchmark_utils import build_tiny_model
+from benchmark_utils import write_report
+from length_buckets import padded_tokens
+from length_buckets import plan_buckets
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("payload", "../predict_payload.json",
+                    "Payload file with an 'instances' list of articles.")
+flags.DEFINE_string("model_path", None,
+                    "Optional seq2seq model and tokenizer to benchmark with.")
+flags.DEFINE_integer("num_instances", 32, "Number of instances per request.")
+flags.DEFINE_float("long_fraction", 0.1,
+                   "Fraction of instances that are full articles.")
+flags.DEFINE_integer("max_new_tokens", 16, "Generation budget per instance.")
+flags.DEFINE_integer("bucket_overhead_tokens", 512,
+                     "Estimated cost of an extra generate call in tokens.")
+flags.DEFINE_integer("repeats", 3, "Timed runs per mode.")
+flags.DEFINE_integer("seed", 0, "Random seed.")
+flags.DEFINE_string("report", None, "Optional path of a JSON report.")
+
+
+def _instances(rng):
+  with open(FLAGS.payload) as f:
+    articles = json.load(f)["instances"]
+  instances = []
+  for _ in range(FLAGS.num_instances):
+    words = rng.choice(articles).split()
+    if rng.random() >= FLAGS.long_fraction:
+      words = words[:rng.randint(8, 64)]
+    instances.append(" ".join(words))
+  return instances
+
+
+def _tokenize(tokenizer, instances):
+  if tokenizer is None:
+    # Offline stand-in for a subword tokenizer, within the tiny model vocab.
+    return [[hash(w) % 510 + 2 for w in text.split()] + [1]
+            for text in instances]
+  return tokenizer(instances, truncation=True)["input_ids"]
+
+
+def _run(model, encoded, buckets):
+  start = time.perf_counter()
+  for bucket in buckets:
+    width = max(len(encoded[i]) for i in bucket)
+    input_ids = torch.tensor(
+        [encoded[i] + [0] * (width - len(encoded[i])) for i in bucket])
+    attention_mask = torch.tensor(
+        [[1] * len(encoded[i]) + [0] * (width - len(encoded[i]))
+         for i in bucket])
+    with torch.no_grad():
+      model.generate(input_ids, attention_mask=attention_mask,
+                     max_new_tokens=FLAGS.max_new_tokens,
+                     min_new_tokens=FLAGS.max_new_tokens)
+  return time.perf_counter() - start
+
+
+def main(argv):
+  del argv
+  rng = random.Random(FLAGS.seed)
+  if FLAGS.model_path:
+    tokenizer = AutoTokenizer.from_pretrained(FLAGS.model_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(FLAGS.model_path).eval()
+  else:
+    tokenizer = None
+    model = build_tiny_model("t5")
+
+  encoded = _tokenize(tokenizer, _instances(rng))
+  lengths = [len(ids) for ids in encoded]
+  plans = {
+      "single_batch": [list(range(len(encoded)))],
+      "length_buckets": plan_buckets(lengths, FLAGS.bucket_overhead_tokens),
+  }
+
+  report = {"real_tokens": sum(lengths)}
+  _run(model, encoded, plans["single_batch"])
+  for name, buckets in plans.items():
+    seconds = min(_run(model, encoded, buckets) for _ in range(FLAGS.repeats))
+    total = padded_tokens(lengths, buckets)
+    report[name] = {
+        "buckets": len(buckets),
+        "padded_tokens": total,
+        "padding_tokens": total - report["real_tokens"],
+        "seconds": seconds,
+    }
+    logging.info("%s: %s", name, report[name])
+
+  logging.info(
+      "Length buckets remove %.1f%% of tokens and %.1f%% of latency.",
+      100.0 * (1 - report["length_buckets"]["padded_tokens"] /
+               report["single_batch"]["padded_tokens"]),
+      100.0 * (1 - report["length_buckets"]["seconds"] /
+               report["single_batch"]["seconds"]))
+  write_report(FLAGS.report, report)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,144 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Microbenchmarks the zero-copy Triton codec against the copying one.
+
+Encodes fastertransformer requests and decodes their responses for several
+batch sizes, with the codec of triton_codec.py and with the request builder
+of TritonProcessorBase and tritonclient's InferResult. Reports the time and
+the peak memory allocated per call:
+
+  python benchmark_codec.py --batch_sizes=1,32,256,1024
+"""
+import json
+import time
+import tracemalloc
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+import tritonclient.http as httpclient
+from tritonclient.utils import np_to_triton_dtype
+
+from benchmark_utils import write_report
+from triton_codec import decode_response
+from triton_codec import encode_request
+from triton_processor import MAX_OUTPUT_LEN
+from triton_processor import TritonProcessorBase
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list("batch_sizes", ["1", "32", "256", "1024"],
+                  "Number of instances of a request.")
+flags.DEFINE_integer("input_len", 512, "Input tokens of an instance.")
+flags.DEFINE_integer("repeats", 20, "Measured calls per case.")
+flags.DEFINE_string("report", None, "Optional path of a JSON report.")
+
+
+def _request_arrays(batch_size):
+  rng = np.random.default_rng(0)
+  return {
+      "input_ids": rng.integers(0, 32000, (batch_size, FLAGS.input_len),
+                                dtype=np.uint32),
+      "sequence_length": np.full((batch_size, 1), FLAGS.input_len,
+                                 dtype=np.uint32),
+      "max_output_len": np.full((batch_size, 1), MAX_OUTPUT_LEN,
+                                dtype=np.uint32),
+      "runtime_top_k": np.ones((batch_size, 1), dtype=np.uint32),
+  }
+
+
+def _response_body(batch_size):
+  """Returns the body of a response and the length of its JSON header."""
+  rng = np.random.default_rng(1)
+  outputs = {
+      "output_ids": rng.integers(0, 32000, (batch_size, 1, MAX_OUTPUT_LEN),
+                                 dtype=np.uint32),
+      "sequence_length": np.full((batch_size, 1), MAX_OUTPUT_LEN,
+                                 dtype=np.uint32),
+  }
+  header = json.dumps({
+      "model_name": "fastertransformer",
+      "outputs": [{
+          "name": name,
+          "datatype": np_to_triton_dtype(array.dtype),
+          "shape": list(array.shape),
+          "parameters": {"binary_data_size": array.nbytes},
+      } for name, array in outputs.items()],
+  }).encode()
+  body = header + b"".join(array.tobytes() for array in outputs.values())
+  return body, len(header)
+
+
+def copying_encode(arrays):
+  inputs = []
+  for name, array in arrays.items():
+    infer_input = httpclient.InferInput(name, array.shape,
+                                        np_to_triton_dtype(array.dtype))
+    infer_input.set_data_from_numpy(array, binary_data=True)
+    inputs.append(infer_input)
+  return TritonProcessorBase._get_inference_request(  # pylint: disable=protected-access
+      None, inputs, request_id="", outputs=None, sequence_id=0,
+      sequence_start=False, sequence_end=False, priority=0, timeout=None)
+
+
+def zero_copy_encode(arrays):
+  return encode_request(arrays)
+
+
+def copying_decode(body, header_length):
+  result = httpclient.InferResult.from_response_body(
+      body, header_length=header_length)
+  return [result.as_numpy(name) for name in ("output_ids", "sequence_length")]
+
+
+def zero_copy_decode(body, header_length):
+  return decode_response(body, header_length)
+
+
+def measure(fn, *args):
+  """Returns the mean seconds and peak allocated bytes of a call."""
+  fn(*args)
+  start = time.perf_counter()
+  for _ in range(FLAGS.repeats):
+    fn(*args)
+  seconds = (time.perf_counter() - start) / FLAGS.repeats
+  tracemalloc.start()
+  fn(*args)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return seconds, peak
+
+
+def main(argv):
+  del argv
+  report = {}
+  for batch_size in FLAGS.batch_sizes:
+    arrays = _request_arrays(int(batch_size))
+    body, header_length = _response_body(int(batch_size))
+    report[batch_size] = {}
+    for name, fn, args in (
+        ("copying_encode", copying_encode, (arrays,)),
+        ("zero_copy_encode", zero_copy_encode, (arrays,)),
+        ("copying_decode", copying_decode, (body, header_length)),
+        ("zero_copy_decode", zero_copy_decode, (body, header_length)),
+    ):
+      seconds, peak = measure(fn, *args)
+      report[batch_size][name] = {"us": 1e6 * seconds, "peak_bytes": peak}
+    logging.info("Batch of %s: %s", batch_size, report[batch_size])
+  write_report(FLAGS.report, report)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,147 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks continuous batching against one-shot generate.
+
+Runs on a tiny locally built model, so no download or GPU is needed:
+
+  python benchmark_generation.py --architecture=t5 --num_requests=64
+"""
+import random
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+import torch
+
+from benchmark_utils import build_tiny_model
+from benchmark_utils import percentile
+from benchmark_utils import write_report
+from generation_engine import GenerationEngine
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum("architecture", "t5", ["t5", "gpt2"], "Tiny model to build.")
+flags.DEFINE_integer("num_requests", 64, "Number of single-instance requests.")
+flags.DEFINE_integer("batch_size", 8, "Batch size of both paths.")
+flags.DEFINE_integer("min_prompt_len", 8, "Minimum prompt length in tokens.")
+flags.DEFINE_integer("max_prompt_len", 64, "Maximum prompt length in tokens.")
+flags.DEFINE_integer("min_new_tokens", 4, "Minimum generation budget.")
+flags.DEFINE_integer("max_new_tokens", 128, "Maximum generation budget.")
+flags.DEFINE_integer("seed", 0, "Random seed.")
+flags.DEFINE_string("report", None, "Optional path of a JSON report.")
+
+
+def _requests(rng):
+  requests = []
+  for _ in range(FLAGS.num_requests):
+    length = rng.randint(FLAGS.min_prompt_len, FLAGS.max_prompt_len)
+    requests.append((
+        [rng.randint(2, 511) for _ in range(length)],
+        rng.randint(FLAGS.min_new_tokens, FLAGS.max_new_tokens)))
+  return requests
+
+
+def run_generate(model, requests):
+  """Static batches: every batch runs until its longest budget is spent."""
+  latencies = []
+  outputs = []
+  start = time.perf_counter()
+  for i in range(0, len(requests), FLAGS.batch_size):
+    chunk = requests[i:i + FLAGS.batch_size]
+    width = max(len(ids) for ids, _ in chunk)
+    pad_left = not model.config.is_encoder_decoder
+    input_ids = []
+    attention_mask = []
+    for ids, _ in chunk:
+      padding = [0] * (width - len(ids))
+      mask = [1] * len(ids)
+      input_ids.append(padding + ids if pad_left else ids + padding)
+      attention_mask.append(
+          [0] * len(padding) + mask if pad_left else mask + [0] * len(padding))
+    with torch.no_grad():
+      generated = model.generate(
+          torch.tensor(input_ids),
+          attention_mask=torch.tensor(attention_mask),
+          max_new_tokens=max(budget for _, budget in chunk),
+          do_sample=False, num_beams=1)
+    done = time.perf_counter()
+    for row, (_, budget) in zip(generated.tolist(), chunk):
+      row = row[1:] if model.config.is_encoder_decoder else row[width:]
+      outputs.append(row[:budget])
+      # All requests arrived at the start of the run.
+      latencies.append(done - start)
+  return time.perf_counter() - start, latencies, outputs
+
+
+def run_engine(model, requests):
+  """Continuous batching: sequences leave the batch as soon as they finish."""
+  engine = GenerationEngine(model, max_batch_size=FLAGS.batch_size)
+  start = time.perf_counter()
+  latencies = []
+  futures = []
+  for ids, budget in requests:
+    future = engine.submit(ids, budget)
+    future.add_done_callback(
+        lambda _: latencies.append(time.perf_counter() - start))
+    futures.append(future)
+  outputs = [future.result() for future in futures]
+  elapsed = time.perf_counter() - start
+  engine.close()
+  return elapsed, latencies, outputs
+
+
+def _strip_eos(tokens, eos_token_id):
+  if eos_token_id in tokens:
+    return tokens[:tokens.index(eos_token_id) + 1]
+  return tokens
+
+
+def main(argv):
+  del argv
+  rng = random.Random(FLAGS.seed)
+  model = build_tiny_model(FLAGS.architecture)
+  requests = _requests(rng)
+  eos = model.generation_config.eos_token_id
+
+  # Warm up both paths.
+  run_generate(model, requests[:FLAGS.batch_size])
+  run_engine(model, requests[:FLAGS.batch_size])
+
+  report = {}
+  results = {}
+  for name, fn in (("generate", run_generate), ("engine", run_engine)):
+    elapsed, latencies, outputs = fn(model, requests)
+    results[name] = [_strip_eos(out, eos) for out in outputs]
+    tokens = sum(len(out) for out in results[name])
+    report[name] = {
+        "seconds": elapsed,
+        "tokens_per_second": tokens / elapsed,
+        "p50_latency_s": percentile(latencies, 50),
+        "p90_latency_s": percentile(latencies, 90),
+        "p99_latency_s": percentile(latencies, 99),
+    }
+    logging.info("%s: %s", name, report[name])
+
+  mismatches = sum(
+      a != b for a, b in zip(results["generate"], results["engine"]))
+  report["mismatched_outputs"] = mismatches
+  logging.info("Speedup: %.2fx, mismatched greedy outputs: %d",
+               report["generate"]["seconds"] / report["engine"]["seconds"],
+               mismatches)
+  write_report(FLAGS.report, report)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,186 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Load generator and latency benchmark for /infer endpoints.
+
+Replays payloads at a fixed rate (--qps) or with a fixed number of callers
+(--concurrency) and reports throughput and latency percentiles. Replayed
+payloads repeat, so disable the response cache of the server under test. To
+run offline against stub backends:
+
+  python stub_backend.py --output_dir=/tmp/stub_model
+  python predict.py --model_path=/tmp/stub_model --response_cache_size=0 &
+  python predict_triton.py --stub_backend --hf_model_path=/tmp/stub_model \
+      --response_cache_size=0 --port=5001 &
+  python benchmark_serving.py --url=http://localhost:5000/infer \
+      --concurrency=8 --num_requests=200
+"""
+import collections
+from concurrent import futures
+import json
+import threading
+import time
+from typing import List
+import urllib.error
+import urllib.request
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from benchmark_utils import percentile
+from benchmark_utils import write_report
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("url", "http://localhost:5000/infer",
+                    "Inference endpoint to send requests to.")
+flags.DEFINE_multi_string(
+    "payload", ["../predict_payload.json"],
+    "Payload files to replay in turn. Can be repeated.")
+flags.DEFINE_float(
+    "qps", 0,
+    "Requests per second to send, independent of response times. 0 uses "
+    "--concurrency instead.")
+flags.DEFINE_integer(
+    "concurrency", 1,
+    "Number of callers that each send their next request as soon as the "
+    "previous one returns. Used when --qps is 0.")
+flags.DEFINE_integer("num_requests", 100, "Number of measured requests.")
+flags.DEFINE_integer("warmup_requests", 5,
+                     "Requests sent before measuring, not reported.")
+flags.DEFINE_float("timeout", 300, "Request timeout in seconds.")
+flags.DEFINE_integer("max_in_flight", 256,
+                     "Maximum number of outstanding requests with --qps.")
+flags.DEFINE_string("report", None, "Optional path of a JSON report.")
+
+
+class _Result:
+
+  def __init__(self, status, latency, instances):
+    self.status = status
+    self.latency = latency
+    self.instances = instances
+
+
+def _load_payloads(paths: List[str]) -> List[bytes]:
+  payloads = []
+  for path in paths:
+    with open(path) as f:
+      payloads.append(json.dumps(json.load(f)).encode())
+  return payloads
+
+
+def _send(payload: bytes, scheduled_time: float) -> _Result:
+  """Sends one request. Latency counts from its scheduled send time."""
+  req = urllib.request.Request(
+      FLAGS.url, data=payload, headers={"Content-Type": "application/json"})
+  try:
+    with urllib.request.urlopen(req, timeout=FLAGS.timeout) as response:
+      body = json.loads(response.read())
+      status = response.status
+    instances = len(body.get("predictions", []))
+  except urllib.error.HTTPError as e:
+    status, instances = e.code, 0
+  except (urllib.error.URLError, OSError) as e:
+    logging.warning("Request failed: %s", e)
+    status, instances = "error", 0
+  return _Result(status, time.perf_counter() - scheduled_time, instances)
+
+
+def run_fixed_qps(payloads, num_requests):
+  """Open loop: sends requests on a fixed schedule."""
+  interval = 1.0 / FLAGS.qps
+  start = time.perf_counter()
+  pending = []
+  with futures.ThreadPoolExecutor(FLAGS.max_in_flight) as pool:
+    for i in range(num_requests):
+      scheduled_time = start + i * interval
+      delay = scheduled_time - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      pending.append(
+          pool.submit(_send, payloads[i % len(payloads)], scheduled_time))
+    results = [f.result() for f in pending]
+  return results, time.perf_counter() - start
+
+
+def run_fixed_concurrency(payloads, num_requests):
+  """Closed loop: every caller waits for its previous response."""
+  counter = iter(range(num_requests))
+  lock = threading.Lock()
+  results = []
+
+  def caller():
+    while True:
+      with lock:
+        i = next(counter, None)
+      if i is None:
+        return
+      result = _send(payloads[i % len(payloads)], time.perf_counter())
+      with lock:
+        results.append(result)
+
+  start = time.perf_counter()
+  threads = [threading.Thread(target=caller)
+             for _ in range(FLAGS.concurrency)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+  ok = [r for r in results if r.status == 200]
+  latencies = [r.latency for r in ok]
+  return {
+      "url": FLAGS.url,
+      "mode": (f"qps={FLAGS.qps}" if FLAGS.qps > 0 else
+               f"concurrency={FLAGS.concurrency}"),
+      "requests": len(results),
+      "errors": len(results) - len(ok),
+      "status_codes": dict(
+          collections.Counter(str(r.status) for r in results)),
+      "seconds": elapsed,
+      "requests_per_second": len(ok) / elapsed,
+      "instances_per_second": sum(r.instances for r in ok) / elapsed,
+      "latency_mean_s": sum(latencies) / len(latencies) if latencies else 0,
+      "latency_p50_s": percentile(latencies, 50),
+      "latency_p90_s": percentile(latencies, 90),
+      "latency_p99_s": percentile(latencies, 99),
+      "latency_max_s": max(latencies) if latencies else 0,
+  }
+
+
+def main(argv):
+  del argv
+  payloads = _load_payloads(FLAGS.payload)
+  run = run_fixed_qps if FLAGS.qps > 0 else run_fixed_concurrency
+  if FLAGS.warmup_requests:
+    run(payloads, FLAGS.warmup_requests)
+  results, elapsed = run(payloads, FLAGS.num_requests)
+  report = summarize(results, elapsed)
+  logging.info("Throughput: %.2f req/s, %.2f instances/s",
+               report["requests_per_second"], report["instances_per_second"])
+  logging.info("Latency p50 %.1f ms, p90 %.1f ms, p99 %.1f ms",
+               1000 * report["latency_p50_s"], 1000 * report["latency_p90_s"],
+               1000 * report["latency_p99_s"])
+  if report["errors"]:
+    logging.warning("%d requests failed: %s", report["errors"],
+                    report["status_codes"])
+  write_report(FLAGS.report, report)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,144 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks assisted generation with a draft model against plain generate.
+
+Runs on tiny locally built models, so no download or GPU is needed. The main
+model is the draft model with --extra_layers more layers, whose output
+projections are scaled by --extra_layer_scale. At scale 0 the extra layers
+are identities and the draft always agrees with the main model; larger
+scales make them disagree more often, like a real draft model.
+
+  python benchmark_speculative.py --architecture=t5 --extra_layer_scale=0.5
+"""
+import random
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+import torch
+
+from benchmark_utils import build_tiny_model
+from benchmark_utils import percentile
+from benchmark_utils import write_report
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum("architecture", "t5", ["t5", "gpt2"], "Tiny model to build.")
+flags.DEFINE_integer("draft_layers", 2, "Number of layers of the draft model.")
+flags.DEFINE_integer("extra_layers", 10,
+                     "Number of layers the main model has on top of them.")
+flags.DEFINE_float("extra_layer_scale", 0.5,
+                   "Scale of the output projections of the extra layers.")
+flags.DEFINE_float(
+    "assistant_confidence_threshold", 0.0,
+    "Draft probability below which a draft ends early. Randomly initialized "
+    "models predict with low confidence, so a nonzero threshold ends most "
+    "drafts after one token.")
+flags.DEFINE_integer("num_requests", 32, "Number of single-instance requests.")
+flags.DEFINE_integer("min_prompt_len", 8, "Minimum prompt length in tokens.")
+flags.DEFINE_integer("max_prompt_len", 64, "Maximum prompt length in tokens.")
+flags.DEFINE_integer("max_new_tokens", 64, "Generation budget.")
+flags.DEFINE_integer("seed", 0, "Random seed.")
+flags.DEFINE_string("report", None, "Optional path of a JSON report.")
+
+# Output projections of the residual branches of each layer.
+_OUTPUT_PROJECTIONS = {
+    "t5": ("SelfAttention.o.", "EncDecAttention.o.", "DenseReluDense.wo."),
+    "gpt2": ("attn.c_proj.", "mlp.c_proj."),
+}
+
+
+def build_models():
+  """Returns a draft model and a deeper main model extending it."""
+  draft = build_tiny_model(FLAGS.architecture, FLAGS.draft_layers,
+                           seed=FLAGS.seed)
+  main_model = build_tiny_model(FLAGS.architecture,
+                                FLAGS.draft_layers + FLAGS.extra_layers,
+                                seed=FLAGS.seed + 1)
+  state = main_model.state_dict()
+  draft_state = draft.state_dict()
+  for name, tensor in state.items():
+    if name in draft_state:
+      tensor.copy_(draft_state[name])
+    elif any(p in name for p in _OUTPUT_PROJECTIONS[FLAGS.architecture]):
+      tensor.mul_(FLAGS.extra_layer_scale)
+  draft.generation_config.assistant_confidence_threshold = (
+      FLAGS.assistant_confidence_threshold)
+  return draft, main_model
+
+
+def _requests(rng):
+  return [[rng.randint(2, 511)
+           for _ in range(rng.randint(FLAGS.min_prompt_len,
+                                      FLAGS.max_prompt_len))]
+          for _ in range(FLAGS.num_requests)]
+
+
+def run(model, requests, assistant_model=None):
+  """Generates every request on its own, as assisted generation requires."""
+  latencies = []
+  outputs = []
+  start = time.perf_counter()
+  for ids in requests:
+    request_start = time.perf_counter()
+    with torch.no_grad():
+      generated = model.generate(
+          torch.tensor([ids]),
+          max_new_tokens=FLAGS.max_new_tokens,
+          do_sample=False,
+          num_beams=1,
+          assistant_model=assistant_model)
+    latencies.append(time.perf_counter() - request_start)
+    row = generated[0].tolist()
+    outputs.append(row[1:] if model.config.is_encoder_decoder else
+                   row[len(ids):])
+  return time.perf_counter() - start, latencies, outputs
+
+
+def main(argv):
+  del argv
+  rng = random.Random(FLAGS.seed)
+  draft, main_model = build_models()
+  requests = _requests(rng)
+
+  # Warm up both paths.
+  run(main_model, requests[:2])
+  run(main_model, requests[:2], draft)
+
+  report = {}
+  results = {}
+  for name, assistant_model in (("generate", None), ("assisted", draft)):
+    elapsed, latencies, outputs = run(main_model, requests, assistant_model)
+    results[name] = outputs
+    tokens = sum(len(out) for out in outputs)
+    report[name] = {
+        "seconds": elapsed,
+        "tokens_per_second": tokens / elapsed,
+        "p50_latency_s": percentile(latencies, 50),
+        "p90_latency_s": percentile(latencies, 90),
+    }
+    logging.info("%s: %s", name, report[name])
+
+  mismatches = sum(
+      a != b for a, b in zip(results["generate"], results["assisted"]))
+  report["mismatched_outputs"] = mismatches
+  logging.info("Speedup: %.2fx, mismatched greedy outputs: %d",
+               report["generate"]["seconds"] / report["assisted"]["seconds"],
+               mismatches)
+  write_report(FLAGS.report, report)
+
+
+if __name__ == "__main__":
+  app.run(main)
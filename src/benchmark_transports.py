@@ -0,0 +1,122 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the transports of the Triton processor.
+
+Sends the same fastertransformer requests over HTTP, gRPC and HTTP with
+system shared memory, and reports the latency of a request per transport
+and batch size. Run it on the host of the Triton server started by
+predict_triton.py, which shared memory requires:
+
+  python benchmark_transports.py --hf_model_path=/all_models/t5-base \\
+      --batch_sizes=1,8,32
+
+With --stub_backend the requests are answered in process, which only
+exercises the client side of each transport. With --fake_triton they are
+sent to fake_triton.py, started in process, which serves every transport but
+gRPC, so gRPC is left out of the default transports.
+"""
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from benchmark_utils import percentile
+from benchmark_utils import write_report
+import fake_triton
+from stub_backend import StubTritonClient
+from triton_processor import ProcessorPool
+from triton_processor import TRANSPORTS
+import warmup
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("hf_model_path", "t5-base", "Path of the tokenizer.")
+flags.DEFINE_string("triton_host", "localhost", "Triton host.")
+flags.DEFINE_integer("triton_port", 8000, "Triton HTTP port.")
+flags.DEFINE_integer("triton_grpc_port", 8001, "Triton gRPC port.")
+flags.DEFINE_list("transports", list(TRANSPORTS),
+                  "Transports to compare. gRPC is not supported with "
+                  "--fake_triton.")
+flags.DEFINE_list("batch_sizes", ["1", "8", "32"],
+                  "Number of instances of a request.")
+flags.DEFINE_integer("input_words", 128, "Approximate words of an instance.")
+flags.DEFINE_integer("num_requests", 50,
+                     "Number of measured requests per transport and batch "
+                     "size.")
+flags.DEFINE_integer("warmup_requests", 5, "Number of unmeasured requests.")
+flags.DEFINE_bool("stub_backend", False,
+                  "Answer requests with a stub instead of Triton.")
+flags.DEFINE_bool("fake_triton", False,
+                  "Send requests to a fake Triton server started in process.")
+flags.DEFINE_string("report", None, "Optional path of a JSON report.")
+
+
+def run(processor, texts, num_requests):
+  """Returns the latencies of `num_requests` requests of `texts`."""
+  latencies = []
+  for _ in range(num_requests):
+    start = time.perf_counter()
+    processor.infer_batch(texts)
+    latencies.append(time.perf_counter() - start)
+  return latencies
+
+
+def main(argv):
+  del argv
+  report = {}
+  host = FLAGS.triton_host
+  transports = FLAGS.transports
+  fake_server = None
+  if FLAGS.fake_triton:
+    if "grpc" in transports:
+      if FLAGS["transports"].present:
+        raise app.UsageError(
+            "fake_triton.py only serves HTTP, remove grpc from --transports.")
+      transports = [t for t in transports if t != "grpc"]
+    fake_server = fake_triton.start(port=0)
+    host, http_port = fake_server.server_address[:2]
+  for transport in transports:
+    if transport == "grpc":
+      port = FLAGS.triton_grpc_port
+    elif fake_server is not None:
+      port = http_port
+    else:
+      port = FLAGS.triton_port
+    pool = ProcessorPool(
+        FLAGS.hf_model_path, host, port, size=1,
+        client_factory=StubTritonClient if FLAGS.stub_backend else None,
+        transport=transport)
+    report[transport] = {}
+    with pool.processor() as processor:
+      for batch_size in FLAGS.batch_sizes:
+        texts = [warmup.synthetic_text(FLAGS.input_words)] * int(batch_size)
+        run(processor, texts, FLAGS.warmup_requests)
+        latencies = run(processor, texts, FLAGS.num_requests)
+        report[transport][batch_size] = {
+            "mean_latency_ms": 1000 * sum(latencies) / len(latencies),
+            "p50_latency_ms": 1000 * percentile(latencies, 50),
+            "p90_latency_ms": 1000 * percentile(latencies, 90),
+        }
+        logging.info("%s, batch of %s: %s", transport, batch_size,
+                     report[transport][batch_size])
+    pool.close()
+  if fake_server is not None:
+    fake_server.shutdown()
+    fake_server.server_close()
+  write_report(FLAGS.report, report)
+
+
+if __name__ == "__main__":
+  app.run(main)
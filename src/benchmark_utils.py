@@ -0,0 +1,70 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared helpers for the serving benchmarks.
+
+Shared helpers for the serving benchmarks.
+"""
+import json
+from typing import Any, Dict, List
+
+
+def build_tiny_model(architecture: str = "t5", num_layers: int = 2,
+                     seed: int = 0):
+  """Builds a small randomly initialized model without any download.
+
+  Args:
+    architecture: 't5' for a seq2seq model or 'gpt2' for a causal LM.
+    num_layers: Number of layers of the encoder and decoder stacks.
+    seed: Seed of the weight initialization.
+
+  Returns:
+    The model in eval mode.
+  """
+  # Imported here so the load generator does not need torch.
+  import torch  # pylint: disable=g-import-not-at-top
+  from transformers import GPT2Config, GPT2LMHeadModel  # pylint: disable=g-import-not-at-top
+  from transformers import T5Config, T5ForConditionalGeneration  # pylint: disable=g-import-not-at-top
+
+  torch.manual_seed(seed)
+  if architecture == "t5":
+    config = T5Config(
+        vocab_size=512, d_model=64, d_kv=16, d_ff=128, num_heads=4,
+        num_layers=num_layers, num_decoder_layers=num_layers,
+        decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+    model = T5ForConditionalGeneration(config)
+  elif architecture == "gpt2":
+    config = GPT2Config(
+        vocab_size=512, n_positions=1024, n_embd=64, n_layer=num_layers,
+        n_head=4, bos_token_id=1, eos_token_id=1, pad_token_id=0)
+    model = GPT2LMHeadModel(config)
+  else:
+    raise ValueError(f"Unknown architecture: {architecture}")
+  model.generation_config.pad_token_id = 0
+  return model.eval()
+
+
+def percentile(values: List[float], pct: float) -> float:
+  """Returns the nearest-rank percentile of `values`."""
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+  return ordered[min(rank, len(ordered) - 1)]
+
+
+def write_report(path: str, report: Dict[str, Any]):
+  """Writes a benchmark report as JSON, if a path is given."""
+  if path:
+    with open(path, "w") as f:
+      json.dump(report, f, indent=2)
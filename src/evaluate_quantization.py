@@ -0,0 +1,143 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Evaluates a model before and after int8 quantization.
+
+Generates greedy predictions for the instances of payload files with the
+model as loaded and after dynamic int8 quantization, as served with
+predict.py --quantize. Reports ROUGE of both against reference predictions
+if given, and ROUGE of the quantized predictions against the unquantized
+ones:
+
+  python evaluate_quantization.py --model_path=/tmp/model \\
+      --payload=../predict_payload.json --references=../predict_result.json
+"""
+import json
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+from rouge_score import rouge_scorer
+import torch
+from transformers import AutoTokenizer
+
+from benchmark_utils import write_report
+from model_loading import model_size_bytes
+from model_loading import quantize_dynamic_int8
+from model_loading import resolve_autoclass
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("model_path", None, "Local path of the HF model.")
+flags.DEFINE_multi_string(
+    "payload", ["../predict_payload.json"],
+    "Payload files whose instances are evaluated. Can be repeated.")
+flags.DEFINE_multi_string(
+    "references", [],
+    "Optional files with the reference 'predictions' of each payload, in the "
+    "same order.")
+flags.DEFINE_integer("max_new_tokens", 128, "Generation budget.")
+flags.DEFINE_integer("batch_size", 8, "Instances generated together.")
+flags.DEFINE_string("report", None, "Optional path of a JSON report.")
+flags.mark_flag_as_required("model_path")
+
+_ROUGE_TYPES = ("rouge1", "rouge2", "rougeL")
+
+
+def _load_field(paths, field):
+  values = []
+  for path in paths:
+    with open(path) as f:
+      values.extend(json.load(f)[field])
+  return values
+
+
+def generate_all(model, tokenizer, texts):
+  """Returns the greedy predictions of `texts` and the time taken."""
+  predictions = []
+  start = time.perf_counter()
+  for i in range(0, len(texts), FLAGS.batch_size):
+    inputs = tokenizer(texts[i:i + FLAGS.batch_size], return_tensors="pt",
+                       padding=True, truncation=True)
+    with torch.no_grad():
+      outputs = model.generate(**inputs, max_new_tokens=FLAGS.max_new_tokens,
+                               do_sample=False, num_beams=1)
+    if not model.config.is_encoder_decoder:
+      outputs = outputs[:, inputs["input_ids"].shape[1]:]
+    predictions.extend(
+        tokenizer.batch_decode(outputs, skip_special_tokens=True))
+  return predictions, time.perf_counter() - start
+
+
+def rouge(predictions, references):
+  """Returns the mean ROUGE F-measures in percent."""
+  scorer = rouge_scorer.RougeScorer(_ROUGE_TYPES, use_stemmer=True)
+  totals = dict.fromkeys(_ROUGE_TYPES, 0.0)
+  for prediction, reference in zip(predictions, references):
+    if prediction == reference:
+      # Also counts two empty texts as a match, which ROUGE scores as 0.
+      for key in _ROUGE_TYPES:
+        totals[key] += 1.0
+      continue
+    scores = scorer.score(reference, prediction)
+    for key in _ROUGE_TYPES:
+      totals[key] += scores[key].fmeasure
+  return {key: round(100 * total / max(len(predictions), 1), 4)
+          for key, total in totals.items()}
+
+
+def main(argv):
+  del argv
+  texts = _load_field(FLAGS.payload, "instances")
+  references = _load_field(FLAGS.references, "predictions")
+  if references and len(references) != len(texts):
+    raise ValueError(f"Got {len(references)} references for {len(texts)} "
+                     "instances.")
+
+  tokenizer = AutoTokenizer.from_pretrained(FLAGS.model_path)
+  model_class = resolve_autoclass(FLAGS.model_path)
+  model = model_class.from_pretrained(FLAGS.model_path).eval()
+  if not model.config.is_encoder_decoder:
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+      tokenizer.pad_token = tokenizer.eos_token
+
+  report = {}
+  results = {}
+  for name in ("float", "int8"):
+    if name == "int8":
+      model = quantize_dynamic_int8(model)
+    # Run once before measuring.
+    generate_all(model, tokenizer, texts[:1])
+    results[name], elapsed = generate_all(model, tokenizer, texts)
+    report[name] = {
+        "size_bytes": model_size_bytes(model),
+        "seconds": elapsed,
+        "seconds_per_instance": elapsed / len(texts),
+    }
+    if references:
+      report[name]["rouge"] = rouge(results[name], references)
+    logging.info("%s: %s", name, report[name])
+
+  report["int8_vs_float_rouge"] = rouge(results["int8"], results["float"])
+  report["identical_predictions"] = sum(
+      a == b for a, b in zip(results["float"], results["int8"]))
+  logging.info("int8 vs float: %s, %d of %d predictions identical",
+               report["int8_vs_float_rouge"], report["identical_predictions"],
+               len(texts))
+  write_report(FLAGS.report, report)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,567 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fake Triton server for offline tests and benchmarks.
+
+Serves the fastertransformer model over the KServe v2 HTTP protocol of
+Triton, with its binary tensor data, system shared memory and statistics
+extensions, without a GPU. Outputs echo the input tokens like
+StubTritonClient, after a simulated execution latency. Requests are executed
+one at a time per model instance, or merged by a dynamic batcher:
+
+  python fake_triton.py --port=8000 --dynamic_batching --max_queue_delay_ms=2
+  python predict_triton.py --nolaunch_triton --hf_model_path=/tmp/stub_model
+"""
+from concurrent.futures import Future
+from http import server
+import json
+import mmap
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+from tritonclient.utils import np_to_triton_dtype
+from tritonclient.utils import triton_to_np_dtype
+
+from stub_backend import echo_outputs
+from triton_codec import decode_request
+from triton_codec import HEADER_LENGTH
+
+FLAGS = flags.FLAGS
+
+MODEL_NAME = "fastertransformer"
+
+# Inputs the fastertransformer model requires, as in config.pbtxt.
+_REQUIRED_INPUTS = ("input_ids", "sequence_length", "max_output_len")
+
+_MODEL_METADATA = {
+    "name": MODEL_NAME,
+    "versions": ["1"],
+    "platform": "fastertransformer",
+    "inputs": [
+        {"name": "input_ids", "datatype": "UINT32", "shape": [-1, -1]},
+        {"name": "sequence_length", "datatype": "UINT32", "shape": [-1, 1]},
+        {"name": "max_output_len", "datatype": "UINT32", "shape": [-1, 1]},
+    ],
+    "outputs": [
+        {"name": "output_ids", "datatype": "UINT32", "shape": [-1, -1, -1]},
+        {"name": "sequence_length", "datatype": "UINT32", "shape": [-1, -1]},
+    ],
+}
+
+
+class InferenceError(Exception):
+  """Raised for a request Triton would reject, with its HTTP status."""
+
+  def __init__(self, message, status=400):
+    super().__init__(message)
+    self.status = status
+
+
+class _PendingRequest:
+  """Inputs of a request waiting to be executed."""
+
+  def __init__(self, arrays):
+    self.arrays = arrays
+    self.rows = arrays["input_ids"].shape[0]
+    # Like Triton, only requests with equal shapes but for the batch
+    # dimension are batched together.
+    self.signature = tuple(sorted(
+        (name, array.shape[1:], array.dtype.str)
+        for name, array in arrays.items()))
+    self.future = Future()
+    self.enqueue_time = time.perf_counter()
+
+
+class FakeModel:
+  """Executes fastertransformer requests with a simulated latency.
+
+  An execution of a batch takes `latency_ms + per_token_ms * max_output_len`
+  for the largest max_output_len of the batch. `instance_count` executions
+  run concurrently. With dynamic batching, queued requests of equal shapes
+  are executed together, up to `max_batch_size` rows, once the oldest waited
+  `max_queue_delay_ms`.
+  """
+
+  def __init__(self, latency_ms: float = 20.0, per_token_ms: float = 0.5,
+               max_batch_size: int = 1024, dynamic_batching: bool = False,
+               max_queue_delay_ms: float = 0.0, instance_count: int = 1):
+    self._latency_ms = latency_ms
+    self._per_token_ms = per_token_ms
+    self._max_batch_size = max_batch_size
+    self._dynamic_batching = dynamic_batching
+    self._max_queue_delay = max_queue_delay_ms / 1000.0
+    self._pending: List[_PendingRequest] = []
+    self._cond = threading.Condition()
+    self._closed = False
+    self._stats = {"inference_count": 0, "execution_count": 0,
+                   "queue_ns": 0, "compute_ns": 0}
+    self._batch_stats = {}
+    self._workers = [
+        threading.Thread(target=self._run, name=f"fake-triton-{i}",
+                         daemon=True)
+        for i in range(instance_count)
+    ]
+    for worker in self._workers:
+      worker.start()
+
+  def infer(self, arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Blocks until the request is executed and returns its outputs.
+
+    Raises:
+      InferenceError: If the inputs do not match the model.
+    """
+    for name in _REQUIRED_INPUTS:
+      if name not in arrays:
+        raise InferenceError(f"expected input {name!r} for model "
+                             f"{MODEL_NAME!r}")
+    rows = arrays["input_ids"].shape[0]
+    if any(array.shape[0] != rows for array in arrays.values()):
+      raise InferenceError("inputs must have the same batch size")
+    if rows > self._max_batch_size:
+      raise InferenceError(
+          f"inference request batch-size must be <= {self._max_batch_size} "
+          f"for {MODEL_NAME!r}")
+    pending = _PendingRequest(arrays)
+    with self._cond:
+      if self._closed:
+        raise InferenceError("server is shutting down", status=503)
+      self._pending.append(pending)
+      self._cond.notify()
+    return pending.future.result()
+
+  def stats(self) -> Dict[str, Any]:
+    """Returns the statistics of the model, as Triton's statistics API."""
+    with self._cond:
+      stats = dict(self._stats)
+      batch_stats = [
+          {"batch_size": size,
+           "compute_infer": {"count": count, "ns": ns}}
+          for size, (count, ns) in sorted(self._batch_stats.items())
+      ]
+    return {
+        "name": MODEL_NAME,
+        "version": "1",
+        "inference_count": stats["inference_count"],
+        "execution_count": stats["execution_count"],
+        "inference_stats": {
+            "success": {"count": stats["inference_count"],
+                        "ns": stats["queue_ns"] + stats["compute_ns"]},
+            "queue": {"count": stats["inference_count"],
+                      "ns": stats["queue_ns"]},
+            "compute_infer": {"count": stats["execution_count"],
+                              "ns": stats["compute_ns"]},
+        },
+        "batch_stats": batch_stats,
+    }
+
+  def close(self):
+    """Stops the workers once all pending requests are executed."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    for worker in self._workers:
+      worker.join()
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      self._execute(batch)
+
+  def _next_batch(self) -> Optional[List[_PendingRequest]]:
+    """Blocks until a batch is ready to be executed."""
+    with self._cond:
+      while True:
+        if not self._pending:
+          if self._closed:
+            return None
+          self._cond.wait()
+          continue
+
+        head = self._pending[0]
+        batch = [head]
+        rows = head.rows
+        if self._dynamic_batching:
+          for pending in self._pending[1:]:
+            if rows >= self._max_batch_size:
+              break
+            if (pending.signature == head.signature and
+                rows + pending.rows <= self._max_batch_size):
+              batch.append(pending)
+              rows += pending.rows
+          remaining = (head.enqueue_time + self._max_queue_delay -
+                       time.perf_counter())
+        else:
+          remaining = 0
+        if rows >= self._max_batch_size or remaining <= 0 or self._closed:
+          for pending in batch:
+            self._pending.remove(pending)
+          return batch
+        self._cond.wait(remaining)
+
+  def _execute(self, batch: List[_PendingRequest]):
+    start = time.perf_counter()
+    max_output_len = max(
+        int(pending.arrays["max_output_len"].max()) for pending in batch)
+    time.sleep(
+        (self._latency_ms + self._per_token_ms * max_output_len) / 1000.0)
+    end = time.perf_counter()
+    rows = sum(pending.rows for pending in batch)
+    with self._cond:
+      self._stats["inference_count"] += rows
+      self._stats["execution_count"] += 1
+      self._stats["queue_ns"] += sum(
+          int(1e9 * (start - pending.enqueue_time)) for pending in batch)
+      self._stats["compute_ns"] += int(1e9 * (end - start))
+      count, ns = self._batch_stats.get(rows, (0, 0))
+      self._batch_stats[rows] = (count + 1, ns + int(1e9 * (end - start)))
+    for pending in batch:
+      try:
+        pending.future.set_result(echo_outputs(pending.arrays))
+      except Exception as e:  # pylint: disable=broad-except
+        pending.future.set_exception(e)
+
+
+class _SharedMemoryRegion:
+  """System shared memory region registered by a client."""
+
+  def __init__(self, key, offset, byte_size):
+    fd = os.open("/dev/shm/" + key.lstrip("/"), os.O_RDWR)
+    try:
+      # Maps the whole object, since mmap offsets must be page aligned.
+      self._buffer = mmap.mmap(fd, offset + byte_size)
+    finally:
+      os.close(fd)
+    self.key = key
+    self.offset = offset
+    self.byte_size = byte_size
+
+  def read(self, dtype, shape, offset, byte_size):
+    self._check(offset, byte_size)
+    return np.frombuffer(
+        self._buffer, dtype=dtype, count=byte_size // np.dtype(dtype).itemsize,
+        offset=self.offset + offset).reshape(shape).copy()
+
+  def write(self, array, offset, byte_size):
+    self._check(offset, array.nbytes)
+    if array.nbytes > byte_size:
+      raise InferenceError(
+          f"shared memory size specified with the request for output is "
+          f"{byte_size} bytes, output needs {array.nbytes} bytes")
+    start = self.offset + offset
+    self._buffer[start:start + array.nbytes] = array.tobytes()
+
+  def close(self):
+    self._buffer.close()
+
+  def _check(self, offset, byte_size):
+    if offset + byte_size > self.byte_size:
+      raise InferenceError(
+          f"{byte_size} bytes at offset {offset} exceed the shared memory "
+          f"region of {self.byte_size} bytes")
+
+
+class FakeTritonServer(server.ThreadingHTTPServer):
+  """HTTP server of the KServe v2 endpoints Triton serves for one model."""
+
+  daemon_threads = True
+
+  def __init__(self, address, model: FakeModel):
+    super().__init__(address, _Handler)
+    self.model = model
+    self.regions: Dict[str, _SharedMemoryRegion] = {}
+    self.regions_lock = threading.Lock()
+
+  def server_close(self):
+    super().server_close()
+    self.model.close()
+    with self.regions_lock:
+      for region in self.regions.values():
+        region.close()
+      self.regions.clear()
+
+
+class _Handler(server.BaseHTTPRequestHandler):
+  """Handles the requests of one connection to a FakeTritonServer."""
+
+  protocol_version = "HTTP/1.1"
+  # Headers, JSON and binary outputs are separate writes.
+  disable_nagle_algorithm = True
+
+  _ROUTES = (
+      ("GET", r"/v2/health/(live|ready)", "_health"),
+      ("GET", r"/v2", "_server_metadata"),
+      ("GET", r"/v2/models/([^/]+)(?:/versions/\d+)?/ready", "_model_ready"),
+      ("GET", r"/v2/models(?:/([^/]+)(?:/versions/\d+)?)?/stats", "_stats"),
+      ("GET", r"/v2/models/([^/]+)(?:/versions/\d+)?", "_model_metadata"),
+      ("POST", r"/v2/models/([^/]+)(?:/versions/\d+)?/infer", "_infer"),
+      ("GET", r"/v2/systemsharedmemory(?:/region/([^/]+))?/status",
+       "_shm_status"),
+      ("POST", r"/v2/systemsharedmemory/region/([^/]+)/register",
+       "_shm_register"),
+      ("POST", r"/v2/systemsharedmemory(?:/region/([^/]+))?/unregister",
+       "_shm_unregister"),
+  )
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    self._dispatch("GET")
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    self._dispatch("POST")
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    logging.debug(format, *args)
+
+  def _dispatch(self, method):
+    path = self.path.split("?", 1)[0]
+    body = self._read_body()
+    for route_method, pattern, handler in self._ROUTES:
+      match = re.fullmatch(pattern, path)
+      if route_method == method and match:
+        try:
+          getattr(self, handler)(body, *match.groups())
+        except InferenceError as e:
+          self._send_json({"error": str(e)}, e.status)
+        except (ValueError, KeyError, TypeError) as e:
+          self._send_json({"error": f"malformed request: {e}"}, 400)
+        return
+    self._send_json({"error": "Not Found"}, 404)
+
+  def _read_body(self):
+    length = int(self.headers.get("Content-Length", 0))
+    body = bytearray(length)
+    view = memoryview(body)
+    read = 0
+    while read < length:
+      count = self.rfile.readinto(view[read:])
+      if not count:
+        break
+      read += count
+    return body
+
+  def _send_json(self, payload, status=200):
+    body = json.dumps(payload).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _send_empty(self):
+    self.send_response(200)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def _check_model(self, model_name):
+    if model_name != MODEL_NAME:
+      raise InferenceError(
+          f"Request for unknown model: '{model_name}' is not found", 404)
+
+  def _health(self, body, kind):
+    del body, kind
+    self._send_empty()
+
+  def _server_metadata(self, body):
+    del body
+    self._send_json({
+        "name": "fake_triton",
+        "version": "0",
+        "extensions": ["binary_tensor_data", "system_shared_memory",
+                       "statistics"],
+    })
+
+  def _model_ready(self, body, model_name):
+    del body
+    self._check_model(model_name)
+    self._send_empty()
+
+  def _model_metadata(self, body, model_name):
+    del body
+    self._check_model(model_name)
+    self._send_json(_MODEL_METADATA)
+
+  def _stats(self, body, model_name):
+    del body
+    if model_name is not None:
+      self._check_model(model_name)
+    self._send_json({"model_stats": [self.server.model.stats()]})
+
+  def _infer(self, body, model_name):
+    self._check_model(model_name)
+    header_length = self.headers.get(HEADER_LENGTH)
+    request, arrays = decode_request(
+        body, int(header_length) if header_length is not None else None)
+    for tensor in request.get("inputs", []):
+      parameters = tensor.get("parameters", {})
+      if "shared_memory_region" in parameters:
+        region = self._region(parameters["shared_memory_region"])
+        arrays[tensor["name"]] = region.read(
+            triton_to_np_dtype(tensor["datatype"]), tensor["shape"],
+            parameters.get("shared_memory_offset", 0),
+            parameters["shared_memory_byte_size"])
+    outputs = self.server.model.infer(arrays)
+    self._send_outputs(request, outputs)
+
+  def _send_outputs(self, request, outputs):
+    """Sends the requested outputs as JSON, binary data or shared memory."""
+    binary_default = request.get("parameters", {}).get("binary_data_output",
+                                                       False)
+    requested = request.get("outputs")
+    if requested is None:
+      requested = [{"name": name} for name in outputs]
+    tensors = []
+    buffers = []
+    for output in requested:
+      name = output["name"]
+      if name not in outputs:
+        raise InferenceError(f"unexpected inference output '{name}' for "
+                             f"model '{MODEL_NAME}'")
+      array = np.ascontiguousarray(outputs[name])
+      parameters = output.get("parameters", {})
+      tensor = {"name": name, "datatype": np_to_triton_dtype(array.dtype),
+                "shape": list(array.shape)}
+      if "shared_memory_region" in parameters:
+        self._region(parameters["shared_memory_region"]).write(
+            array, parameters.get("shared_memory_offset", 0),
+            parameters["shared_memory_byte_size"])
+        tensor["parameters"] = {
+            "shared_memory_region": parameters["shared_memory_region"],
+            "shared_memory_byte_size": array.nbytes,
+        }
+      elif parameters.get("binary_data", binary_default):
+        tensor["parameters"] = {"binary_data_size": array.nbytes}
+        buffers.append(memoryview(array).cast("B"))
+      else:
+        tensor["data"] = array.reshape(-1).tolist()
+      tensors.append(tensor)
+    header = json.dumps({"model_name": MODEL_NAME, "model_version": "1",
+                         "outputs": tensors}).encode()
+    self.send_response(200)
+    if buffers:
+      self.send_header("Content-Type", "application/octet-stream")
+      self.send_header(HEADER_LENGTH, str(len(header)))
+    else:
+      self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length",
+                     str(len(header) + sum(len(b) for b in buffers)))
+    self.end_headers()
+    self.wfile.write(header)
+    for buffer in buffers:
+      self.wfile.write(buffer)
+
+  def _region(self, name):
+    with self.server.regions_lock:
+      region = self.server.regions.get(name)
+    if region is None:
+      raise InferenceError(
+          f"Unable to find system shared memory region: '{name}'")
+    return region
+
+  def _shm_status(self, body, name):
+    del body
+    with self.server.regions_lock:
+      regions = dict(self.server.regions)
+    if name is not None:
+      regions = {name: self._region(name)}
+    self._send_json([
+        {"name": region_name, "key": region.key, "offset": region.offset,
+         "byte_size": region.byte_size}
+        for region_name, region in regions.items()
+    ])
+
+  def _shm_register(self, body, name):
+    request = json.loads(bytes(body))
+    with self.server.regions_lock:
+      if name in self.server.regions:
+        raise InferenceError(
+            f"shared memory region '{name}' already in manager")
+    try:
+      region = _SharedMemoryRegion(request["key"], request.get("offset", 0),
+                                   request["byte_size"])
+    except OSError as e:
+      raise InferenceError(
+          f"Unable to open shared memory region: '{request['key']}': {e}"
+      ) from e
+    with self.server.regions_lock:
+      self.server.regions[name] = region
+    self._send_empty()
+
+  def _shm_unregister(self, body, name):
+    del body
+    with self.server.regions_lock:
+      names = [name] if name is not None else list(self.server.regions)
+      for region_name in names:
+        region = self.server.regions.pop(region_name, None)
+        if region is not None:
+          region.close()
+    self._send_empty()
+
+
+def start(host: str = "localhost", port: int = 8000,
+          model: Optional[FakeModel] = None) -> FakeTritonServer:
+  """Serves `model` from a background thread.
+
+  Returns:
+    The server, stopped by its shutdown() then server_close() methods. Port 0
+    picks a free port, available as server.server_address[1].
+  """
+  fake_server = FakeTritonServer((host, port), model or FakeModel())
+  threading.Thread(target=fake_server.serve_forever, name="fake-triton-http",
+                   daemon=True).start()
+  return fake_server
+
+
+def main(argv):
+  del argv
+  model = FakeModel(
+      latency_ms=FLAGS.latency_ms,
+      per_token_ms=FLAGS.per_token_ms,
+      max_batch_size=FLAGS.max_batch_size,
+      dynamic_batching=FLAGS.dynamic_batching,
+      max_queue_delay_ms=FLAGS.max_queue_delay_ms,
+      instance_count=FLAGS.instance_count)
+  fake_server = FakeTritonServer((FLAGS.host, FLAGS.port), model)
+  logging.info("Fake Triton serving %s on %s:%d", MODEL_NAME, FLAGS.host,
+               fake_server.server_address[1])
+  try:
+    fake_server.serve_forever()
+  finally:
+    fake_server.server_close()
+
+
+if __name__ == "__main__":
+  flags.DEFINE_string("host", "localhost", "Address to serve on.")
+  flags.DEFINE_integer("port", 8000, "HTTP port.")
+  flags.DEFINE_float("latency_ms", 20.0,
+                     "Fixed latency of an execution of the model.")
+  flags.DEFINE_float("per_token_ms", 0.5,
+                     "Latency of an execution per token of max_output_len.")
+  flags.DEFINE_integer("max_batch_size", 1024,
+                       "Maximum rows of a request and of a batch, as in "
+                       "config.pbtxt.")
+  flags.DEFINE_bool("dynamic_batching", False,
+                    "Execute queued requests of equal shapes together.")
+  flags.DEFINE_float("max_queue_delay_ms", 0.0,
+                     "Time a request waits for others to join its batch with "
+                     "--dynamic_batching.")
+  flags.DEFINE_integer("instance_count", 1,
+                       "Number of concurrent executions of the model.")
+  app.run(main)
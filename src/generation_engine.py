@@ -0,0 +1,379 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Iteration-level (continuous) batching for greedy generation.
+
+Iteration-level (continuous) batching for greedy generation.
+"""
+from concurrent.futures import Future
+import inspect
+import threading
+import time
+from typing import List, Optional
+
+from absl import logging
+import torch
+import torch.nn.functional as F
+from transformers import GenerationConfig
+
+import instrumentation
+
+# Budget of `generate` when the generation config sets no length.
+_DEFAULT_MAX_NEW_TOKENS = 20
+
+# Generation config fields that make `generate` differ from plain greedy
+# decoding, with the value that leaves its output unchanged.
+_GREEDY_VALUES = {
+    "do_sample": False,
+    "num_beams": 1,
+    "penalty_alpha": None,
+    "repetition_penalty": 1.0,
+    "encoder_repetition_penalty": 1.0,
+    "no_repeat_ngram_size": 0,
+    "encoder_no_repeat_ngram_size": 0,
+    "min_length": 0,
+    "min_new_tokens": 0,
+    "bad_words_ids": [],
+    "sequence_bias": None,
+    "forced_bos_token_id": None,
+    "forced_eos_token_id": None,
+    "suppress_tokens": [],
+    "begin_suppress_tokens": [],
+    "exponential_decay_length_penalty": None,
+}
+
+
+def unsupported_fields(generation_config) -> List[str]:
+  """Returns the fields of `generation_config` the engine does not apply.
+
+  The engine picks the most likely token at every step, without the logits
+  processors `generate` builds for penalties, minimum lengths or forced and
+  suppressed tokens, so these configs must be served by `generate`.
+  """
+  default = GenerationConfig()
+  unsupported = []
+  for field, greedy_value in _GREEDY_VALUES.items():
+    value = getattr(generation_config, field, None)
+    if value not in (None, greedy_value, getattr(default, field, None)):
+      unsupported.append(field)
+  return unsupported
+
+
+class _Sequence:
+  """State of a single sequence being decoded."""
+
+  def __init__(self, prompt_ids, max_new_tokens):
+    self.prompt_ids = list(prompt_ids)
+    self.max_new_tokens = max_new_tokens
+    self.generated = []
+    self.future = Future()
+    self.enqueue_time = time.perf_counter()
+    self.start_time = None
+    # Per layer tuple of cached tensors with a batch dimension of 1, None
+    # while the sequence is part of the batched cache.
+    self.past = None
+    # Length of the self-attention cache.
+    self.cache_len = 0
+    # Length of the encoder output, seq2seq models only.
+    self.encoder_len = 0
+
+
+class _BatchState:
+  """Batched cache of the sequences decoded in the previous step."""
+
+  def __init__(self, members, past, cache_len, encoder_len):
+    self.members = members
+    self.past = past
+    self.cache_len = cache_len
+    self.encoder_len = encoder_len
+    self.self_mask = None
+    self.encoder_mask = None
+
+
+class GenerationEngine:
+  """Schedules greedy decoding one step at a time across requests.
+
+  Every step runs a single forward pass over all active sequences. Finished
+  sequences leave the batch right away and queued sequences join it between
+  steps, so short generations do not wait behind long ones. The key/value
+  cache of each sequence is kept separately and padded into a batch at every
+  step: self-attention caches are padded on the left and masked, encoder
+  (cross-attention) caches are padded on the right and masked.
+
+  Only greedy decoding without logits processors is supported, see
+  `unsupported_fields`.
+  """
+
+  def __init__(self, model, max_batch_size: int = 16,
+               eos_token_id=None, max_new_tokens: Optional[int] = None):
+    """Creates the engine and starts its decoding thread.
+
+    Args:
+      model: A HF causal LM or seq2seq LM.
+      max_batch_size: Maximum number of sequences decoded together.
+      eos_token_id: Token id or list of token ids ending a sequence. Defaults
+        to the model's generation config.
+      max_new_tokens: Default generation budget of a sequence. Defaults to the
+        model's generation config.
+    """
+    self._model = model
+    self._max_batch_size = max_batch_size
+    self._is_encoder_decoder = model.config.is_encoder_decoder
+    generation_config = model.generation_config
+    if eos_token_id is None:
+      eos_token_id = generation_config.eos_token_id
+    if eos_token_id is None:
+      eos_token_id = []
+    elif isinstance(eos_token_id, int):
+      eos_token_id = [eos_token_id]
+    self._eos_token_ids = set(eos_token_id)
+    self._max_new_tokens = max_new_tokens or generation_config.max_new_tokens
+    self._max_length = generation_config.max_length
+    self._decoder_start_token_id = generation_config.decoder_start_token_id
+    if self._decoder_start_token_id is None:
+      self._decoder_start_token_id = getattr(
+          model.config, "decoder_start_token_id", None)
+    self._accepts_position_ids = (
+        "position_ids" in inspect.signature(model.forward).parameters)
+    self._cache_type = None
+    self._batch: Optional[_BatchState] = None
+
+    self._waiting: List[_Sequence] = []
+    self._active: List[_Sequence] = []
+    self._cond = threading.Condition()
+    self._closed = False
+    self._worker = threading.Thread(
+        target=self._run, name="generation-engine", daemon=True)
+    self._worker.start()
+
+  def submit(self, input_ids: List[int],
+             max_new_tokens: Optional[int] = None) -> Future:
+    """Queues a single tokenized prompt.
+
+    Args:
+      input_ids: Prompt token ids, without padding.
+      max_new_tokens: Optional generation budget for this sequence.
+
+    Returns:
+      A future resolving to the list of generated token ids.
+    """
+    if max_new_tokens is None:
+      max_new_tokens = self._max_new_tokens
+    if max_new_tokens is None and self._max_length is None:
+      # Recent transformers releases leave max_length unset, and `generate`
+      # then produces its default number of new tokens.
+      max_new_tokens = _DEFAULT_MAX_NEW_TOKENS
+    if max_new_tokens is None:
+      # Mirror `generate`: max_length counts the decoder start token for
+      # seq2seq models and the prompt for decoder-only models.
+      used = 1 if self._is_encoder_decoder else len(input_ids)
+      max_new_tokens = max(self._max_length - used, 1)
+    sequence = _Sequence(input_ids, max_new_tokens)
+    with self._cond:
+      if self._closed:
+        raise RuntimeError("GenerationEngine is closed.")
+      self._waiting.append(sequence)
+      self._cond.notify()
+    return sequence.future
+
+  def close(self):
+    """Stops the engine once all queued sequences are finished."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._worker.join()
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._waiting and not self._active:
+          if self._closed:
+            return
+          self._cond.wait()
+        free = self._max_batch_size - len(self._active)
+        joining = self._waiting[:free]
+        del self._waiting[:free]
+
+      try:
+        with torch.no_grad():
+          for sequence in joining:
+            self._prefill(sequence)
+          self._active.extend(joining)
+          self._retire_finished()
+          if self._active:
+            self._step()
+            self._retire_finished()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Generation step failed")
+        for sequence in self._active + joining:
+          if not sequence.future.done():
+            sequence.future.set_exception(e)
+        self._active = []
+        self._batch = None
+
+  def _prefill(self, sequence: _Sequence):
+    """Runs the prompt of a joining sequence and picks its first token."""
+    sequence.start_time = time.perf_counter()
+    instrumentation.observe(
+        "queue_wait", sequence.start_time - sequence.enqueue_time)
+    device = self._model.device
+    input_ids = torch.tensor([sequence.prompt_ids], device=device)
+    if self._is_encoder_decoder:
+      attention_mask = torch.ones_like(input_ids)
+      encoder_outputs = self._model.get_encoder()(
+          input_ids=input_ids, attention_mask=attention_mask)
+      outputs = self._model(
+          encoder_outputs=encoder_outputs,
+          attention_mask=attention_mask,
+          decoder_input_ids=torch.tensor(
+              [[self._decoder_start_token_id]], device=device),
+          use_cache=True)
+      sequence.cache_len = 1
+      sequence.encoder_len = input_ids.shape[1]
+    else:
+      outputs = self._model(input_ids=input_ids, use_cache=True)
+      sequence.cache_len = input_ids.shape[1]
+    sequence.past = self._to_legacy(outputs.past_key_values)
+    sequence.generated.append(int(outputs.logits[0, -1].argmax()))
+
+  def _step(self):
+    """Decodes one token for every active sequence."""
+    device = self._model.device
+    batch = self._active
+    if self._batch is None or self._batch.members != batch:
+      # The batch changed: give every sequence its own cache back and pad
+      # the caches of the new batch together.
+      self._unbatch()
+      self._batch = self._build_batch(batch)
+    state = self._batch
+
+    next_tokens = torch.tensor([[s.generated[-1]] for s in batch],
+                               device=device)
+    state.self_mask = torch.cat(
+        [state.self_mask, state.self_mask.new_ones(len(batch), 1)], dim=1)
+    kwargs = {
+        "past_key_values": self._from_legacy(state.past),
+        "use_cache": True,
+    }
+    if self._is_encoder_decoder:
+      kwargs["decoder_input_ids"] = next_tokens
+      kwargs["decoder_attention_mask"] = state.self_mask
+      kwargs["attention_mask"] = state.encoder_mask
+      # Cross-attention keys and values come from the cache, the decoder only
+      # needs encoder states of the right shape.
+      kwargs["encoder_outputs"] = (torch.zeros(
+          len(batch), state.encoder_len, self._model.config.d_model,
+          device=device),)
+    else:
+      kwargs["input_ids"] = next_tokens
+      kwargs["attention_mask"] = state.self_mask
+      if self._accepts_position_ids:
+        kwargs["position_ids"] = torch.tensor(
+            [[s.cache_len] for s in batch], device=device)
+    outputs = self._model(**kwargs)
+
+    state.past = self._to_legacy(outputs.past_key_values)
+    state.cache_len += 1
+    tokens = outputs.logits[:, -1].argmax(dim=-1).tolist()
+    for sequence, token in zip(batch, tokens):
+      sequence.cache_len += 1
+      sequence.generated.append(token)
+
+  def _build_batch(self, batch: List[_Sequence]) -> "_BatchState":
+    """Pads the caches of `batch` into a single batched cache."""
+    device = self._model.device
+    cache_len = max(s.cache_len for s in batch)
+    encoder_len = max(s.encoder_len for s in batch)
+    past = []
+    for layer in range(len(batch[0].past)):
+      tensors = []
+      for i in range(len(batch[0].past[layer])):
+        # Entries 0 and 1 are self-attention keys and values, entries 2 and
+        # 3 (seq2seq only) are cross-attention keys and values.
+        if i < 2:
+          padded = [
+              F.pad(s.past[layer][i], (0, 0, cache_len - s.cache_len, 0))
+              for s in batch
+          ]
+        else:
+          padded = [
+              F.pad(s.past[layer][i], (0, 0, 0, encoder_len - s.encoder_len))
+              for s in batch
+          ]
+        tensors.append(torch.cat(padded, dim=0))
+      past.append(tuple(tensors))
+    for s in batch:
+      s.past = None
+
+    state = _BatchState(list(batch), tuple(past), cache_len, encoder_len)
+    state.self_mask = torch.tensor(
+        [[0] * (cache_len - s.cache_len) + [1] * s.cache_len for s in batch],
+        device=device)
+    state.encoder_mask = torch.tensor(
+        [[1] * s.encoder_len + [0] * (encoder_len - s.encoder_len)
+         for s in batch], device=device)
+    return state
+
+  def _unbatch(self):
+    """Slices the batched cache back into the unfinished sequences."""
+    state = self._batch
+    self._batch = None
+    if state is None:
+      return
+    for b, sequence in enumerate(state.members):
+      if sequence.future.done():
+        continue
+      start = state.cache_len - sequence.cache_len
+      sequence.past = tuple(
+          tuple(
+              layer[i][b:b + 1, :, start:] if i < 2 else
+              layer[i][b:b + 1, :, :sequence.encoder_len]
+              for i in range(len(layer)))
+          for layer in state.past)
+
+  def _retire_finished(self):
+    still_active = []
+    for sequence in self._active:
+      if (sequence.generated[-1] in self._eos_token_ids or
+          len(sequence.generated) >= sequence.max_new_tokens):
+        sequence.past = None
+        instrumentation.observe(
+            "model", time.perf_counter() - sequence.start_time)
+        sequence.future.set_result(sequence.generated)
+      else:
+        still_active.append(sequence)
+    self._active = still_active
+
+  def _to_legacy(self, past_key_values):
+    """Converts a transformers Cache object into per layer tuples."""
+    if isinstance(past_key_values, (tuple, list)):
+      return tuple(tuple(layer) for layer in past_key_values)
+    self._cache_type = type(past_key_values)
+    if hasattr(past_key_values, "to_legacy_cache"):
+      return tuple(
+          tuple(layer) for layer in past_key_values.to_legacy_cache())
+    if hasattr(past_key_values, "self_attention_cache"):
+      self_cache = past_key_values.self_attention_cache.layers
+      cross_cache = past_key_values.cross_attention_cache.layers
+      return tuple(
+          (s.keys, s.values, c.keys, c.values)
+          for s, c in zip(self_cache, cross_cache))
+    return tuple((l.keys, l.values) for l in past_key_values.layers)
+
+  def _from_legacy(self, past):
+    """Converts per layer tuples back into the model's cache format."""
+    if self._cache_type is None:
+      return tuple(past)
+    if hasattr(self._cache_type, "from_legacy_cache"):
+      return self._cache_type.from_legacy_cache(tuple(past))
+    return self._cache_type(tuple(past))
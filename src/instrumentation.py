@@ -0,0 +1,236 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Prometheus instrumentation shared by the prediction servers.
+
+Set PROMETHEUS_MULTIPROC_DIR to aggregate metrics across gunicorn workers.
+"""
+import contextlib
+import os
+import time
+
+# prometheus_client picks its storage when imported, so the multiprocess
+# directory must exist beforehand.
+_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if _MULTIPROC_DIR:
+  os.makedirs(_MULTIPROC_DIR, exist_ok=True)
+
+# pylint: disable=g-import-not-at-top,wrong-import-position
+from flask import Response
+import prometheus_client
+from prometheus_client import multiprocess
+# pylint: enable=g-import-not-at-top,wrong-import-position
+
+STAGES = ("queue_wait", "tokenize", "model", "decode", "total")
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = prometheus_client.Histogram(
+    "llm_server_stage_seconds",
+    "Latency of a serving stage in seconds.",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS)
+REQUESTS = prometheus_client.Counter(
+    "llm_server_requests_total", "Number of inference requests.")
+INSTANCES = prometheus_client.Counter(
+    "llm_server_instances_total", "Number of instances in inference requests.")
+INPUT_TOKENS = prometheus_client.Counter(
+    "llm_server_input_tokens_total", "Number of input tokens processed.")
+OUTPUT_TOKENS = prometheus_client.Counter(
+    "llm_server_output_tokens_total", "Number of output tokens generated.")
+MODEL_LOAD_SECONDS = prometheus_client.Gauge(
+    "llm_server_model_load_seconds", "Time taken to load the model.",
+    multiprocess_mode="liveall")
+PEAK_RSS_BYTES = prometheus_client.Gauge(
+    "llm_server_model_load_peak_rss_bytes",
+    "Peak resident set size of the process after loading the model.",
+    multiprocess_mode="liveall")
+MODEL_SIZE_BYTES = prometheus_client.Gauge(
+    "llm_server_model_size_bytes",
+    "Size of the model weights, before and after quantization.",
+    ["quantized"],
+    multiprocess_mode="liveall")
+PROBE_LATENCY_SECONDS = prometheus_client.Gauge(
+    "llm_server_model_probe_latency_seconds",
+    "Latency of a probe generation, before and after quantization.",
+    ["quantized"],
+    multiprocess_mode="liveall")
+ADMISSION_QUEUE_DEPTH = prometheus_client.Gauge(
+    "llm_server_admission_queue_depth",
+    "Number of requests waiting for admission.",
+    multiprocess_mode="livesum")
+ADMISSION_QUEUED_TOKENS = prometheus_client.Gauge(
+    "llm_server_admission_queued_tokens",
+    "Estimated tokens of the requests waiting for admission.",
+    multiprocess_mode="livesum")
+ADMISSION_INFLIGHT_TOKENS = prometheus_client.Gauge(
+    "llm_server_admission_inflight_tokens",
+    "Estimated tokens of the admitted requests.",
+    multiprocess_mode="livesum")
+ADMISSION_REJECTIONS = prometheus_client.Counter(
+    "llm_server_admission_rejections_total",
+    "Number of requests rejected by admission control.",
+    ["reason"])
+WARMUP_SECONDS = prometheus_client.Gauge(
+    "llm_server_warmup_seconds",
+    "Time taken to run the warmup batches before serving.",
+    multiprocess_mode="liveall")
+STARTUP_PHASE_SECONDS = prometheus_client.Gauge(
+    "llm_server_startup_phase_seconds",
+    "Duration of each phase of the server startup.", ["phase"],
+    multiprocess_mode="liveall")
+TRITON_ENDPOINT_HEALTHY = prometheus_client.Gauge(
+    "llm_server_triton_endpoint_healthy",
+    "Whether a Triton endpoint receives requests, 1, or is ejected, 0.",
+    ["endpoint"], multiprocess_mode="liveall")
+TRITON_ENDPOINT_EJECTIONS = prometheus_client.Counter(
+    "llm_server_triton_endpoint_ejections_total",
+    "Number of ejections of each Triton endpoint.", ["endpoint"])
+MODEL_LOADS = prometheus_client.Counter(
+    "llm_server_model_loads_total", "Number of loads of each model.",
+    ["model"])
+MODEL_LOAD_SECONDS_TOTAL = prometheus_client.Counter(
+    "llm_server_model_loading_seconds_total",
+    "Time spent loading each model.", ["model"])
+MODEL_HITS = prometheus_client.Counter(
+    "llm_server_model_hits_total",
+    "Number of requests served by an already loaded model.", ["model"])
+MODEL_EVICTIONS = prometheus_client.Counter(
+    "llm_server_model_evictions_total",
+    "Number of evictions of each model.", ["model"])
+LOADED_MODELS = prometheus_client.Gauge(
+    "llm_server_loaded_models", "Number of loaded models.",
+    multiprocess_mode="livesum")
+LOADED_MODEL_BYTES = prometheus_client.Gauge(
+    "llm_server_loaded_model_bytes", "Size of the loaded models.",
+    multiprocess_mode="livesum")
+
+
+def observe(stage: str, seconds: float):
+  """Records the latency of a stage."""
+  STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextlib.contextmanager
+def timer(stage: str):
+  """Records the latency of the enclosed block as `stage`."""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe(stage, time.perf_counter() - start)
+
+
+def count_request(instances: int):
+  """Counts an inference request and its instances."""
+  REQUESTS.inc()
+  INSTANCES.inc(instances)
+
+
+def count_tokens(input_tokens: int = 0, output_tokens: int = 0):
+  """Counts processed input tokens and generated output tokens."""
+  if input_tokens:
+    INPUT_TOKENS.inc(input_tokens)
+  if output_tokens:
+    OUTPUT_TOKENS.inc(output_tokens)
+
+
+def record_quantization(size_before: int, size_after: int,
+                        latency_before: float, latency_after: float):
+  """Records the model size and probe latency around quantization."""
+  MODEL_SIZE_BYTES.labels("false").set(size_before)
+  MODEL_SIZE_BYTES.labels("true").set(size_after)
+  PROBE_LATENCY_SECONDS.labels("false").set(latency_before)
+  PROBE_LATENCY_SECONDS.labels("true").set(latency_after)
+
+
+def set_admission_state(queue_depth: int, queued_tokens: int,
+                        inflight_tokens: int):
+  """Records the state of the admission controller."""
+  ADMISSION_QUEUE_DEPTH.set(queue_depth)
+  ADMISSION_QUEUED_TOKENS.set(queued_tokens)
+  ADMISSION_INFLIGHT_TOKENS.set(inflight_tokens)
+
+
+def count_rejection(reason: str):
+  """Counts a request rejected by admission control."""
+  ADMISSION_REJECTIONS.labels(reason).inc()
+
+
+def record_model_load(seconds: float, peak_rss_bytes: int):
+  """Records the load time and peak memory of the model."""
+  MODEL_LOAD_SECONDS.set(seconds)
+  PEAK_RSS_BYTES.set(peak_rss_bytes)
+
+
+def count_model_load(model: str, seconds: float):
+  """Counts a load of a model and its duration."""
+  MODEL_LOADS.labels(model).inc()
+  MODEL_LOAD_SECONDS_TOTAL.labels(model).inc(seconds)
+
+
+def count_model_hit(model: str):
+  """Counts a request served by an already loaded model."""
+  MODEL_HITS.labels(model).inc()
+
+
+def count_model_eviction(model: str):
+  """Counts an eviction of a model."""
+  MODEL_EVICTIONS.labels(model).inc()
+
+
+def set_loaded_models(count: int, size_bytes: int):
+  """Records the number and size of the loaded models."""
+  LOADED_MODELS.set(count)
+  LOADED_MODEL_BYTES.set(size_bytes)
+
+
+def record_warmup(seconds: float):
+  """Records the duration of the warmup phase."""
+  WARMUP_SECONDS.set(seconds)
+
+
+def record_startup_phase(phase: str, seconds: float):
+  """Records the duration of a startup phase."""
+  STARTUP_PHASE_SECONDS.labels(phase).set(seconds)
+
+
+def set_endpoint_health(endpoint: str, healthy: bool):
+  """Records whether a Triton endpoint receives requests."""
+  TRITON_ENDPOINT_HEALTHY.labels(endpoint).set(int(healthy))
+
+
+def count_endpoint_ejection(endpoint: str):
+  """Counts an ejection of a Triton endpoint."""
+  TRITON_ENDPOINT_EJECTIONS.labels(endpoint).inc()
+
+
+def mark_process_dead(pid: int):
+  """Drops the live gauges of an exited worker process."""
+  if _MULTIPROC_DIR:
+    multiprocess.mark_process_dead(pid)
+
+
+def register(app):
+  """Serves the metrics of `app` at /metrics in Prometheus text format."""
+
+  @app.route("/metrics")
+  def metrics():  # pylint: disable=unused-variable
+    if _MULTIPROC_DIR:
+      registry = prometheus_client.CollectorRegistry()
+      multiprocess.MultiProcessCollector(registry)
+    else:
+      registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry),
+                    mimetype=prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,86 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Length-bucketed batch formation.
+
+Length-bucketed batch formation.
+"""
+from typing import Any, List, Optional, Sequence
+
+
+def plan_buckets(lengths: Sequence[int], overhead_tokens: int = 512,
+                 max_bucket_size: Optional[int] = None) -> List[List[int]]:
+  """Splits instances into buckets of similar length.
+
+  Instances are sorted by length and cut into contiguous buckets, each padded
+  to its own longest instance. The cut points minimize the total number of
+  padded tokens plus `overhead_tokens` per bucket, which stands for the fixed
+  cost of an extra model call.
+
+  Args:
+    lengths: Token length of every instance.
+    overhead_tokens: Cost of an additional bucket, in tokens. Larger values
+      give fewer, more padded buckets.
+    max_bucket_size: Optional maximum number of instances in a bucket.
+
+  Returns:
+    List of buckets, each a list of indices into `lengths`.
+  """
+  order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+  n = len(order)
+  if n == 0:
+    return []
+  max_bucket_size = max_bucket_size or n
+
+  # best[i] is the lowest cost of bucketing the i shortest instances.
+  best = [0] + [float("inf")] * n
+  cut = [0] * (n + 1)
+  for end in range(1, n + 1):
+    width = lengths[order[end - 1]]
+    for start in range(max(end - max_bucket_size, 0), end):
+      cost = best[start] + (end - start) * width + overhead_tokens
+      if cost < best[end]:
+        best[end] = cost
+        cut[end] = start
+
+  buckets = []
+  end = n
+  while end > 0:
+    buckets.append(order[cut[end]:end])
+    end = cut[end]
+  buckets.reverse()
+  return buckets
+
+
+def restore_order(buckets: List[List[int]],
+                  outputs: List[List[Any]]) -> List[Any]:
+  """Merges per bucket outputs back into the original instance order.
+
+  Args:
+    buckets: Buckets returned by `plan_buckets`.
+    outputs: Outputs of every bucket, in the order of the bucket indices.
+
+  Returns:
+    A single list of outputs, in the order of the original instances.
+  """
+  merged = [None] * sum(len(bucket) for bucket in buckets)
+  for bucket, bucket_outputs in zip(buckets, outputs):
+    for index, output in zip(bucket, bucket_outputs):
+      merged[index] = output
+  return merged
+
+
+def padded_tokens(lengths: Sequence[int], buckets: List[List[int]]) -> int:
+  """Returns the number of tokens after padding every bucket."""
+  return sum(
+      len(bucket) * max(lengths[i] for i in bucket) for bucket in buckets)
@@ -0,0 +1,270 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Parallel, cached model downloads for the prediction servers.
+
+Parallel, cached model downloads for the prediction servers.
+"""
+from concurrent import futures
+import contextlib
+import fcntl
+import hashlib
+import os
+import posixpath
+import re
+import shutil
+import time
+from typing import Any, Dict, Optional
+
+from absl import flags
+from absl import logging
+import fsspec
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    "model_cache_dir", "/tmp/model_cache",
+    "Local directory models are downloaded to. Mount a persistent volume "
+    "here to skip the download when a server restarts.")
+flags.DEFINE_integer(
+    "download_workers", 16,
+    "Number of files or byte ranges downloaded concurrently.")
+flags.DEFINE_integer(
+    "model_cache_versions", 2,
+    "Versions of a model kept in --model_cache_dir. Older versions are "
+    "deleted once a new one is fetched.")
+flags.DEFINE_integer(
+    "download_chunk_mb", 64,
+    "Files larger than this many MiB are downloaded in byte ranges of this "
+    "size.")
+
+# Object metadata fields identifying a version of a file, in order of
+# preference. 'generation' and the hashes are set by GCS.
+_VERSION_FIELDS = ("generation", "md5Hash", "crc32c", "etag", "ETag")
+
+
+class ModelFetcher:
+  """Downloads model directories into a local, versioned cache.
+
+  A directory is cached under a name derived from its URL and the version of
+  every file in it: the GCS generation or checksum if the filesystem reports
+  one, its size and modification time otherwise. Fetching a directory whose
+  files did not change returns the cached copy without downloading anything.
+  Only the most recently fetched versions of a URL are kept.
+
+  Files are downloaded concurrently and large files in byte ranges. Downloads
+  go to a temporary directory that is renamed once complete, and concurrent
+  fetches of the same directory from several processes are serialized with a
+  file lock, so a cached directory is always complete.
+  """
+
+  def __init__(self, cache_dir: str, max_workers: int = 16,
+               chunk_size: int = 64 << 20,
+               fs: Optional[fsspec.AbstractFileSystem] = None,
+               keep_versions: int = 2):
+    """Creates the fetcher.
+
+    Args:
+      cache_dir: Local directory of the cache.
+      max_workers: Number of files or byte ranges downloaded concurrently.
+      chunk_size: Size in bytes of the ranges large files are split into.
+      fs: Filesystem to download from. Inferred from each URL by default.
+      keep_versions: Number of versions of a URL kept in the cache, including
+        the fetched one.
+    """
+    self._cache_dir = cache_dir
+    self._max_workers = max_workers
+    self._chunk_size = chunk_size
+    self._fs = fs
+    self._keep_versions = max(keep_versions, 1)
+
+  def fetch(self, url: str, recursive: bool = False) -> str:
+    """Returns a local directory holding the files under `url`.
+
+    Args:
+      url: Remote directory, such as gs://bucket/model.
+      recursive: Whether to include files in subdirectories.
+
+    Returns:
+      Path of the cached directory.
+    """
+    fs, root, files = self._list_url(url, recursive)
+    target = os.path.join(self._cache_dir, _cache_name(url, root, files))
+    if os.path.isdir(target):
+      logging.info("Using cached model %s for %s", target, url)
+      self._prune(target)
+      return target
+
+    os.makedirs(self._cache_dir, exist_ok=True)
+    with _file_lock(target + ".lock"):
+      # Another process may have completed the download while we waited.
+      cached = os.path.isdir(target)
+      if not cached:
+        partial = target + ".partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        start = time.perf_counter()
+        self._download(fs, files, partial)
+        os.rename(partial, target)
+    if cached:
+      logging.info("Using cached model %s for %s", target, url)
+      self._prune(target)
+      return target
+    size = sum(info["size"] for _, info in files.values())
+    elapsed = time.perf_counter() - start
+    logging.info("Downloaded %d files, %.1f MiB from %s in %.1fs (%.1f MiB/s)",
+                 len(files), size / (1 << 20), url, elapsed,
+                 size / (1 << 20) / max(elapsed, 1e-6))
+    self._prune(target)
+    return target
+
+  def version(self, url: str, recursive: bool = False) -> str:
+    """Returns the version of the files under `url` without downloading them.
+
+    The version is the name of the cached directory of `fetch`, which
+    changes whenever a file is added, removed or rewritten.
+    """
+    _, root, files = self._list_url(url, recursive)
+    return _cache_name(url, root, files)
+
+  def _prune(self, target):
+    """Deletes the least recently fetched versions of the URL of `target`."""
+    # Marks the fetched version as the most recently used one.
+    os.utime(target)
+    prefix = os.path.basename(target).rsplit("-", 1)[0] + "-"
+    versions = []
+    for entry in os.scandir(self._cache_dir):
+      if (entry.name.startswith(prefix) and entry.path != target and
+          re.fullmatch(r"[0-9a-f]{16}", entry.name[len(prefix):]) and
+          entry.is_dir()):
+        versions.append((entry.stat().st_mtime, entry.path))
+    versions.sort(reverse=True)
+    for _, path in versions[self._keep_versions - 1:]:
+      logging.info("Deleting old cached model %s", path)
+      # The empty lock file is kept, a process may be waiting on it.
+      with _file_lock(path + ".lock"):
+        shutil.rmtree(path, ignore_errors=True)
+
+  def _list_url(self, url, recursive):
+    fs, root = self._resolve(url)
+    files = self._list(fs, root, recursive)
+    if not files:
+      raise FileNotFoundError(f"No files found under {url}")
+    return fs, root, files
+
+  def _resolve(self, url):
+    if self._fs is None:
+      return fsspec.core.url_to_fs(url)
+    return self._fs, self._fs._strip_protocol(url)  # pylint: disable=protected-access
+
+  def _list(self, fs, root, recursive) -> Dict[str, Any]:
+    """Maps the relative path of every file to its (remote path, info)."""
+    root = root.rstrip("/")
+    if recursive:
+      infos = fs.find(root, detail=True).values()
+    else:
+      infos = fs.ls(root, detail=True)
+    files = {}
+    for info in infos:
+      if info["type"] != "file":
+        continue
+      path = info["name"]
+      files[posixpath.relpath(path, root)] = (path, info)
+    return files
+
+  def _download(self, fs, files, local_dir):
+    """Downloads all files, splitting large ones into byte ranges."""
+    with futures.ThreadPoolExecutor(self._max_workers) as pool:
+      tasks = []
+      for relpath, (path, info) in files.items():
+        local_path = os.path.join(local_dir, *relpath.split("/"))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        size = info["size"]
+        if size <= self._chunk_size:
+          tasks.append(pool.submit(fs.get_file, path, local_path))
+          continue
+        with open(local_path, "wb") as f:
+          f.truncate(size)
+        for start in range(0, size, self._chunk_size):
+          end = min(start + self._chunk_size, size)
+          tasks.append(
+              pool.submit(_download_range, fs, path, local_path, start, end))
+      for task in futures.as_completed(tasks):
+        task.result()
+
+    for relpath, (path, info) in files.items():
+      local_size = os.path.getsize(os.path.join(local_dir, *relpath.split("/")))
+      if local_size != info["size"]:
+        raise IOError(f"Downloaded {local_size} bytes of {path}, expected "
+                      f"{info['size']}")
+
+
+def fetch_model(url: str, recursive: bool = False) -> str:
+  """Fetches `url` into --model_cache_dir and returns the local directory."""
+  fetcher = ModelFetcher(FLAGS.model_cache_dir, FLAGS.download_workers,
+                         FLAGS.download_chunk_mb << 20,
+                         keep_versions=FLAGS.model_cache_versions)
+  return fetcher.fetch(url, recursive)
+
+
+def model_version(path: str, recursive: bool = False) -> str:
+  """Returns a version of the model at `path` that changes with its content.
+
+  Remote URLs and local directories are versioned by the files they hold,
+  like the cached directories of ModelFetcher, so a model republished at the
+  same path gets a new version. Other paths, such as HuggingFace model names,
+  are their own version.
+  """
+  if "://" not in path and not os.path.isdir(path):
+    return path
+  fetcher = ModelFetcher(FLAGS.model_cache_dir)
+  return fetcher.version(path, recursive)
+
+
+def _download_range(fs, path, local_path, start, end):
+  data = fs.cat_file(path, start=start, end=end)
+  if len(data) != end - start:
+    raise IOError(f"Read {len(data)} bytes of {path}[{start}:{end}]")
+  with open(local_path, "r+b") as f:
+    f.seek(start)
+    f.write(data)
+
+
+def _file_version(info: Dict[str, Any]) -> str:
+  for field in _VERSION_FIELDS:
+    if info.get(field):
+      return f"{field}={info[field]},size={info['size']}"
+  return f"size={info['size']},mtime={info.get('mtime')}"
+
+
+def _cache_name(url, root, files) -> str:
+  """Returns <name>-<hash of the URL>-<hash of the file versions>."""
+  url_digest = hashlib.sha256(url.rstrip("/").encode()).hexdigest()[:8]
+  return (f"{posixpath.basename(root.rstrip('/'))}-{url_digest}-"
+          f"{_digest(files)}")
+
+
+def _digest(files) -> str:
+  sha = hashlib.sha256()
+  for relpath in sorted(files):
+    sha.update(f"\0{relpath}\0{_file_version(files[relpath][1])}".encode())
+  return sha.hexdigest()[:16]
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+  with open(path, "w") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,225 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Model class resolution and memory-mapped weight loading.
+
+Model class resolution and memory-mapped weight loading.
+"""
+import json
+import mmap
+import os
+import resource
+import struct
+from typing import Dict
+
+from absl import logging
+import torch
+from transformers import AutoConfig
+from transformers import AutoModelForCausalLM
+from transformers import AutoModelForSeq2SeqLM
+from transformers.models.auto import modeling_auto
+from transformers.pytorch_utils import Conv1D
+
+_SAFETENSORS_DTYPES = {
+    "BOOL": torch.bool,
+    "U8": torch.uint8,
+    "I8": torch.int8,
+    "I16": torch.int16,
+    "I32": torch.int32,
+    "I64": torch.int64,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F32": torch.float32,
+    "F64": torch.float64,
+}
+
+
+def resolve_autoclass(model_path: str):
+  """Picks the autoclass of a model from its config.json.
+
+  Encoder-decoder models load as AutoModelForSeq2SeqLM, others as
+  AutoModelForCausalLM.
+
+  Args:
+    model_path: Local directory of the model.
+
+  Returns:
+    The autoclass, or None if the model type supports neither.
+  """
+  config = AutoConfig.from_pretrained(model_path)
+  model_type = config.model_type
+  seq2seq = modeling_auto.MODEL_FOR_SEQ_TO_SEQ_CAUSAL_LM_MAPPING_NAMES
+  causal = modeling_auto.MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
+  if config.is_encoder_decoder and model_type in seq2seq:
+    return AutoModelForSeq2SeqLM
+  if model_type in causal:
+    return AutoModelForCausalLM
+  if model_type in seq2seq:
+    return AutoModelForSeq2SeqLM
+  return None
+
+
+def load_mmap(model_class, model_path: str):
+  """Loads a model on CPU with weights memory-mapped from safetensors files.
+
+  The model is built on the meta device and its parameters are assigned
+  tensors backed by private mappings of the checkpoint files. Pages are read
+  lazily and shared through the page cache by all processes mapping the same
+  files, until a process writes to them.
+
+  Args:
+    model_class: Autoclass to build the model with.
+    model_path: Local directory of the model.
+
+  Returns:
+    The model in eval mode, or None if GPUs are available, if the checkpoint
+    is not in safetensors format or if the model has tensors that are not in
+    the checkpoint.
+  """
+  if torch.cuda.is_available():
+    logging.warning("Memory-mapped weights are only supported on CPU.")
+    return None
+  files = _safetensors_files(model_path)
+  if not files:
+    logging.warning("No safetensors weights in %s, unable to mmap.", model_path)
+    return None
+
+  config = AutoConfig.from_pretrained(model_path)
+  with torch.device("meta"):
+    model = model_class.from_config(config)
+  state_dict = {}
+  for path in files:
+    state_dict.update(_mmap_safetensors(path))
+  model.load_state_dict(state_dict, strict=False, assign=True)
+  model.tie_weights()
+
+  missing = [
+      name for name, tensor in
+      list(model.named_parameters()) + list(model.named_buffers())
+      if tensor.is_meta
+  ]
+  if missing:
+    logging.warning("Tensors missing from the checkpoint, unable to mmap: %s",
+                    ", ".join(missing[:10]))
+    return None
+  return model.eval()
+
+
+def quantize_dynamic_int8(model):
+  """Quantizes the linear layers of a CPU model to int8.
+
+  Weights are stored as int8 and activations are quantized on the fly, so
+  no calibration data is needed. The Conv1D projections of GPT-2 style
+  models are converted to torch.nn.Linear first. Output projections tied to
+  the input embeddings stay in floating point, since a quantized copy would
+  be stored next to the shared weight instead of replacing it.
+
+  Args:
+    model: Model on CPU.
+
+  Returns:
+    The quantized model, or `model` unchanged if it has no layer to quantize.
+  """
+  _convert_conv1d(model)
+  embeddings = model.get_input_embeddings()
+  tied = {embeddings.weight.data_ptr()} if embeddings is not None else set()
+  layers = {
+      name for name, module in model.named_modules()
+      if isinstance(module, torch.nn.Linear) and
+      module.weight.data_ptr() not in tied
+  }
+  if not layers:
+    logging.warning("No linear layers to quantize besides the tied output "
+                    "embeddings. Serving the model unquantized.")
+    return model
+  logging.info("Quantizing %d linear layers to int8", len(layers))
+  return torch.ao.quantization.quantize_dynamic(
+      model, layers, dtype=torch.qint8)
+
+
+def _convert_conv1d(model):
+  """Replaces the Conv1D layers of `model` by equivalent torch.nn.Linear."""
+  for parent in list(model.modules()):
+    for name, child in list(parent.named_children()):
+      if not isinstance(child, Conv1D):
+        continue
+      linear = torch.nn.Linear(child.nx, child.nf)
+      with torch.no_grad():
+        # Conv1D computes x @ weight, its weight is transposed.
+        linear.weight.copy_(child.weight.t())
+        linear.bias.copy_(child.bias)
+      setattr(parent, name, linear)
+
+
+def model_size_bytes(model) -> int:
+  """Returns the size of the state of a model, including packed weights.
+
+  Tied weights are counted once.
+  """
+  seen = set()
+  return sum(_nbytes(value, seen) for value in model.state_dict().values())
+
+
+def peak_rss_bytes() -> int:
+  """Returns the peak resident set size of this process."""
+  # ru_maxrss is in KiB on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _nbytes(value, seen) -> int:
+  if isinstance(value, torch.Tensor):
+    if value.data_ptr() in seen:
+      return 0
+    seen.add(value.data_ptr())
+    return value.numel() * value.element_size()
+  if isinstance(value, (tuple, list)):
+    return sum(_nbytes(v, seen) for v in value)
+  return 0
+
+
+def _safetensors_files(model_path):
+  index_path = os.path.join(model_path, "model.safetensors.index.json")
+  if os.path.exists(index_path):
+    with open(index_path) as f:
+      shards = sorted(set(json.load(f)["weight_map"].values()))
+    return [os.path.join(model_path, shard) for shard in shards]
+  path = os.path.join(model_path, "model.safetensors")
+  return [path] if os.path.exists(path) else []
+
+
+def _mmap_safetensors(path) -> Dict[str, torch.Tensor]:
+  """Returns the tensors of a safetensors file without reading them."""
+  with open(path, "rb") as f:
+    # A private mapping shares clean pages and copies pages on write.
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+  header_size = struct.unpack("<Q", buffer[:8])[0]
+  header = json.loads(buffer[8:8 + header_size])
+  data_start = 8 + header_size
+
+  tensors = {}
+  for name, info in header.items():
+    if name == "__metadata__":
+      continue
+    dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+    start, end = info["data_offsets"]
+    tensors[name] = _from_buffer(buffer, dtype, data_start + start,
+                                 end - start).reshape(info["shape"])
+  return tensors
+
+
+def _from_buffer(buffer, dtype, offset, size) -> torch.Tensor:
+  if size == 0:
+    return torch.empty(0, dtype=dtype)
+  itemsize = torch.empty(0, dtype=dtype).element_size()
+  return torch.frombuffer(buffer, dtype=dtype, count=size // itemsize,
+                          offset=offset)
@@ -0,0 +1,243 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Registry of the models served by one prediction server.
+
+Models are loaded on demand into a memory budget and the least recently used
+ones are evicted to make room for others.
+"""
+import collections
+import contextlib
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from absl import flags
+from absl import logging
+
+import instrumentation
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+    "models", [],
+    "Additional models served next to --model_path, as name=path pairs. "
+    "Requests select one with their 'model' field and are served by "
+    "--model_path without it. Models are loaded on their first request.")
+flags.DEFINE_float(
+    "model_memory_budget_gb", 0,
+    "Memory budget in GB of the model weights loaded by a worker. The least "
+    "recently used models are evicted to stay within it, except the model of "
+    "--model_path. 0 keeps all loaded models.")
+
+
+class UnknownModel(KeyError):
+  """Raised for a model name that is not registered."""
+
+  def __str__(self):
+    return f"Unknown model {self.args[0]!r}."
+
+
+class _Entry:
+
+  def __init__(self, model, size_bytes):
+    self.model = model
+    self.size_bytes = size_bytes
+    self.in_use = 0
+
+
+class ModelRegistry:
+  """Loads named models on demand and evicts the least recently used ones.
+
+  Loaded models must have a close() method, which is called after eviction.
+  Models in use by a request and pinned models are never evicted, so the
+  budget is exceeded while they do not fit it.
+  """
+
+  def __init__(self, paths: Dict[str, str],
+               load_fn: Callable[[str, str], Any],
+               size_fn: Callable[[Any], int],
+               memory_budget_bytes: int = 0):
+    """Creates the registry.
+
+    Args:
+      paths: Path of each model by name.
+      load_fn: Called with a name and path to load a model.
+      size_fn: Returns the size in bytes of a loaded model.
+      memory_budget_bytes: Budget of the loaded models. 0 disables eviction.
+    """
+    self._paths = dict(paths)
+    self._load_fn = load_fn
+    self._size_fn = size_fn
+    self._budget = memory_budget_bytes
+    self._lock = threading.Lock()
+    # Loads are serialized, so concurrent loads do not overshoot the budget.
+    self._load_lock = threading.Lock()
+    self._loaded = collections.OrderedDict()
+    self._pinned = set()
+    self._stats = {name: collections.Counter() for name in self._paths}
+    self._sizes = {}
+    self._load_seconds = {}
+
+  def pin(self, name: str):
+    """Loads a model and excludes it from eviction."""
+    with self.use(name):
+      with self._lock:
+        self._pinned.add(name)
+
+  @contextlib.contextmanager
+  def use(self, name: str):
+    """Yields the model `name`, loading it if needed.
+
+    The model is not evicted while the block runs.
+
+    Raises:
+      UnknownModel: If `name` is not registered.
+    """
+    model = self.acquire(name)
+    try:
+      yield model
+    finally:
+      self.release(name)
+
+  def acquire(self, name: str):
+    """Returns the model `name`, loading it if needed.
+
+    The model is not evicted until a matching call to release().
+
+    Raises:
+      UnknownModel: If `name` is not registered.
+    """
+    return self._acquire(name).model
+
+  def release(self, name: str):
+    """Allows eviction of a model returned by acquire()."""
+    with self._lock:
+      self._loaded[name].in_use -= 1
+
+  def stats(self) -> Dict[str, Dict[str, Any]]:
+    """Returns the load and hit statistics of every model."""
+    with self._lock:
+      return {
+          name: {
+              "loaded": name in self._loaded,
+              "pinned": name in self._pinned,
+              "size_bytes": self._sizes.get(name),
+              "load_seconds": self._load_seconds.get(name),
+              "loads": self._stats[name]["loads"],
+              "hits": self._stats[name]["hits"],
+              "evictions": self._stats[name]["evictions"],
+          } for name in sorted(self._paths)
+      }
+
+  def _acquire(self, name) -> _Entry:
+    if name not in self._paths:
+      raise UnknownModel(name)
+    entry = self._lookup(name)
+    if entry is not None:
+      return entry
+    with self._load_lock:
+      # Another request may have loaded the model in the meantime.
+      entry = self._lookup(name)
+      if entry is not None:
+        return entry
+      # Make room for the size of a previous load, if any, before loading.
+      self._close(self._evict(self._sizes.get(name, 0)))
+      logging.info("Loading model %s from %s", name, self._paths[name])
+      start = time.perf_counter()
+      model = self._load_fn(name, self._paths[name])
+      load_seconds = time.perf_counter() - start
+      size = self._size_fn(model)
+      entry = _Entry(model, size)
+      entry.in_use = 1
+      with self._lock:
+        self._sizes[name] = size
+        self._load_seconds[name] = load_seconds
+        self._stats[name]["loads"] += 1
+      victims = self._evict(size)
+      with self._lock:
+        self._loaded[name] = entry
+        self._update_gauges()
+      self._close(victims)
+    logging.info("Loaded model %s in %.2fs, %.1f MiB", name, load_seconds,
+                 size / (1 << 20))
+    instrumentation.count_model_load(name, load_seconds)
+    return entry
+
+  def _lookup(self, name) -> Optional[_Entry]:
+    with self._lock:
+      entry = self._loaded.get(name)
+      if entry is None:
+        return None
+      self._loaded.move_to_end(name)
+      entry.in_use += 1
+      self._stats[name]["hits"] += 1
+    instrumentation.count_model_hit(name)
+    return entry
+
+  def _evict(self, size) -> List[Any]:
+    """Unregisters least recently used models until `size` bytes fit."""
+    if not self._budget:
+      return []
+    victims = []
+    with self._lock:
+      used = sum(entry.size_bytes for entry in self._loaded.values())
+      for name, entry in list(self._loaded.items()):
+        if used + size <= self._budget:
+          break
+        if entry.in_use or name in self._pinned:
+          continue
+        del self._loaded[name]
+        used -= entry.size_bytes
+        self._stats[name]["evictions"] += 1
+        victims.append((name, entry.model))
+      if used + size > self._budget:
+        logging.warning(
+            "Loaded models need %.1f MiB, over the budget of %.1f MiB.",
+            (used + size) / (1 << 20), self._budget / (1 << 20))
+      self._update_gauges()
+    return victims
+
+  def _close(self, victims):
+    for name, model in victims:
+      logging.info("Evicting model %s", name)
+      instrumentation.count_model_eviction(name)
+      model.close()
+
+  def _update_gauges(self):
+    instrumentation.set_loaded_models(
+        len(self._loaded),
+        sum(entry.size_bytes for entry in self._loaded.values()))
+
+
+def parse_models(values: List[str]) -> Dict[str, str]:
+  """Parses name=path pairs of --models."""
+  paths = {}
+  for value in values:
+    name, sep, path = value.partition("=")
+    if not sep or not name or not path:
+      raise ValueError(f"Expected name=path in --models, got {value!r}.")
+    paths[name] = path
+  return paths
+
+
+def from_flags(default_name: str, default_path: str,
+               load_fn: Callable[[str, str], Any],
+               size_fn: Callable[[Any], int]) -> ModelRegistry:
+  """Creates a ModelRegistry of --models and a default model."""
+  paths = parse_models(FLAGS.models)
+  if default_name in paths:
+    raise ValueError(f"--models can not redefine the model {default_name!r}.")
+  paths[default_name] = default_path
+  return ModelRegistry(paths, load_fn, size_fn,
+                       int(FLAGS.model_memory_budget_gb * (1 << 30)))
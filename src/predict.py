@@ -16,103 +16,560 @@
 Simple Flask prediction for a model.
 """
 import argparse
+import functools
+import gc
 import os
 import importlib
+import json
+import threading
+import time
 from typing import List, Tuple
 
 from absl import app as absl_app
 from absl import flags
 from absl import logging
 from absl.flags import argparse_flags
-from flask import Flask, send_from_directory
+from flask import Flask, Response, send_from_directory
 from flask import request
-import gcsfs
+import torch
 from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM
 from transformers import AutoTokenizer
 from transformers import GenerationConfig
+from transformers import TextIteratorStreamer
+
+import admission
+from admission import AdmissionRejected
+from admission import rejection_response
+from batch_scheduler import BatchScheduler
+from generation_engine import GenerationEngine
+from generation_engine import unsupported_fields
+import instrumentation
+from length_buckets import plan_buckets
+from length_buckets import restore_order
+from model_fetcher import fetch_model
+from model_fetcher import model_version
+from model_loading import load_mmap
+from model_loading import model_size_bytes
+from model_loading import peak_rss_bytes
+from model_loading import quantize_dynamic_int8
+from model_loading import resolve_autoclass
+import model_registry
+from model_registry import UnknownModel
+from response_cache import ResponseCache
+import serving
+import warmup
 
 app = Flask(__name__, root_path=os.path.join(os.getcwd(), "app/"))
+instrumentation.register(app)
+warmup.register(app)
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string("model_path", None, "Path of HF model to load.")
 flags.DEFINE_string("hf_autoclass", None, "Optional. Name of the Transformers autoclass to instantiate the model with. Defaults to known supported classes: [ AutoModelForCausalLM, AutoModelForSeq2SeqLM ]")
+flags.DEFINE_bool("mmap_weights", False, "Memory-map safetensors weights on CPU instead of reading them into memory, so processes on one host share their pages. Falls back to a regular load on GPU hosts or for other checkpoints.")
 flags.DEFINE_integer("port", 5000, "server port.")
+flags.DEFINE_integer("max_batch_size", 8, "Maximum number of instances from concurrent requests merged into one generate call. 1 disables batching across requests.")
+flags.DEFINE_float("max_batch_wait_ms", 5.0, "Maximum time in milliseconds a request waits for other requests to join its batch.")
+flags.DEFINE_bool("length_buckets", True, "Split a batch into buckets of similar token length, each padded separately.")
+flags.DEFINE_integer("bucket_overhead_tokens", 512, "Estimated cost in tokens of an extra generate call. Higher values form fewer, more padded buckets.")
+flags.DEFINE_integer("response_cache_size", 1024, "Number of predictions kept in the in-process response cache. 0 disables it.")
+flags.DEFINE_float("response_cache_ttl", 3600, "Time in seconds after which cached predictions expire.")
+flags.DEFINE_string("response_cache_dir", None, "Optional directory of a disk response cache shared by workers on the same host.")
+flags.DEFINE_float("response_cache_disk_max_mb", 1024, "Size in MiB above which the oldest entries of the disk response cache are removed. 0 does not limit it.")
+flags.DEFINE_bool("continuous_batching", False, "Schedule greedy generation one decoding step at a time, so sequences join and leave the batch between steps. Requests overriding anything but max_new_tokens, and models whose generation config samples, searches beams or applies logits processors, use the batched generate path.")
+flags.DEFINE_integer("max_active_sequences", 16, "Maximum number of sequences decoded together with --continuous_batching.")
+flags.DEFINE_bool("quantize", False, "Quantize the linear layers of the model to int8 after loading, for serving on CPU. Logs the model size and the latency of a probe generation before and after quantization.")
+flags.DEFINE_string("draft_model_path", None, "Optional path of a small draft model sharing the tokenizer of the model, such as t5-small for a flan-t5 model. Enables assisted generation (speculative decoding) for requests without beam search, which decodes one instance at a time. Only used for the model of --model_path.")
+
+
+DEFAULT_MODEL = "default"
+
+
+class ServedModel:
+  """A loaded model with its tokenizer, config and schedulers."""
+
+  def __init__(self, name, version, model, tokenizer, generation_config,
+               draft_model=None):
+    self.name = name
+    self.version = version
+    self.model = model
+    self.tokenizer = tokenizer
+    self.generation_config = generation_config
+    self.draft_model = draft_model
+    self.scheduler = BatchScheduler(
+        functools.partial(generate, self), FLAGS.max_batch_size,
+        FLAGS.max_batch_wait_ms)
+    self.engine = None
+    if FLAGS.continuous_batching:
+      unsupported = unsupported_fields(generation_config)
+      if draft_model is not None:
+        logging.warning("Continuous batching does not support a draft model. "
+                        "Falling back to batched generate.")
+      elif unsupported:
+        logging.warning("Continuous batching only supports plain greedy "
+                        "decoding, the generation config sets %s. Falling "
+                        "back to batched generate.",
+                        ", ".join(unsupported))
+      else:
+        self.engine = GenerationEngine(model, FLAGS.max_active_sequences)
+
+  def size_bytes(self):
+    size = model_size_bytes(self.model)
+    if self.draft_model is not None:
+      size += model_size_bytes(self.draft_model)
+    return size
+
+  def close(self):
+    """Stops the schedulers and frees the memory of the model."""
+    self.scheduler.close()
+    if self.engine is not None:
+      self.engine.close()
+    self.model = self.draft_model = self.engine = None
+    gc.collect()
+    if torch.cuda.is_available():
+      torch.cuda.empty_cache()
 
 
 def init_model():
   model_path = os.environ.get("AIP_STORAGE_URI", FLAGS.model_path)
   logging.info("Model path: %s", model_path)
+  app.registry = model_registry.from_flags(
+      DEFAULT_MODEL, model_path, load_served_model, ServedModel.size_bytes)
+  app.registry.pin(DEFAULT_MODEL)
+  app.cache = ResponseCache(
+      FLAGS.response_cache_size, FLAGS.response_cache_ttl,
+      FLAGS.response_cache_dir,
+      int(FLAGS.response_cache_disk_max_mb * (1 << 20)))
+  app.admission = admission.from_flags()
+  logging.info("Model ready to serve")
+
+
+def load_served_model(name, model_path):
+  """Loads a model of the registry with its tokenizer and config."""
+  # Cached predictions are keyed by the content of the model, not its path.
+  version = model_version(model_path)
   if model_path.startswith("gs://"):
-    src = model_path.replace("gs://", "")
-    dst = src.split("/")[-1] + "/"
-    gcs = gcsfs.GCSFileSystem()
     logging.info("Downloading model from %s", model_path)
-    for f in gcs.ls(src):
-      if gcs.isfile(f):
-        logging.info("Downloading %s", f)
-        gcs.get(f, dst)
-    model_path = dst
-  
+    model_path = fetch_model(model_path)
+
   # now a model can be loaded.
   logging.info("Loading local model from %s", model_path)
-  load_model(model_path, FLAGS.hf_autoclass)
+  model = load_model(model_path, FLAGS.hf_autoclass)
   tokenizer = AutoTokenizer.from_pretrained(model_path)
-  app.generation_config = GenerationConfig.from_pretrained(model_path)
-  logging.info("Model ready to serve")
-  app.tokenizer = tokenizer
+  generation_config = GenerationConfig.from_pretrained(model_path)
+  if not model.config.is_encoder_decoder:
+    # Decoder-only models continue generating from the end of the prompt, so
+    # prompts in a merged batch must be padded on the left.
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+      tokenizer.pad_token = tokenizer.eos_token
+  if FLAGS.quantize:
+    model = quantize_model(model, tokenizer)
+  draft_model = None
+  if FLAGS.draft_model_path and name == DEFAULT_MODEL:
+    draft_model = load_draft_model(FLAGS.draft_model_path, model)
+  return ServedModel(name, version, model, tokenizer, generation_config,
+                     draft_model)
+
+
+def quantize_model(model, tokenizer):
+  """Quantizes a model to int8 and reports its size and latency."""
+  if model.device.type != "cpu":
+    logging.warning("Int8 quantization is only supported on CPU. Serving the "
+                    "model unquantized.")
+    return model
+  size_before = model_size_bytes(model)
+  latency_before = _probe_latency(model, tokenizer)
+  model = quantize_dynamic_int8(model)
+  size_after = model_size_bytes(model)
+  latency_after = _probe_latency(model, tokenizer)
+  logging.info("Quantized model to int8: size %.1f -> %.1f MiB, probe latency "
+               "%.1f -> %.1f ms", size_before / (1 << 20),
+               size_after / (1 << 20), 1000 * latency_before,
+               1000 * latency_after)
+  if size_after >= size_before:
+    logging.warning("Int8 quantization did not shrink the model.")
+  instrumentation.record_quantization(size_before, size_after, latency_before,
+                                      latency_after)
+  return model
+
+
+def _probe_latency(model, tokenizer, num_runs=3):
+  """Returns the best latency of a short generation on a synthetic input."""
+  inputs = tokenizer([warmup.synthetic_text(64)], return_tensors="pt")
+  latencies = []
+  for _ in range(num_runs):
+    start = time.perf_counter()
+    with torch.no_grad():
+      model.generate(**inputs, max_new_tokens=16, min_new_tokens=16)
+    latencies.append(time.perf_counter() - start)
+  return min(latencies)
+
+
+def load_draft_model(draft_model_path, model):
+  """Loads the draft model of assisted generation next to `model`."""
+  if draft_model_path.startswith("gs://"):
+    logging.info("Downloading draft model from %s", draft_model_path)
+    draft_model_path = fetch_model(draft_model_path)
+  if model.config.is_encoder_decoder:
+    model_class = AutoModelForSeq2SeqLM
+  else:
+    model_class = AutoModelForCausalLM
+  logging.info("Loading draft model from %s", draft_model_path)
+  draft_model = model_class.from_pretrained(draft_model_path)
+  return draft_model.to(model.device).eval()
+
 
 def load_model(model_path, hf_autoclass):
+  start = time.perf_counter()
   if hf_autoclass:
     model_class = getattr(importlib.import_module("transformers"), hf_autoclass)
-    app.model = model_class.from_pretrained(model_path, device_map="auto")
   else:
+    model_class = resolve_autoclass(model_path)
+  model = None
+  if FLAGS.mmap_weights and model_class is not None:
+    model = load_mmap(model_class, model_path)
+  if model is None and model_class is not None:
+    logging.info("Instantiating %s as %s.", model_path, model_class.__name__)
+    model = model_class.from_pretrained(model_path, device_map="auto")
+  elif model is None:
     try:
       print(f"Instantiating {model_path} as AutoModelForCausalLM.")
-      app.model = AutoModelForCausalLM.from_pretrained(model_path, device_map="auto")
+      model = AutoModelForCausalLM.from_pretrained(model_path, device_map="auto")
     except ValueError:
       print(f"Unable to instantiate {model_path} as AutoModelForCausalLM. Trying with AutoModelForSeq2Seq.")
       try:
-        app.model = AutoModelForSeq2SeqLM.from_pretrained(model_path, device_map="auto")
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_path, device_map="auto")
       except ValueError as ve:
         print(f"Unable to instantiate {model_path} as AutoModelForSeq2SeqLM. Exiting.")
         raise ve
-
-@app.route("/health")
-def health():
-  return {"health": "ok"}
-
+  load_seconds = time.perf_counter() - start
+  rss = peak_rss_bytes()
+  logging.info("Loaded model in %.2fs, peak RSS %.1f MiB", load_seconds,
+               rss / (1 << 20))
+  instrumentation.record_model_load(load_seconds, rss)
+  return model
 
 @app.route("/ui", methods=["GET"])
 def ui():
   return send_from_directory("templates", "ui.html")
 
 
+@app.route("/models", methods=["GET"])
+def models():
+  """Returns the load and hit statistics of the served models."""
+  return {"models": app.registry.stats()}
+
+
 @app.route("/infer", methods=["POST"])
 def infer():
   """Process an inferencing request."""
   logging.info("Received request")
-  inputs = app.tokenizer(
-      request.json["instances"],
-      return_tensors="pt",
-      padding=True,
-      truncation=True).to(app.model.device)
-  logging.info("Encoded")
+  start_time = time.perf_counter()
+  instances = request.json["instances"]
+  instrumentation.count_request(len(instances))
   config_overrides = {}
   try:
     config_overrides = request.json["config"]
   except KeyError:
     pass
+  send_metrics = request.args.get("metrics", False, bool)
+  try:
+    with app.registry.use(request.json.get("model", DEFAULT_MODEL)) as served:
+      outputs, missing = _infer(served, instances, config_overrides)
+  except UnknownModel as e:
+    return {"error": str(e)}, 404
+  except AdmissionRejected as e:
+    return rejection_response(e)
+
+  return_payload = {
+      "predictions": [text for texts in outputs for text in texts]
+  }
+  if send_metrics:
+    missing = set(missing)
+    return_payload["metrics"] = [
+        {"cache": "miss" if i in missing else "hit"}
+        for i in range(len(instances))
+    ]
+    return_payload["cache"] = app.cache.stats()
+  instrumentation.observe("total", time.perf_counter() - start_time)
+  return return_payload
+
+
+def _infer(served, instances, config_overrides):
+  """Returns the cached or generated predictions and the indices generated."""
+  keys = [None] * len(instances)
+  outputs = [None] * len(instances)
+  if app.cache.enabled and not _is_sampling(served, config_overrides):
+    keys = [app.cache.key(x, served.version, config_overrides)
+            for x in instances]
+    outputs = [app.cache.get(key) for key in keys]
+  missing = [i for i, out in enumerate(outputs) if out is None]
+  if missing:
+    texts = [instances[i] for i in missing]
+    with app.admission.admit(_estimate_cost(served, texts, config_overrides)):
+      computed = predict(served, texts, config_overrides)
+    for i, out in zip(missing, computed):
+      outputs[i] = out
+      if keys[i] is not None:
+        app.cache.put(keys[i], out)
+  return outputs, missing
+
+
+def predict(served, instances, config_overrides):
+  """Generates predictions through the engine or the batch scheduler.
+
+  Args:
+    served: The ServedModel generating the predictions.
+    instances: List of input texts.
+    config_overrides: Generation config overrides of the request.
+
+  Returns:
+    List with the predictions of every instance.
+  """
+  if served.engine is not None and set(config_overrides) <= {"max_new_tokens"}:
+    predictions = generate_continuous(
+        served, instances, config_overrides.get("max_new_tokens"))
+    return [[text] for text in predictions]
+  return served.scheduler.submit(instances, config_overrides).result()
+
+
+def _estimate_cost(served, instances, config_overrides):
+  """Estimates the tokens of a request: its input plus its output budget."""
+  if not app.admission.enabled:
+    return 0
+  input_tokens = sum(
+      len(ids) for ids in served.tokenizer(instances, truncation=True)["input_ids"])
+  config = served.generation_config
+  max_new_tokens = config_overrides.get("max_new_tokens",
+                                        config.max_new_tokens)
+  if max_new_tokens is None:
+    max_new_tokens = config_overrides.get("max_length", config.max_length) or 20
+  sequences = config_overrides.get("num_return_sequences",
+                                   config.num_return_sequences) or 1
+  return input_tokens + len(instances) * max_new_tokens * sequences
+
+
+def warmup_model(instances):
+  """Runs a warmup batch through the same path as /infer."""
+  with app.registry.use(DEFAULT_MODEL) as served:
+    predict(served, instances, {})
+
+
+def _is_sampling(served, config_overrides):
+  return config_overrides.get("do_sample",
+                              served.generation_config.do_sample)
+
+
+@app.route("/infer_stream", methods=["POST"])
+def infer_stream():
+  """Streams the prediction of a single instance as it is generated.
+
+  Returns:
+    A newline delimited JSON stream of {'token': ..} objects with the
+    generated text, followed by a final {'predictions': [..]} object equal
+    to the predictions of /infer.
+  """
+  logging.info("Received streaming request")
+  start_time = time.perf_counter()
+  instances = request.json["instances"]
+  if len(instances) != 1:
+    return {"error": "Streaming supports exactly one instance."}, 400
+  config_overrides = request.json.get("config", {})
+  instrumentation.count_request(len(instances))
+
+  name = request.json.get("model", DEFAULT_MODEL)
+  try:
+    served = app.registry.acquire(name)
+  except UnknownModel as e:
+    return {"error": str(e)}, 404
+  # The model stays loaded until the generation thread is done with it.
+  started = False
+  try:
+    with instrumentation.timer("tokenize"):
+      inputs = served.tokenizer(
+          instances, return_tensors="pt",
+          truncation=True).to(served.model.device)
+    instrumentation.count_tokens(input_tokens=inputs["input_ids"].numel())
+    cost = app.admission.acquire(
+        _estimate_cost(served, instances, config_overrides))
+    started = True
+  except AdmissionRejected as e:
+    return rejection_response(e)
+  finally:
+    if not started:
+      app.registry.release(name)
+
+  streamer = TextIteratorStreamer(
+      served.tokenizer, skip_prompt=True, skip_special_tokens=True)
+  errors = []
+  predictions = []
+
+  def run_generate():
+    try:
+      outputs = served.model.generate(
+          inputs["input_ids"],
+          attention_mask=inputs["attention_mask"],
+          streamer=streamer,
+          **config_overrides)
+      _count_output_tokens(served, inputs, outputs)
+      # Decoded like /infer, so decoder-only predictions include the prompt
+      # the streamed tokens skip.
+      with instrumentation.timer("decode"):
+        predictions.extend(
+            served.tokenizer.decode(x, skip_special_tokens=True)
+            for x in outputs)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Streaming generation failed")
+      errors.append(str(e))
+      streamer.end()
+    finally:
+      app.admission.release(cost)
+      app.registry.release(name)
+
+  thread = threading.Thread(target=run_generate, daemon=True)
+  thread.start()
+
+  def stream():
+    for token in streamer:
+      if token:
+        yield json.dumps({"token": token}) + "\n"
+    thread.join()
+    if errors:
+      yield json.dumps({"error": errors[0]}) + "\n"
+      return
+    logging.info("Streamed.")
+    instrumentation.observe("total", time.perf_counter() - start_time)
+    yield json.dumps({"predictions": predictions}) + "\n"
+
+  return Response(stream(), mimetype="application/x-ndjson")
+
+
+def generate(served, instances, config_overrides):
+  """Generates predictions for a batch of instances.
+
+  Instances are split into length buckets, each generated as its own padded
+  batch, so short prompts are not padded to the longest one.
+
+  Args:
+    served: The ServedModel generating the predictions.
+    instances: List of input texts.
+    config_overrides: Generation config overrides applied to the whole batch.
+
+  Returns:
+    List with the decoded predictions of every instance. Each entry holds
+    one prediction per returned sequence.
+  """
+  tokenizer = served.tokenizer
+  with instrumentation.timer("tokenize"):
+    encoded = tokenizer(instances, truncation=True)
+  logging.info("Encoded")
+  lengths = [len(ids) for ids in encoded["input_ids"]]
+  instrumentation.count_tokens(input_tokens=sum(lengths))
+  if FLAGS.length_buckets:
+    buckets = plan_buckets(lengths, FLAGS.bucket_overhead_tokens)
+  else:
+    buckets = [list(range(len(instances)))]
   logging.debug("Passing inferencing configuration: %s", config_overrides)
-  outputs = app.model.generate(
-    inputs["input_ids"],
-    **config_overrides
-  )
 
+  bucket_outputs = []
+  for bucket in buckets:
+    inputs = tokenizer.pad(
+        {key: [encoded[key][i] for i in bucket]
+         for key in ("input_ids", "attention_mask")},
+        return_tensors="pt").to(served.model.device)
+    with instrumentation.timer("model"):
+      if _use_draft_model(served, config_overrides):
+        outputs = generate_assisted(served, inputs, config_overrides)
+      else:
+        outputs = served.model.generate(
+          inputs["input_ids"],
+          attention_mask=inputs["attention_mask"],
+          **config_overrides
+        )
+    _count_output_tokens(served, inputs, outputs)
+    with instrumentation.timer("decode"):
+      text_out = [tokenizer.decode(x, skip_special_tokens=True)
+                  for x in outputs]
+    # generate returns num_return_sequences rows per instance.
+    per_instance = len(text_out) // len(bucket)
+    bucket_outputs.append([
+        text_out[i * per_instance:(i + 1) * per_instance]
+        for i in range(len(bucket))
+    ])
+  logging.info("Generated %d buckets.", len(buckets))
+  return restore_order(buckets, bucket_outputs)
+
+
+def generate_assisted(served, inputs, config_overrides):
+  """Generates a padded batch with the draft model, one row at a time.
+
+  Assisted generation only supports batches of one instance.
+
+  Args:
+    served: The ServedModel generating the predictions.
+    inputs: Padded input_ids and attention_mask of the batch.
+    config_overrides: Generation config overrides applied to every row.
+
+  Returns:
+    The generated sequences of all rows, right padded to the same length.
+  """
+  rows = []
+  for i in range(inputs["input_ids"].shape[0]):
+    rows.append(served.model.generate(
+        inputs["input_ids"][i:i + 1],
+        attention_mask=inputs["attention_mask"][i:i + 1],
+        assistant_model=served.draft_model,
+        **config_overrides)[0])
+  return torch.nn.utils.rnn.pad_sequence(
+      rows, batch_first=True, padding_value=served.tokenizer.pad_token_id)
+
+
+def _use_draft_model(served, config_overrides):
+  if served.draft_model is None:
+    return False
+  config = served.generation_config
+  num_beams = config_overrides.get("num_beams", config.num_beams)
+  num_return_sequences = config_overrides.get(
+      "num_return_sequences", config.num_return_sequences)
+  return (num_beams or 1) == 1 and (num_return_sequences or 1) == 1
+
+
+def _count_output_tokens(served, inputs, outputs):
+  """Counts the tokens `generate` produced for `inputs`, without padding."""
+  if not served.model.config.is_encoder_decoder:
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+  else:
+    new_tokens = outputs[:, 1:]
+  instrumentation.count_tokens(output_tokens=int(
+      (new_tokens != served.tokenizer.pad_token_id).sum()))
+
+
+def generate_continuous(served, instances, max_new_tokens=None):
+  """Generates predictions through the continuous batching engine.
+
+  Args:
+    served: The ServedModel generating the predictions.
+    instances: List of input texts.
+    max_new_tokens: Optional generation budget for every instance.
+
+  Returns:
+    List of decoded predictions, one per instance.
+  """
+  with instrumentation.timer("tokenize"):
+    prompts = served.tokenizer(instances, truncation=True)["input_ids"]
+  futures = [served.engine.submit(ids, max_new_tokens) for ids in prompts]
+  outputs = [future.result() for future in futures]
   logging.info("Generated.")
-  text_out = map(lambda x: app.tokenizer.decode(x, skip_special_tokens=True),
-                 outputs)
-  logging.info("Decoded")
-  return {"predictions": list(text_out)}
+  instrumentation.count_tokens(
+      input_tokens=sum(len(ids) for ids in prompts),
+      output_tokens=sum(len(out) for out in outputs))
+  if not served.model.config.is_encoder_decoder:
+    # Match `generate`, which returns the prompt followed by the new tokens.
+    outputs = [ids + out for ids, out in zip(prompts, outputs)]
+  with instrumentation.timer("decode"):
+    return [served.tokenizer.decode(x, skip_special_tokens=True)
+            for x in outputs]
 
 
 def parse_flags(argv: List[str]) -> Tuple[argparse.Namespace, List[str]]:
@@ -138,8 +595,7 @@ def main(argv):
   app.host = os.environ.get("SERVER_HOST", "localhost")
   app.port = int(os.environ.get("AIP_HTTP_PORT", str(FLAGS.port)))
 
-  init_model()
-  app.run(app.host, app.port, debug=False)
+  serving.serve(app, init_model, warmup_fn=warmup_model)
 
 
 if __name__ == "__main__":
@@ -16,56 +16,71 @@
 Simple Flask prediction for a model.
 """
 import argparse
+import atexit
 import os
+import time
 from typing import List, Tuple
 
 from absl import app as absl_app
 from absl import flags
 from absl import logging
 from absl.flags import argparse_flags
-import deepspeed
 from flask import Flask, send_from_directory
 from flask import request
-import gcsfs
 import torch
 from transformers import AutoConfig
 from transformers import AutoModelForSeq2SeqLM
 from transformers import AutoTokenizer
-from transformers.deepspeed import HfDeepSpeedConfig
+
+import instrumentation
+from length_buckets import plan_buckets
+from length_buckets import restore_order
+from model_fetcher import fetch_model
+from rank_broadcast import RankBroadcaster
+import serving
+import warmup
 
 app = Flask(__name__, root_path=os.path.join(os.getcwd(), "app/"))
+instrumentation.register(app)
+warmup.register(app)
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string("model_path", None, "Path of HF model to load.")
 flags.DEFINE_integer("port", 5000, "server port.")
+flags.DEFINE_bool("length_buckets", True, "Split a request into buckets of similar token length, each padded separately.")
+flags.DEFINE_integer("bucket_overhead_tokens", 512, "Estimated cost in tokens of an extra generate call. Higher values form fewer, more padded buckets.")
+flags.DEFINE_float("rank_heartbeat_interval", 60, "Seconds without requests after which rank 0 signals the other ranks, which wait for its batches.")
 
 
 def init_model():
   """Initializes the model using deep speed."""
+  # Imported here so the serving path can be tested without deepspeed.
+  import deepspeed  # pylint: disable=g-import-not-at-top
+  from transformers.deepspeed import HfDeepSpeedConfig  # pylint: disable=g-import-not-at-top
+
   os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
   # distributed setup
   local_rank = int(os.getenv("LOCAL_RANK", "0"))
   world_size = int(os.getenv("WORLD_SIZE", "1"))
-  torch.cuda.set_device(local_rank)
+  if torch.cuda.is_available():
+    torch.cuda.set_device(local_rank)
+    app.device = torch.device("cuda", local_rank)
+  else:
+    app.device = torch.device("cpu")
   app.local_rank = local_rank
   app.world_size = world_size
 
   model_path = os.environ.get("AIP_STORAGE_URI", FLAGS.model_path)
   logging.info("Model path: %s", model_path)
   if model_path.startswith("gs://"):
-    src = model_path.replace("gs://", "")
-    dst = src.split("/")[-1] + "/"
-    if local_rank == 0:
-      gcs = gcsfs.GCSFileSystem()
-      logging.info("Downloading model from %s", model_path)
-      for f in gcs.ls(src):
-        if gcs.isfile(f):
-          logging.info("Downloading %s", f)
-          gcs.get(f, dst)
-    model_path = dst
-
-  deepspeed.init_distributed()
+    # Every local rank fetches the model. The first one downloads it while
+    # the others wait for it and then use the cached copy.
+    logging.info("Downloading model from %s", model_path)
+    model_path = fetch_model(model_path)
+
+  deepspeed.init_distributed(
+      dist_backend="nccl" if torch.cuda.is_available() else "gloo")
   config = AutoConfig.from_pretrained(model_path)
   model_hidden_size = config.d_model
 
@@ -115,11 +130,9 @@ def init_model():
   app.ds_engine = ds_engine
   app.tokenizer = tokenizer
   app.dschf = dschf
-
-
-@app.route("/health")
-def health():
-  return {"health": "ok"}
+  # Rank 0 sends the batches of its requests to the other ranks.
+  app.broadcaster = RankBroadcaster(
+      _generate_batch, heartbeat_interval=FLAGS.rank_heartbeat_interval)
 
 
 @app.route("/ui", methods=["GET"])
@@ -129,22 +142,73 @@ def ui():
 
 @app.route("/infer", methods=["POST"])
 def infer():
-  """Process an inferencing request."""
+  """Process an inferencing request.
+
+  The optional 'config' object of the payload overrides the generation
+  config of the model, such as {"max_new_tokens": 64}.
+  """
   logging.info("Received request")
-  inputs = app.tokenizer(
-      request.json["instances"],
-      return_tensors="pt",
-      padding=True,
-      truncation=True).to(device=app.local_rank)
+  start_time = time.perf_counter()
+  instances = request.json["instances"]
+  config = request.json.get("config", {})
+  if not isinstance(config, dict):
+    return {"error": "config must be an object."}, 400
+  instrumentation.count_request(len(instances))
+  predictions = generate(instances, config)
+  instrumentation.observe("total", time.perf_counter() - start_time)
+  return {"predictions": predictions}
+
+
+def generate(instances, config=None):
+  """Generates the predictions of a list of input texts on all ranks.
+
+  Args:
+    instances: List of input texts.
+    config: Optional generation config overrides.
+
+  Returns:
+    List with the prediction of every instance.
+  """
+  config = config or {}
+  with instrumentation.timer("tokenize"):
+    encoded = app.tokenizer(instances, truncation=True)
   logging.info("Encoded")
+  lengths = [len(ids) for ids in encoded["input_ids"]]
+  instrumentation.count_tokens(input_tokens=sum(lengths))
+  if FLAGS.length_buckets:
+    buckets = plan_buckets(lengths, FLAGS.bucket_overhead_tokens)
+  else:
+    buckets = [list(range(len(instances)))]
+
+  bucket_outputs = []
+  for bucket in buckets:
+    inputs = app.tokenizer.pad(
+        {key: [encoded[key][i] for i in bucket]
+         for key in ("input_ids", "attention_mask")},
+        return_tensors="pt")
+    with instrumentation.timer("model"):
+      outputs = app.broadcaster.generate(inputs, config)
+    instrumentation.count_tokens(output_tokens=int(
+        (outputs[:, 1:] != app.tokenizer.pad_token_id).sum()))
+    with instrumentation.timer("decode"):
+      bucket_outputs.append(
+          [app.tokenizer.decode(x, skip_special_tokens=True) for x in outputs])
+  logging.info("Generated %d buckets.", len(buckets))
+  return restore_order(buckets, bucket_outputs)
+
+
+def _generate_batch(inputs, config):
+  """Runs a batch broadcast by rank 0 on the shard of the model of this rank.
+
+  Every rank runs the same batch, which ZeRO-3 needs to gather the
+  parameters of each layer.
+  """
   with torch.no_grad():
-    outputs = app.ds_engine.module.generate(
-        inputs["input_ids"], synced_gpus=True)
-    logging.info("Generated.")
-  text_out = map(lambda x: app.tokenizer.decode(x, skip_special_tokens=True),
-                 outputs)
-  logging.info("Decoded")
-  return {"predictions": list(text_out)}
+    return app.ds_engine.module.generate(
+        inputs["input_ids"].to(app.device),
+        attention_mask=inputs["attention_mask"].to(app.device),
+        synced_gpus=True,
+        **config)
 
 
 def parse_flags(argv: List[str]) -> Tuple[argparse.Namespace, List[str]]:
@@ -172,12 +236,13 @@ def main(argv):
 
   init_model()
   if app.local_rank == 0:
-    app.run(app.host, app.port, debug=False)
+    # Forked workers would not inherit the distributed process group.
+    # The model is loaded on all ranks beforehand, only warmup runs in the
+    # background.
+    atexit.register(app.broadcaster.stop)
+    serving.serve(app, allow_fork=False, warmup_fn=generate)
   else:
-    t = app.tokenizer.encode("", return_tensors="pt").to(device=app.local_rank)
-    while True:
-      with torch.no_grad():
-        app.ds_engine.module.generate(t, synced_gpus=True)
+    app.broadcaster.serve()
 
 
 if __name__ == "__main__":
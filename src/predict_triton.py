@@ -17,8 +17,12 @@ Simple Flask prediction for a model.
 """
 
 import argparse
+import atexit
 import os
+import signal
 import subprocess
+import threading
+import time
 from typing import List, Tuple
 
 from absl import app as absl_app
@@ -27,11 +31,35 @@ from absl import logging
 from absl.flags import argparse_flags
 from flask import Flask, send_from_directory
 from flask import request
-import gcsfs
-from triton_processor import T5TritonProcessor
+import tritonclient.grpc as grpcclient
+import tritonclient.http as httpclient
+from transformers import AutoTokenizer
+from tritonclient.utils import InferenceServerException
+import admission
+from admission import AdmissionRejected
+from admission import rejection_response
+import instrumentation
+from model_fetcher import fetch_model
+from model_fetcher import model_version
+from response_cache import ResponseCache
+import serving
+import startup
+import triton_balancer
+from triton_balancer import BalancedProcessorPool
+from triton_balancer import NoHealthyEndpoint
+from triton_processor import AsyncProcessorRunner
+from triton_processor import batch_key
+from triton_processor import is_sampling
+from triton_processor import output_tokens
+from triton_processor import parse_parameters
+from triton_processor import ProcessorPool
+import warmup
 import json
 
 app = Flask(__name__, root_path=os.path.join(os.getcwd(), "app/"))
+instrumentation.register(app)
+warmup.register(app)
+startup.register(app)
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string(
@@ -58,6 +86,40 @@ flags.DEFINE_string(
         " 'localhost'."
     ),
 )
+flags.DEFINE_enum(
+    "triton_transport",
+    "http",
+    ["http", "grpc", "shm", "binary"],
+    (
+        "How tensors are exchanged with Triton: 'http' sends them in the"
+        " request body, 'grpc' uses the gRPC endpoint, 'shm' sends HTTP"
+        " requests with tensors in system shared memory, which requires"
+        " Triton to run on the same host, and 'binary' sends and receives"
+        " HTTP bodies of binary tensors without copying them."
+    ),
+)
+flags.DEFINE_bool(
+    "triton_async",
+    False,
+    (
+        "Send requests with the asyncio Triton client from an event loop"
+        " shared by the requests of a worker, overlapping their tokenization"
+        " and decoding with Triton calls in flight. The --triton_batch_size"
+        " batches of a request are sent concurrently. Only supported with"
+        " --triton_transport=http or grpc."
+    ),
+)
+flags.register_multi_flags_validator(
+    ["triton_async", "triton_transport"],
+    lambda values: (not values["triton_async"] or
+                    values["triton_transport"] in ("http", "grpc")),
+    message="--triton_async only supports --triton_transport=http or grpc.",
+)
+flags.DEFINE_integer(
+    "triton_grpc_port",
+    8001,
+    "Triton gRPC port, used with --triton_transport=grpc.",
+)
 flags.DEFINE_string(
     "hf_model_path",
     "t5-base",
@@ -66,30 +128,77 @@ flags.DEFINE_string(
         " 'google/t5-v1_1-base'."
     ),
 )
+flags.DEFINE_bool(
+    "stub_backend",
+    False,
+    (
+        "Answer requests with a stub instead of Triton, to benchmark and test"
+        " the server offline. --hf_model_path must point to a local tokenizer."
+    ),
+)
+flags.DEFINE_bool(
+    "launch_triton",
+    True,
+    (
+        "Download the model and start tritonserver on it. Disable to send"
+        " requests to a Triton server started separately at --triton_host,"
+        " such as fake_triton.py, with the tokenizer of --hf_model_path."
+    ),
+)
+flags.DEFINE_integer(
+    "triton_startup_timeout",
+    600,
+    "Seconds to wait for Triton to load the model before failing.",
+)
+flags.DEFINE_integer(
+    "triton_batch_size",
+    32,
+    (
+        "Maximum number of instances of a request sent to Triton together."
+        " Larger requests are split into several Triton requests, sent"
+        " concurrently with --triton_async."
+    ),
+)
+flags.DEFINE_integer(
+    "response_cache_size",
+    1024,
+    "Number of predictions kept in the in-process response cache. 0"
+    " disables it.",
+)
+flags.DEFINE_float(
+    "response_cache_ttl",
+    3600,
+    "Time in seconds after which cached predictions expire.",
+)
+flags.DEFINE_string(
+    "response_cache_dir",
+    None,
+    (
+        "Optional directory of a disk response cache shared by workers on the"
+        " same host."
+    ),
+)
+flags.DEFINE_float(
+    "response_cache_disk_max_mb",
+    1024,
+    (
+        "Size in MiB above which the oldest entries of the disk response cache"
+        " are removed. 0 does not limit it."
+    ),
+)
 
 
 def download_model(model_path):
   """Downloads the model to the expected Triton directory."""
-  os.environ["TOKENIZERS_PARALLELISM"] = "false"
-
   logging.info("Model path: %s", model_path)
   if model_path.startswith("gs://"):
-    src = model_path.replace("gs://", "")
-    dst = "/workspace/all_models/"
-    gcs = gcsfs.GCSFileSystem()
     logging.info("Downloading model FROM %s", model_path)
-    logging.info("Downloading model TO %s", dst)
-    gcs.get(src, dst, recursive=True)
-    model_path = dst + src.split("/")[-1] + "/"
+    model_path = fetch_model(model_path, recursive=True)
+    logging.info("Downloaded model TO %s", model_path)
 
   return model_path
 
 
-@app.route("/health")
-def health():
-  return {"health": "ok"}
-
-
 @app.route("/ui", methods=["GET"])
 def ui():
   return send_from_directory("templates", "ui.html")
@@ -99,35 +208,127 @@ def ui():
 def infer():
   """Process a generic inference request.
 
-  The task should be provided as the first chunk of text.
+  The task should be provided as the first chunk of text. An instance is
+  either a text or an object {'text': .., 'config': {..}} whose generation
+  parameters override the 'config' of the request, see
+  triton_processor.GENERATION_PARAMETERS.
 
   Returns:
     Inferencing result object {'predictions': [..]}
   """
   logging.info("Request received.")
+  start_time = time.perf_counter()
+  instrumentation.count_request(len(request.json["instances"]))
   logging.info("Passing %s to Triton", request.json["instances"])
 
   metrics_key = "metrics"
   predictions_key = "predictions"
   send_metrics = request.args.get('metrics', False, bool)
-  return_payload = {predictions_key: [], metrics_key: []}
-  client = _get_triton_client()
-
-  for req in request.json["instances"]:
-    text_out, req_metrics = client.infer(text=req)
-    return_payload[predictions_key].append(text_out)
-
-    logging.info(json.dumps(req_metrics))
-    if send_metrics:
-      return_payload[metrics_key].append(req_metrics)
-
-  client.client.close()
-  
+  try:
+    texts, parameters = _parse_instances(request.json)
+  except ValueError as e:
+    return {"error": str(e)}, 400
+  predictions = [None] * len(texts)
+  metrics = [{"cache": "hit"} for _ in texts]
+  keys = [None] * len(texts)
+
+  if app.cache.enabled:
+    keys = [
+        None if is_sampling(config) else
+        app.cache.key(text, app.model_version, config)
+        for text, config in zip(texts, parameters)
+    ]
+    predictions = [None if key is None else app.cache.get(key) for key in keys]
+  missing = [i for i, text_out in enumerate(predictions) if text_out is None]
+
+  if missing:
+    try:
+      with app.admission.admit(_estimate_cost(
+          [texts[i] for i in missing], [parameters[i] for i in missing])):
+        batches = _group_batches(missing, parameters)
+        results = _infer_batches(
+            [[texts[i] for i in batch] for batch in batches],
+            [[parameters[i] for i in batch] for batch in batches])
+        for batch, (texts_out, batch_metrics) in zip(batches, results):
+          logging.info(json.dumps(batch_metrics))
+          for i, text_out in zip(batch, texts_out):
+            predictions[i] = text_out
+            if keys[i] is not None:
+              app.cache.put(keys[i], text_out)
+            metrics[i] = dict(batch_metrics, cache="miss")
+    except AdmissionRejected as e:
+      return rejection_response(e)
+    except NoHealthyEndpoint as e:
+      return {"error": str(e)}, 503
+
+  return_payload = {predictions_key: predictions, metrics_key: metrics}
   if not send_metrics:
     return_payload.pop(metrics_key)
+  else:
+    return_payload["cache"] = app.cache.stats()
 
+  instrumentation.observe("total", time.perf_counter() - start_time)
   return return_payload
 
+
+def _parse_instances(payload):
+  """Returns the texts of a payload and the generation parameters of each.
+
+  Raises:
+    ValueError: If an instance or its parameters are malformed.
+  """
+  defaults = payload.get("config", {})
+  if not isinstance(defaults, dict):
+    raise ValueError("config must be an object.")
+  texts = []
+  parameters = []
+  for instance in payload["instances"]:
+    config = defaults
+    if isinstance(instance, dict):
+      if not isinstance(instance.get("text"), str):
+        raise ValueError("An instance object needs a 'text' string.")
+      overrides = instance.get("config", {})
+      if not isinstance(overrides, dict):
+        raise ValueError("The config of an instance must be an object.")
+      config = {**defaults, **overrides}
+      instance = instance["text"]
+    texts.append(instance)
+    parameters.append(parse_parameters(config))
+  return texts, parameters
+
+
+def _group_batches(indices, parameters):
+  """Splits `indices` into Triton batches of compatible parameters.
+
+  Instances whose parameters have equal batch_key share batches of up to
+  --triton_batch_size instances, in the order of the request.
+  """
+  groups = {}
+  for i in indices:
+    groups.setdefault(batch_key(parameters[i]), []).append(i)
+  return [group[start:start + FLAGS.triton_batch_size]
+          for group in groups.values()
+          for start in range(0, len(group), FLAGS.triton_batch_size)]
+
+
+def _infer_batches(batches, parameters=None):
+  """Sends lists of texts to Triton, concurrently with --triton_async.
+
+  Args:
+    batches: Lists of texts.
+    parameters: Optional generation parameters of the texts of every batch.
+
+  Returns:
+    List with the predictions and metrics of every batch.
+  """
+  if parameters is None:
+    parameters = [None] * len(batches)
+  if FLAGS.triton_async:
+    return app.async_runner.infer_batches(batches, parameters)
+  with app.processors.processor() as client:
+    return [client.infer_batch(texts, parameters=batch_parameters)
+            for texts, batch_parameters in zip(batches, parameters)]
+
 def parse_flags(argv: List[str]) -> Tuple[argparse.Namespace, List[str]]:
   """Parses command line arguments entry_point.
 
@@ -152,35 +353,205 @@ def main(argv):
   app.port = int(os.environ.get("AIP_HTTP_PORT", str(FLAGS.port)))
 
   model_path = os.environ.get("AIP_STORAGE_URI", FLAGS.model_path).rstrip("/")
-  model_dir = download_model(model_path)
+  app.cache = ResponseCache(
+      FLAGS.response_cache_size,
+      FLAGS.response_cache_ttl,
+      FLAGS.response_cache_dir,
+      int(FLAGS.response_cache_disk_max_mb * (1 << 20)),
+  )
+  app.tokenizer = start_backend(model_path)
+  # Cached predictions are keyed by the content of the model, not its path.
+  app.model_version = model_version(model_path, recursive=True)
+
+  serving.serve(app, init_backend, warmup_fn=warmup_model)
+
 
-  subprocess.Popen(
-      ["/opt/tritonserver/bin/tritonserver", f"--model-repository={model_dir}", "--allow-vertex-ai=false", "--allow-http=true", "--http-port=8000"]
+def start_backend(model_path):
+  """Prepares Triton and the tokenizer shared by the workers.
+
+  Downloads the model, then loads the tokenizer while Triton starts on the
+  model, and waits until Triton serves it. See /startup for the duration of
+  every phase.
+
+  Returns:
+    The tokenizer.
+
+  Raises:
+    startup.StartupError: If a phase failed, such as Triton exiting or not
+      being ready after --triton_startup_timeout.
+  """
+  # The tokenizer is loaded before forking the workers.
+  os.environ["TOKENIZERS_PARALLELISM"] = "false"
+  pipeline = startup.StartupPipeline()
+  if FLAGS.stub_backend or not FLAGS.launch_triton:
+    pipeline.add("tokenizer", lambda: load_tokenizer(FLAGS.hf_model_path))
+    if not FLAGS.stub_backend:
+      pipeline.add("triton_ready", wait_for_triton)
+    return pipeline.run()["tokenizer"]
+
+  pipeline.add("download", lambda: download_model(model_path))
+  pipeline.add("tokenizer",
+               lambda model_dir: load_tokenizer(find_tokenizer(model_dir)),
+               after=["download"])
+  pipeline.add("triton_launch", launch_triton, after=["download"])
+  pipeline.add("triton_ready", wait_for_triton, after=["triton_launch"])
+  try:
+    results = pipeline.run()
+  except startup.StartupError:
+    process = getattr(app, "triton_process", None)
+    if process is not None:
+      process.terminate()
+    raise
+  threading.Thread(target=_watch_triton, args=(app.triton_process,),
+                   name="triton-watcher", daemon=True).start()
+  return results["tokenizer"]
+
+
+def launch_triton(model_dir):
+  """Starts Triton on the downloaded model and returns its process."""
+  app.triton_process = subprocess.Popen(
+      ["/opt/tritonserver/bin/tritonserver", f"--model-repository={model_dir}", "--allow-vertex-ai=false", "--allow-http=true", "--http-port=8000", "--allow-grpc=true", f"--grpc-port={FLAGS.triton_grpc_port}"]
   )
+  return app.triton_process
 
-  # Check inside converted model for a config.json for tokenizer dictionary. If not found, use the passed flag.
-  nested_model_dir = model_dir
-  for _ in range(3):
-    filepaths = os.listdir(nested_model_dir)
-    
-    try:
-      filepaths.remove("config.pbtxt")
-    except ValueError:
-      pass
-    
-    nested_model_dir = os.path.join(nested_model_dir, filepaths[0])
-
-  if os.path.exists(os.path.join(nested_model_dir, "config.json")):
-    app.tokenizer_model_path = nested_model_dir
+
+def find_tokenizer(model_dir):
+  """Returns the path of the tokenizer to use with a converted model.
+
+  Converted models may hold the config.json of their HuggingFace model up
+  to three levels below the model repository. Otherwise --hf_model_path is
+  used.
+  """
+  for root, dirs, files in os.walk(model_dir):
+    depth = 0
+    if root != model_dir:
+      depth = os.path.relpath(root, model_dir).count(os.sep) + 1
+      if "config.json" in files:
+        return root
+    # Walks in a stable order, and not below the third level.
+    dirs[:] = sorted(dirs) if depth < 3 else []
+  return FLAGS.hf_model_path
+
+
+def load_tokenizer(path):
+  logging.info("Loading tokenizer from %s", path)
+  return AutoTokenizer.from_pretrained(path)
+
+
+def _watch_triton(process):
+  """Stops the server when Triton exits, so the container is restarted."""
+  code = process.wait()
+  logging.error("Triton exited with code %s, stopping the server.", code)
+  os.kill(os.getpid(), signal.SIGTERM)
+
+
+def init_backend():
+  """Creates the Triton clients of a worker."""
+  if FLAGS.triton_transport == "grpc":
+    port = FLAGS.triton_grpc_port
+  else:
+    port = FLAGS.triton_port
+  client_factory = async_client_factory = None
+  if FLAGS.stub_backend:
+    # Imported here, the serving image does not ship the offline stubs.
+    from stub_backend import AsyncStubTritonClient  # pylint: disable=g-import-not-at-top
+    from stub_backend import StubTritonClient  # pylint: disable=g-import-not-at-top
+    client_factory = StubTritonClient
+    async_client_factory = AsyncStubTritonClient
+  app.balancer = None
+  if FLAGS.triton_endpoints:
+    app.balancer = triton_balancer.from_flags(
+        (lambda address: True) if FLAGS.stub_backend else _endpoint_ready)
+    app.balancer.start()
+
+  def create_pool(host, port):
+    return ProcessorPool(
+        FLAGS.hf_model_path, host, port,
+        size=FLAGS.max_concurrency,
+        client_factory=client_factory,
+        transport=FLAGS.triton_transport,
+        tokenizer=app.tokenizer)
+
+  if FLAGS.triton_async:
+    app.async_runner = AsyncProcessorRunner(
+        FLAGS.hf_model_path, FLAGS.triton_host, port,
+        tokenizer=app.tokenizer,
+        transport=FLAGS.triton_transport,
+        client_factory=async_client_factory,
+        max_workers=FLAGS.max_concurrency,
+        balancer=app.balancer)
   else:
-    app.tokenizer_model_path = FLAGS.hf_model_path
+    if app.balancer is not None:
+      app.processors = BalancedProcessorPool(app.balancer, create_pool)
+    else:
+      app.processors = create_pool(FLAGS.triton_host, port)
+    # Unregisters the shared memory regions from Triton.
+    atexit.register(app.processors.close)
+  app.admission = admission.from_flags()
 
-  app.run(app.host, app.port, debug=False)
 
-def _get_triton_client():
-  return T5TritonProcessor(
-      app.tokenizer_model_path, FLAGS.triton_host, FLAGS.triton_port
-  )
+def _estimate_cost(instances, parameters):
+  """Estimates the tokens of instances: their input plus output budget."""
+  if not app.admission.enabled:
+    return 0
+  encoded = app.tokenizer(instances, truncation=True)
+  return (sum(len(ids) for ids in encoded["input_ids"]) +
+          sum(output_tokens(config) for config in parameters))
+
+
+def wait_for_triton(process=None):
+  """Blocks until a Triton endpoint serves the fastertransformer model.
+
+  Args:
+    process: Optional process of Triton, which must not exit meanwhile.
+
+  Raises:
+    RuntimeError: If `process` exited.
+    TimeoutError: If no endpoint is ready after --triton_startup_timeout.
+  """
+  deadline = time.monotonic() + FLAGS.triton_startup_timeout
+  while True:
+    ready = [address for address in _triton_addresses()
+             if _endpoint_ready(address)]
+    if ready:
+      logging.info("Triton is ready at %s", ", ".join(ready))
+      return
+    if process is not None and process.poll() is not None:
+      raise RuntimeError(
+          f"Triton exited with code {process.returncode} before serving "
+          "the model.")
+    if time.monotonic() > deadline:
+      raise TimeoutError(
+          f"Triton not ready after {FLAGS.triton_startup_timeout}s")
+    time.sleep(1)
+
+
+def _triton_addresses():
+  """Returns the host:port of every Triton endpoint to send requests to."""
+  if FLAGS.triton_endpoints:
+    return FLAGS.triton_endpoints
+  if FLAGS.triton_transport == "grpc":
+    return [f"{FLAGS.triton_host}:{FLAGS.triton_grpc_port}"]
+  return [f"{FLAGS.triton_host}:{FLAGS.triton_port}"]
+
+
+def _endpoint_ready(address):
+  """Returns whether the Triton endpoint at `address` serves the model."""
+  if FLAGS.triton_transport == "grpc":
+    client = grpcclient.InferenceServerClient(address)
+  else:
+    client = httpclient.InferenceServerClient(address)
+  try:
+    return client.is_model_ready("fastertransformer")
+  except (OSError, InferenceServerException):
+    return False
+  finally:
+    client.close()
+
+
+def warmup_model(instances):
+  """Runs warmup instances through Triton in one batch like /infer."""
+  _infer_batches([instances])
 
 if __name__ == "__main__":
   absl_app.run(main, flags_parser=parse_flags)
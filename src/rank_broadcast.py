@@ -0,0 +1,133 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs the batches of rank 0 on every rank of a distributed model.
+
+Rank 0 serves requests and broadcasts each tokenized batch with its
+generation config to the other ranks over a gloo process group, so that all
+ranks run the same generate call. The other ranks block on the next
+broadcast while there is no traffic instead of generating dummy inputs.
+"""
+import datetime
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from absl import logging
+import torch
+from torch import distributed as dist
+
+_GENERATE = "generate"
+_HEARTBEAT = "heartbeat"
+_STOP = "stop"
+
+
+class RankBroadcaster:
+  """Sends batches from rank 0 to the other ranks and runs them everywhere.
+
+  Rank 0 calls generate from any thread, which runs one batch at a time
+  across all ranks. The other ranks call serve, which returns once rank 0
+  calls stop.
+  """
+
+  def __init__(self,
+               generate_fn: Callable[[Dict[str, torch.Tensor], Dict[str, Any]],
+                                     Any],
+               group: Optional[dist.ProcessGroup] = None,
+               heartbeat_interval: float = 60.0):
+    """Creates the broadcaster. Must be called by all ranks.
+
+    Args:
+      generate_fn: Runs a batch on this rank, called with the input_ids and
+        attention_mask CPU tensors and the generation config.
+      group: Optional gloo group of all ranks. By default a new one is
+        created, so batches are sent from CPU memory whatever the backend of
+        the model.
+      heartbeat_interval: Seconds without batches after which rank 0 sends a
+        heartbeat, so the waiting ranks do not hit the timeout of the group.
+    """
+    self._generate_fn = generate_fn
+    self._group = group if group is not None else dist.new_group(
+        backend="gloo",
+        timeout=datetime.timedelta(seconds=max(600, 10 * heartbeat_interval)))
+    self._rank = dist.get_rank()
+    self._lock = threading.Lock()
+    self._last_send = time.monotonic()
+    self._stopped = threading.Event()
+    if self._rank == 0:
+      threading.Thread(target=self._heartbeat_loop, args=(heartbeat_interval,),
+                       name="rank-heartbeat", daemon=True).start()
+
+  def generate(self, inputs: Dict[str, torch.Tensor],
+               config: Dict[str, Any]) -> Any:
+    """Runs a batch on all ranks and returns the output of rank 0.
+
+    Args:
+      inputs: The input_ids and attention_mask of the batch, of equal shape.
+      config: Generation config overrides, sent as a picklable dict.
+    """
+    if self._rank != 0:
+      raise RuntimeError("Only rank 0 sends batches.")
+    input_ids = inputs["input_ids"].to("cpu", torch.int64)
+    attention_mask = inputs["attention_mask"].to("cpu", torch.int64)
+    with self._lock:
+      if self._stopped.is_set():
+        raise RuntimeError("The other ranks were stopped.")
+      self._send(_GENERATE, config, torch.stack([input_ids, attention_mask]))
+      return self._generate_fn(
+          {"input_ids": input_ids, "attention_mask": attention_mask}, config)
+
+  def serve(self):
+    """Runs the batches of rank 0 until it stops. Called by the other ranks."""
+    if self._rank == 0:
+      raise RuntimeError("Rank 0 sends batches instead.")
+    logging.info("Rank %d waiting for batches", self._rank)
+    while True:
+      header = [None]
+      dist.broadcast_object_list(header, src=0, group=self._group)
+      command, config, shape = header[0]
+      if command == _STOP:
+        logging.info("Rank %d stopped by rank 0", self._rank)
+        return
+      if command == _HEARTBEAT:
+        continue
+      batch = torch.empty(shape, dtype=torch.int64)
+      dist.broadcast(batch, src=0, group=self._group)
+      try:
+        self._generate_fn(
+            {"input_ids": batch[0], "attention_mask": batch[1]}, config)
+      except Exception:  # pylint: disable=broad-except
+        # Rank 0 fails on the same batch and answers its request with an
+        # error, the ranks stay in step.
+        logging.exception("Rank %d failed to generate a batch", self._rank)
+
+  def stop(self):
+    """Makes the other ranks return from serve. Called by rank 0."""
+    with self._lock:
+      if not self._stopped.is_set():
+        self._stopped.set()
+        self._send(_STOP)
+
+  def _send(self, command, config=None, batch=None):
+    header = [(command, config, None if batch is None else tuple(batch.shape))]
+    dist.broadcast_object_list(header, src=0, group=self._group)
+    if batch is not None:
+      dist.broadcast(batch, src=0, group=self._group)
+    self._last_send = time.monotonic()
+
+  def _heartbeat_loop(self, interval):
+    while not self._stopped.wait(interval / 4):
+      with self._lock:
+        if (not self._stopped.is_set() and
+            time.monotonic() - self._last_send >= interval):
+          self._send(_HEARTBEAT)
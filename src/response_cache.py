@@ -0,0 +1,242 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Two-tier response cache for the prediction servers.
+
+Two-tier response cache for the prediction servers.
+"""
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from absl import logging
+
+# Seconds between sweeps of the disk tier while it is below its size limit,
+# which only remove expired entries.
+_SWEEP_INTERVAL = 60.0
+# Fraction of the size limit a sweep above the limit shrinks the disk tier
+# to, so that the following writes do not sweep again.
+_SWEEP_TARGET = 0.9
+
+
+class ResponseCache:
+  """Caches predictions per instance.
+
+  The first tier is an in-process LRU with a TTL. The optional second tier
+  stores entries as files in a directory, so it can be shared by all workers
+  on the same host. Entries found on disk are promoted to memory.
+
+  Writes to the disk tier periodically sweep it: entries written more than
+  the TTL ago are removed, then the oldest written ones while the directory
+  is above its size limit.
+  """
+
+  def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600,
+               disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+    """Creates the cache.
+
+    Args:
+      max_entries: Maximum number of entries kept in memory. 0 disables the
+        memory tier.
+      ttl_seconds: Time after which an entry expires.
+      disk_dir: Optional directory of the shared disk tier.
+      disk_max_bytes: Size of the entries of the disk tier above which the
+        oldest are removed. 0 does not limit it.
+    """
+    self._max_entries = max_entries
+    self._ttl = ttl_seconds
+    self._disk_dir = disk_dir
+    self._disk_max_bytes = disk_max_bytes
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._counters = collections.Counter()
+    # Size of the disk tier measured by the last sweep plus the entries
+    # written since. The first write sweeps.
+    self._disk_bytes = 0
+    self._next_sweep = 0.0
+    self._sweep_lock = threading.Lock()
+    if disk_dir:
+      os.makedirs(disk_dir, exist_ok=True)
+
+  @property
+  def enabled(self) -> bool:
+    return self._max_entries > 0 or bool(self._disk_dir)
+
+  @staticmethod
+  def key(text: str, model_version: str, config: Dict[str, Any]) -> str:
+    """Builds the cache key of an instance.
+
+    Args:
+      text: Input text. Whitespace is normalized.
+      model_version: Identifies the content of the served model, such as
+        model_fetcher.model_version.
+      config: Generation config overrides of the request.
+
+    Returns:
+      A hex digest.
+    """
+    payload = json.dumps(
+        {
+            "text": " ".join(str(text).split()),
+            "model": model_version,
+            "config": config,
+        },
+        sort_keys=True,
+        default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+  def get(self, key: str) -> Optional[Any]:
+    """Returns the cached value of `key`, or None on a miss."""
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        expires, value = entry
+        if expires > now:
+          self._entries.move_to_end(key)
+          self._counters["hits"] += 1
+          self._counters["memory_hits"] += 1
+          return value
+        del self._entries[key]
+
+    value = self._disk_get(key, now)
+    with self._lock:
+      if value is None:
+        self._counters["misses"] += 1
+        return None
+      self._counters["hits"] += 1
+      self._counters["disk_hits"] += 1
+    self._memory_put(key, value, now + self._ttl)
+    return value
+
+  def put(self, key: str, value: Any):
+    """Stores `value` in both tiers."""
+    expires = time.time() + self._ttl
+    self._memory_put(key, value, expires)
+    self._disk_put(key, value, expires)
+
+  def stats(self) -> Dict[str, int]:
+    """Returns hit and miss counters."""
+    with self._lock:
+      return {
+          "hits": self._counters["hits"],
+          "misses": self._counters["misses"],
+          "memory_hits": self._counters["memory_hits"],
+          "disk_hits": self._counters["disk_hits"],
+          "disk_evictions": self._counters["disk_evictions"],
+          "entries": len(self._entries),
+      }
+
+  def _memory_put(self, key, value, expires):
+    if self._max_entries <= 0:
+      return
+    with self._lock:
+      self._entries[key] = (expires, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def _disk_path(self, key):
+    return os.path.join(self._disk_dir, key[:2], key + ".json")
+
+  def _disk_get(self, key, now):
+    if not self._disk_dir:
+      return None
+    path = self._disk_path(key)
+    try:
+      with open(path) as f:
+        entry = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if entry["expires"] <= now:
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      return None
+    return entry["value"]
+
+  def _disk_put(self, key, value, expires):
+    if not self._disk_dir:
+      return
+    path = self._disk_path(key)
+    data = json.dumps({"expires": expires, "value": value}).encode()
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # Write to a temporary file first so readers never see partial entries.
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+      with os.fdopen(fd, "wb") as f:
+        f.write(data)
+      os.replace(tmp_path, path)
+    except OSError:
+      logging.warning("Unable to write cache entry %s", path, exc_info=True)
+      return
+    now = time.time()
+    with self._lock:
+      self._disk_bytes += len(data)
+      sweep = now >= self._next_sweep or (
+          self._disk_max_bytes and self._disk_bytes > self._disk_max_bytes)
+    if sweep:
+      self._sweep_disk(now)
+
+  def _sweep_disk(self, now):
+    """Removes expired entries, then the oldest ones above the size limit.
+
+    Entries are ordered by the modification time of their file, which other
+    workers sharing the directory also update when writing.
+    """
+    if not self._sweep_lock.acquire(blocking=False):
+      # Another thread is sweeping.
+      return
+    try:
+      files = []
+      for root, _, names in os.walk(self._disk_dir):
+        for name in names:
+          if not name.endswith(".json"):
+            continue
+          path = os.path.join(root, name)
+          try:
+            stat = os.stat(path)
+          except OSError:
+            # Removed by another worker.
+            continue
+          files.append((stat.st_mtime, stat.st_size, path))
+      files.sort()
+      total = sum(size for _, size, _ in files)
+      over_limit = self._disk_max_bytes and total > self._disk_max_bytes
+      removed = 0
+      for mtime, size, path in files:
+        expired = mtime + self._ttl <= now
+        if not expired and not (
+            over_limit and total > self._disk_max_bytes * _SWEEP_TARGET):
+          break
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+        total -= size
+        removed += 1
+      with self._lock:
+        self._disk_bytes = total
+        self._next_sweep = now + _SWEEP_INTERVAL
+        self._counters["disk_evictions"] += removed
+    finally:
+      self._sweep_lock.release()
+    if removed:
+      logging.info("Removed %d disk cache entries, %d bytes left", removed,
+                   total)
@@ -0,0 +1,115 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serving modes shared by the prediction servers.
+
+Serving modes shared by the prediction servers.
+"""
+from typing import Callable, List, Optional
+
+from absl import flags
+from absl import logging
+
+import instrumentation
+import warmup
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum(
+    "server", "gunicorn", ["flask", "waitress", "gunicorn"],
+    "HTTP server to run. 'flask' is the single process development server, "
+    "'waitress' serves from a thread pool in this process and 'gunicorn' "
+    "runs --workers processes, each loading its own model.")
+flags.DEFINE_integer(
+    "workers", 1,
+    "Number of gunicorn worker processes. Every worker loads its own copy of "
+    "the model.")
+flags.DEFINE_integer(
+    "max_concurrency", 8,
+    "Maximum number of requests handled concurrently by each worker.")
+flags.DEFINE_integer(
+    "server_timeout", 0,
+    "Seconds after which gunicorn restarts a silent worker. 0 disables the "
+    "timeout, since model loading and long generations block workers.")
+
+
+def serve(app, init_fn: Optional[Callable[[], None]] = None,
+          allow_fork: bool = True,
+          warmup_fn: Optional[Callable[[List[str]], object]] = None):
+  """Serves `app` on app.host:app.port with the server selected by --server.
+
+  The model is initialized and warmed up in the background of every worker
+  process, which reports ready once done. See warmup.start.
+
+  Args:
+    app: The Flask application.
+    init_fn: Loads the model. Called once per worker process.
+    allow_fork: Whether the server may fork worker processes. Must be False
+      when the process already holds state that does not survive a fork,
+      such as a distributed process group.
+    warmup_fn: Runs a batch of input texts through the model once it is
+      loaded.
+  """
+  server = FLAGS.server
+  if server == "gunicorn" and not allow_fork:
+    logging.info("Forking workers is not supported here, using waitress.")
+    server = "waitress"
+
+  if server == "gunicorn":
+    _serve_gunicorn(app, init_fn, warmup_fn)
+    return
+
+  warmup.start(init_fn, warmup_fn)
+  if server == "waitress":
+    import waitress  # pylint: disable=g-import-not-at-top
+    logging.info("Serving with waitress, %d threads", FLAGS.max_concurrency)
+    waitress.serve(app, host=app.host, port=app.port,
+                   threads=FLAGS.max_concurrency)
+  else:
+    app.run(app.host, app.port, debug=False, threaded=True)
+
+
+def _serve_gunicorn(app, init_fn, warmup_fn):
+  """Runs gunicorn with threaded workers that each initialize the model."""
+  from gunicorn.app.base import BaseApplication  # pylint: disable=g-import-not-at-top
+
+  class _Application(BaseApplication):
+
+    def __init__(self, options):
+      self.options = options
+      super().__init__()
+
+    def load_config(self):
+      for key, value in self.options.items():
+        self.cfg.set(key, value)
+
+    def load(self):
+      return app
+
+  def post_worker_init(worker):
+    logging.info("Initializing worker %d", worker.pid)
+    warmup.start(init_fn, warmup_fn)
+
+  options = {
+      "bind": f"{app.host}:{app.port}",
+      "workers": FLAGS.workers,
+      "worker_class": "gthread",
+      "threads": FLAGS.max_concurrency,
+      "timeout": FLAGS.server_timeout,
+      "post_worker_init": post_worker_init,
+      "child_exit": lambda _, worker: instrumentation.mark_process_dead(
+          worker.pid),
+  }
+  logging.info("Serving with gunicorn, %d workers x %d threads",
+               FLAGS.workers, FLAGS.max_concurrency)
+  _Application(options).run()
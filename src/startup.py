@@ -0,0 +1,137 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Startup orchestration of the prediction servers.
+
+Runs the startup phases of a server concurrently, each once the phases it
+depends on are done, and reports the duration of every phase.
+"""
+from concurrent import futures
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, Sequence
+
+from absl import logging
+
+import instrumentation
+
+_lock = threading.Lock()
+# Phases of this process by name. Worker processes inherit the phases run
+# before they were forked.
+_report: Dict[str, Dict[str, Any]] = {}
+
+
+class StartupError(RuntimeError):
+  """Raised when a startup phase failed."""
+
+  def __init__(self, phase: str, error: BaseException):
+    super().__init__(f"Startup phase {phase} failed: {error}")
+    self.phase = phase
+
+
+class _Skipped(Exception):
+  """A phase did not run because a phase it depends on failed."""
+
+
+class StartupPipeline:
+  """Runs named startup phases on threads as their dependencies allow."""
+
+  def __init__(self):
+    self._phases = {}
+
+  def add(self, name: str, fn: Callable[..., Any], after: Sequence[str] = ()):
+    """Adds a phase.
+
+    Args:
+      name: Name of the phase in the report.
+      fn: Runs the phase. Called with the results of the phases of `after`,
+        in order.
+      after: Phases that must succeed before this one starts.
+    """
+    for dependency in after:
+      if dependency not in self._phases:
+        raise ValueError(f"Unknown phase {dependency!r}.")
+    self._phases[name] = (fn, tuple(after))
+
+  def run(self) -> Dict[str, Any]:
+    """Runs all phases and waits for them.
+
+    Returns:
+      The result of every phase by name.
+
+    Raises:
+      StartupError: For the first phase that failed, once all phases that
+        could run are done.
+    """
+    start = time.perf_counter()
+    results = {}
+    with futures.ThreadPoolExecutor(
+        max(1, len(self._phases)), thread_name_prefix="startup") as executor:
+      for name, (fn, after) in self._phases.items():
+        results[name] = executor.submit(
+            self._run_phase, name, fn, [results[d] for d in after], start)
+    failures = [(name, future.exception()) for name, future in results.items()
+                if future.exception() is not None and
+                not isinstance(future.exception(), _Skipped)]
+    phases = report()
+    logging.info("Startup took %.2fs: %s", time.perf_counter() - start,
+                 json.dumps(phases))
+    if failures:
+      name, error = min(failures, key=lambda f: phases[f[0]]["end_s"])
+      raise StartupError(name, error) from error
+    return {name: future.result() for name, future in results.items()}
+
+  def _run_phase(self, name, fn, dependencies, pipeline_start):
+    try:
+      args = [dependency.result() for dependency in dependencies]
+    except Exception as e:  # pylint: disable=broad-except
+      _record(name, status="skipped")
+      raise _Skipped(name) from e
+    start = time.perf_counter()
+    _record(name, status="running", start_s=start - pipeline_start)
+    logging.info("Startup phase %s started", name)
+    try:
+      result = fn(*args)
+    except Exception:
+      _record(name, status="failed", end_s=time.perf_counter() - pipeline_start,
+              seconds=time.perf_counter() - start)
+      logging.exception("Startup phase %s failed", name)
+      raise
+    seconds = time.perf_counter() - start
+    _record(name, status="done", end_s=time.perf_counter() - pipeline_start,
+            seconds=seconds)
+    instrumentation.record_startup_phase(name, seconds)
+    logging.info("Startup phase %s took %.2fs", name, seconds)
+    return result
+
+
+def _record(name, **fields):
+  with _lock:
+    _report.setdefault(name, {}).update(
+        (key, round(value, 3) if isinstance(value, float) else value)
+        for key, value in fields.items())
+
+
+def report() -> Dict[str, Dict[str, Any]]:
+  """Returns the status, start, end and duration in seconds of every phase."""
+  with _lock:
+    return {name: dict(fields) for name, fields in _report.items()}
+
+
+def register(app):
+  """Serves the startup report of `app` at /startup."""
+
+  @app.route("/startup")
+  def startup():  # pylint: disable=unused-variable
+    return {"phases": report()}
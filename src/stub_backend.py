@@ -0,0 +1,211 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stub model backends to run the prediction servers offline.
+
+Writes a tiny randomly initialized T5 model with a word level tokenizer
+trained on a payload file, which predict.py serves with --model_path and
+predict_triton.py uses as tokenizer with --hf_model_path:
+
+  python stub_backend.py --output_dir=/tmp/stub_model
+"""
+import asyncio
+import json
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+from tokenizers import Tokenizer
+from tokenizers import models
+from tokenizers import pre_tokenizers
+from tokenizers import trainers
+from transformers import PreTrainedTokenizerFast
+from tritonclient.utils import np_to_triton_dtype
+from tritonclient.utils import shared_memory
+from tritonclient.utils import triton_to_np_dtype
+
+from benchmark_utils import build_tiny_model
+
+FLAGS = flags.FLAGS
+
+_SPECIAL_TOKENS = ["<pad>", "</s>", "<unk>"]
+
+
+def save_stub_model(output_dir: str, texts, vocab_size: int = 512,
+                    architecture: str = "t5"):
+  """Saves a tiny model and a tokenizer trained on `texts`.
+
+  Args:
+    output_dir: Directory to write the model and tokenizer to.
+    texts: Corpus the word level vocabulary is built from.
+    vocab_size: Vocabulary size of both the tokenizer and the model.
+    architecture: 't5' for a seq2seq model or 'gpt2' for a causal LM.
+  """
+  tokenizer = Tokenizer(models.WordLevel(unk_token="<unk>"))
+  tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+  tokenizer.train_from_iterator(
+      texts,
+      trainers.WordLevelTrainer(
+          vocab_size=vocab_size, special_tokens=_SPECIAL_TOKENS))
+  tokenizer = PreTrainedTokenizerFast(
+      tokenizer_object=tokenizer,
+      pad_token="<pad>",
+      eos_token="</s>",
+      unk_token="<unk>",
+      model_max_length=512)
+  tokenizer.save_pretrained(output_dir)
+  build_tiny_model(architecture).save_pretrained(output_dir)
+
+
+def echo_outputs(arrays):
+  """Returns fastertransformer outputs whose rows echo their input tokens.
+
+  Args:
+    arrays: Input arrays by name, with at least input_ids, sequence_length
+      and max_output_len.
+
+  Returns:
+    The output_ids and sequence_length arrays, truncated to the largest
+    max_output_len of the batch as FasterTransformer does.
+  """
+  max_output_len = int(arrays["max_output_len"].max())
+  output_ids = arrays["input_ids"][:, None, :max_output_len].astype(np.uint32)
+  lengths = np.minimum(arrays["sequence_length"].reshape(-1), max_output_len)
+  return {
+      "output_ids": output_ids,
+      "sequence_length": lengths.reshape(-1, 1).astype(np.uint32),
+  }
+
+
+class _StubResult:
+  """Mimics the tritonclient InferResult of the fastertransformer model."""
+
+  def __init__(self, outputs, in_shared_memory=()):
+    self._outputs = outputs
+    self._in_shared_memory = in_shared_memory
+
+  def as_numpy(self, name):
+    if name in self._in_shared_memory:
+      return None
+    return self._outputs.get(name)
+
+  def get_output(self, name):
+    array = self._outputs[name]
+    return {"name": name, "datatype": np_to_triton_dtype(array.dtype),
+            "shape": list(array.shape)}
+
+
+class StubTritonClient:
+  """Stands in for tritonclient's InferenceServerClient.
+
+  Answers fastertransformer requests without a Triton server: the output of
+  every row echoes its input tokens, after a latency of
+  `latency_ms + per_token_ms * max_output_len`. Accepts HTTP and gRPC inputs,
+  tensors in registered system shared memory regions and arrays by name.
+  """
+
+  def __init__(self, latency_ms: float = 20.0, per_token_ms: float = 0.5):
+    self._latency_ms = latency_ms
+    self._per_token_ms = per_token_ms
+    self._regions = {}
+
+  def register_system_shared_memory(self, name, key, byte_size, offset=0):
+    del byte_size, offset
+    self._regions[name] = shared_memory.create_shared_memory_region(
+        name + "_stub", key, 0)
+
+  def unregister_system_shared_memory(self, name=""):
+    for region in [name] if name else list(self._regions):
+      shared_memory.destroy_shared_memory_region(self._regions.pop(region))
+
+  def infer(self, model_name, inputs, outputs=None, **kwargs):
+    """Returns echoed output ids for a fastertransformer request."""
+    del model_name, kwargs
+    delay, result = self._respond(inputs, outputs)
+    time.sleep(delay)
+    return result
+
+  def close(self):
+    self.unregister_system_shared_memory()
+
+  def _respond(self, inputs, outputs):
+    """Returns the simulated latency in seconds and the result."""
+    if isinstance(inputs, dict):
+      arrays = inputs
+    else:
+      arrays = {i.name(): self._input_array(i) for i in inputs}
+    max_output_len = int(arrays["max_output_len"].max())
+    delay = (self._latency_ms + self._per_token_ms * max_output_len) / 1000.0
+    results = echo_outputs(arrays)
+    in_shared_memory = []
+    for output in outputs or []:
+      params = output._get_tensor().get("parameters", {})  # pylint: disable=protected-access
+      if "shared_memory_region" in params:
+        shared_memory.set_shared_memory_region(
+            self._regions[params["shared_memory_region"]],
+            [results[output.name()]], params.get("shared_memory_offset", 0))
+        in_shared_memory.append(output.name())
+    return delay, _StubResult(results, in_shared_memory)
+
+  def _input_array(self, infer_input):
+    # pylint: disable=protected-access
+    tensor = infer_input._get_tensor()
+    if isinstance(tensor, dict):
+      datatype, shape = tensor["datatype"], tensor["shape"]
+      params = tensor.get("parameters", {})
+      raw = infer_input._get_binary_data()
+    else:
+      # gRPC InferInput.
+      datatype, shape = tensor.datatype, list(tensor.shape)
+      params = {}
+      raw = infer_input._get_content()
+    dtype = triton_to_np_dtype(datatype)
+    if "shared_memory_region" in params:
+      return shared_memory.get_contents_as_numpy(
+          self._regions[params["shared_memory_region"]], dtype, shape,
+          params.get("shared_memory_offset", 0)).copy()
+    if raw is not None:
+      array = np.frombuffer(raw, dtype=dtype)
+    else:
+      array = np.array(tensor["data"], dtype=dtype)
+    return array.reshape(shape)
+
+
+class AsyncStubTritonClient(StubTritonClient):
+  """Stands in for the asyncio InferenceServerClient of tritonclient."""
+
+  async def infer(self, model_name, inputs, outputs=None, **kwargs):
+    """Returns echoed output ids for a fastertransformer request."""
+    del model_name, kwargs
+    delay, result = self._respond(inputs, outputs)
+    await asyncio.sleep(delay)
+    return result
+
+  async def close(self):
+    super().close()
+
+
+def main(argv):
+  del argv
+  with open(FLAGS.payload) as f:
+    texts = json.load(f)["instances"]
+  save_stub_model(FLAGS.output_dir, texts)
+
+
+if __name__ == "__main__":
+  flags.DEFINE_string("output_dir", None, "Directory to write the model to.")
+  flags.DEFINE_string("payload", "../predict_payload.json",
+                      "Payload whose instances the vocabulary is built from.")
+  flags.mark_flag_as_required("output_dir")
+  app.run(main)
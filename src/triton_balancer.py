@@ -0,0 +1,253 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Client-side load balancing across several Triton servers.
+
+Batches are routed to the healthy endpoint with the fewest requests in
+flight. Endpoints are ejected after consecutive failed requests or a failed
+health check, and re-admitted once a health check succeeds.
+"""
+import contextlib
+import itertools
+import threading
+from typing import Any, Callable, Dict, List
+
+from absl import flags
+from absl import logging
+from tritonclient.utils import InferenceServerException
+
+import instrumentation
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+    "triton_endpoints", [],
+    "Triton servers to balance requests across, as host:port pairs of their "
+    "HTTP port, or gRPC port with --triton_transport=grpc. Empty sends all "
+    "requests to --triton_host.")
+flags.DEFINE_float(
+    "triton_health_check_interval", 5.0,
+    "Seconds between health checks of every Triton endpoint.")
+flags.DEFINE_integer(
+    "triton_ejection_failures", 3,
+    "Consecutive failed requests after which a Triton endpoint is ejected "
+    "until its next successful health check.")
+
+
+# gRPC status codes of errors of the server rather than of the request.
+_GRPC_SERVER_ERRORS = ("UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL",
+                       "UNKNOWN")
+
+
+class NoHealthyEndpoint(RuntimeError):
+  """Raised when all Triton endpoints are ejected."""
+
+
+class _Endpoint:
+
+  def __init__(self, address):
+    self.address = address
+    self.healthy = True
+    self.outstanding = 0
+    self.consecutive_failures = 0
+    self.requests = 0
+    self.failures = 0
+    self.ejections = 0
+
+
+class EndpointBalancer:
+  """Routes requests to the healthy endpoint with the fewest in flight.
+
+  Endpoints start healthy. Ties go to the endpoint used least recently, so
+  an idle tier is used round robin.
+  """
+
+  def __init__(self, addresses: List[str],
+               health_check_fn: Callable[[str], bool],
+               check_interval: float = 5.0, ejection_failures: int = 3):
+    """Creates the balancer.
+
+    Args:
+      addresses: Endpoints as host:port.
+      health_check_fn: Returns whether the endpoint at an address serves the
+        model. Called from a background thread.
+      check_interval: Seconds between health checks of every endpoint.
+      ejection_failures: Consecutive failed requests that eject an endpoint.
+    """
+    if not addresses:
+      raise ValueError("EndpointBalancer needs at least one endpoint.")
+    self.addresses = list(addresses)
+    self._endpoints = [_Endpoint(address) for address in self.addresses]
+    self._health_check_fn = health_check_fn
+    self._check_interval = check_interval
+    self._ejection_failures = ejection_failures
+    self._lock = threading.Lock()
+    self._order = itertools.count()
+    self._last_used = {address: 0 for address in self.addresses}
+    self._closed = threading.Event()
+    self._checker = None
+    for endpoint in self._endpoints:
+      instrumentation.set_endpoint_health(endpoint.address, True)
+
+  def start(self):
+    """Starts health checking the endpoints in the background."""
+    self._checker = threading.Thread(
+        target=self._check_loop, name="triton-health", daemon=True)
+    self._checker.start()
+
+  def close(self):
+    self._closed.set()
+    if self._checker is not None:
+      self._checker.join()
+
+  @contextlib.contextmanager
+  def acquire(self):
+    """Yields the address of the endpoint to send a request to.
+
+    A request raising a connection error or a server error counts as a
+    failure of the endpoint.
+
+    Raises:
+      NoHealthyEndpoint: If all endpoints are ejected.
+    """
+    with self._lock:
+      healthy = [e for e in self._endpoints if e.healthy]
+      if not healthy:
+        raise NoHealthyEndpoint("All Triton endpoints are unhealthy.")
+      endpoint = min(healthy, key=lambda e: (e.outstanding,
+                                             self._last_used[e.address]))
+      endpoint.outstanding += 1
+      endpoint.requests += 1
+      self._last_used[endpoint.address] = next(self._order)
+    failed = False
+    try:
+      yield endpoint.address
+    except BaseException as e:
+      failed = _is_endpoint_failure(e)
+      raise
+    finally:
+      self._release(endpoint, failed)
+
+  def check_all(self) -> bool:
+    """Health checks every endpoint once and returns whether any is healthy."""
+    for endpoint in self._endpoints:
+      try:
+        healthy = bool(self._health_check_fn(endpoint.address))
+      except Exception:  # pylint: disable=broad-except
+        healthy = False
+      self._set_health(endpoint, healthy, "a failed health check")
+    with self._lock:
+      return any(e.healthy for e in self._endpoints)
+
+  def stats(self) -> Dict[str, Dict[str, Any]]:
+    """Returns the health and request counts of every endpoint."""
+    with self._lock:
+      return {
+          e.address: {
+              "healthy": e.healthy,
+              "outstanding": e.outstanding,
+              "requests": e.requests,
+              "failures": e.failures,
+              "ejections": e.ejections,
+          } for e in self._endpoints
+      }
+
+  def _release(self, endpoint, failed):
+    with self._lock:
+      endpoint.outstanding -= 1
+      if not failed:
+        endpoint.consecutive_failures = 0
+        return
+      endpoint.failures += 1
+      endpoint.consecutive_failures += 1
+      eject = (endpoint.healthy and
+               endpoint.consecutive_failures >= self._ejection_failures)
+    if eject:
+      self._set_health(
+          endpoint, False,
+          f"{endpoint.consecutive_failures} consecutive failed requests")
+
+  def _set_health(self, endpoint, healthy, reason):
+    with self._lock:
+      if endpoint.healthy == healthy:
+        return
+      endpoint.healthy = healthy
+      endpoint.consecutive_failures = 0
+      if not healthy:
+        endpoint.ejections += 1
+    if healthy:
+      logging.info("Re-admitting Triton endpoint %s", endpoint.address)
+    else:
+      logging.warning("Ejecting Triton endpoint %s after %s",
+                      endpoint.address, reason)
+      instrumentation.count_endpoint_ejection(endpoint.address)
+    instrumentation.set_endpoint_health(endpoint.address, healthy)
+
+  def _check_loop(self):
+    while not self._closed.wait(self._check_interval):
+      self.check_all()
+
+
+class BalancedProcessorPool:
+  """ProcessorPools of several Triton endpoints behind an EndpointBalancer.
+
+  Has the interface of ProcessorPool, so the callers of a single endpoint
+  work unchanged.
+  """
+
+  def __init__(self, balancer: EndpointBalancer,
+               pool_factory: Callable[[str, int], Any]):
+    """Creates a pool per endpoint.
+
+    Args:
+      balancer: Routes requests across the endpoints.
+      pool_factory: Creates the ProcessorPool of a host and port.
+    """
+    self._balancer = balancer
+    self._pools = {}
+    for address in balancer.addresses:
+      host, _, port = address.rpartition(":")
+      self._pools[address] = pool_factory(host, int(port))
+    self.tokenizer = next(iter(self._pools.values())).tokenizer
+
+  @contextlib.contextmanager
+  def processor(self):
+    """Yields an idle processor of the endpoint chosen by the balancer.
+
+    Raises:
+      NoHealthyEndpoint: If all endpoints are ejected.
+    """
+    with self._balancer.acquire() as address:
+      with self._pools[address].processor() as processor:
+        yield processor
+
+  def close(self):
+    for pool in self._pools.values():
+      pool.close()
+
+
+def _is_endpoint_failure(e: BaseException) -> bool:
+  """Whether a request error hints at an unhealthy endpoint."""
+  if isinstance(e, InferenceServerException):
+    # Requests rejected as invalid are not the fault of the endpoint.
+    status = str(e.status() or "")
+    return (not status or status.startswith("5") or
+            status.endswith(_GRPC_SERVER_ERRORS))
+  return isinstance(e, (OSError, TimeoutError))
+
+
+def from_flags(health_check_fn: Callable[[str], bool]) -> EndpointBalancer:
+  """Creates an EndpointBalancer of --triton_endpoints."""
+  return EndpointBalancer(FLAGS.triton_endpoints, health_check_fn,
+                          FLAGS.triton_health_check_interval,
+                          FLAGS.triton_ejection_failures)
@@ -0,0 +1,239 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Zero-copy codec of the Triton HTTP protocol with binary tensor data.
+
+Requests are encoded as a list of buffers, the JSON header followed by the
+memory of every input array, which are sent with a single scatter/gather
+write instead of being concatenated. Binary tensors of a response, or of a
+request received by fake_triton.py, are parsed as numpy views over the body.
+"""
+import http.client
+import json
+import socket
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from tritonclient.utils import InferenceServerException
+from tritonclient.utils import np_to_triton_dtype
+from tritonclient.utils import triton_to_np_dtype
+
+HEADER_LENGTH = "Inference-Header-Content-Length"
+
+
+def encode_request(
+    inputs: Dict[str, np.ndarray],
+    outputs: Optional[Sequence[str]] = None,
+    parameters: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[memoryview], int]:
+  """Encodes an inference request with binary tensor data.
+
+  Args:
+    inputs: Input arrays by name. Arrays are only copied if they are not
+      C-contiguous.
+    outputs: Names of the outputs to return. None returns all outputs.
+    parameters: Optional request parameters.
+
+  Returns:
+    The buffers of the body, and the length of its JSON header.
+  """
+  arrays = []
+  tensors = []
+  for name, array in inputs.items():
+    array = np.ascontiguousarray(array)
+    if array.dtype == np.object_:
+      raise ValueError(f"Input {name} has no fixed size datatype.")
+    arrays.append(array)
+    tensors.append({
+        "name": name,
+        "shape": list(array.shape),
+        "datatype": np_to_triton_dtype(array.dtype),
+        "parameters": {"binary_data_size": array.nbytes},
+    })
+  request = {"inputs": tensors}
+  request_parameters = dict(parameters or {})
+  if outputs is None:
+    request_parameters["binary_data_output"] = True
+  else:
+    request["outputs"] = [{"name": name, "parameters": {"binary_data": True}}
+                          for name in outputs]
+  if request_parameters:
+    request["parameters"] = request_parameters
+  header = json.dumps(request, separators=(",", ":")).encode()
+  buffers = [memoryview(header)]
+  buffers.extend(_byte_view(array) for array in arrays if array.nbytes)
+  return buffers, len(header)
+
+
+def decode_response(body, header_length: Optional[int] = None
+                   ) -> Dict[str, np.ndarray]:
+  """Decodes the outputs of an inference response.
+
+  Args:
+    body: The response body, as bytes or any buffer.
+    header_length: Value of the Inference-Header-Content-Length header, or
+      None if the whole body is JSON.
+
+  Returns:
+    Output arrays by name. Binary outputs are views over `body`.
+  """
+  _, arrays = _decode(body, header_length, "outputs")
+  return arrays
+
+
+def decode_request(body, header_length: Optional[int] = None
+                  ) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+  """Decodes an inference request, as a server receives it.
+
+  Args:
+    body: The request body, as bytes or any buffer.
+    header_length: Value of the Inference-Header-Content-Length header, or
+      None if the whole body is JSON.
+
+  Returns:
+    The JSON header, and the input arrays by name. Binary inputs are views
+    over `body`. Inputs in shared memory are left to the caller.
+  """
+  return _decode(body, header_length, "inputs")
+
+
+def _decode(body, header_length, key):
+  view = memoryview(body)
+  if header_length is None:
+    header_length = len(view)
+  header = json.loads(view[:header_length].tobytes())
+  arrays = {}
+  offset = header_length
+  for tensor in header.get(key, []):
+    parameters = tensor.get("parameters", {})
+    if "shared_memory_region" in parameters:
+      continue
+    dtype = triton_to_np_dtype(tensor["datatype"])
+    shape = tensor["shape"]
+    size = parameters.get("binary_data_size")
+    if size is None:
+      arrays[tensor["name"]] = np.array(tensor["data"], dtype=dtype).reshape(
+          shape)
+      continue
+    if dtype == np.object_:
+      raise ValueError(f"Tensor {tensor['name']} has no fixed size datatype.")
+    arrays[tensor["name"]] = np.frombuffer(
+        view, dtype=dtype, count=size // np.dtype(dtype).itemsize,
+        offset=offset).reshape(shape)
+    offset += size
+  return header, arrays
+
+
+class DecodedResult:
+  """Outputs of a response, with the accessors of tritonclient's InferResult."""
+
+  def __init__(self, arrays: Dict[str, np.ndarray]):
+    self._arrays = arrays
+
+  def as_numpy(self, name: str) -> Optional[np.ndarray]:
+    return self._arrays.get(name)
+
+  def get_output(self, name: str) -> Optional[Dict[str, Any]]:
+    array = self._arrays.get(name)
+    if array is None:
+      return None
+    return {"name": name, "datatype": np_to_triton_dtype(array.dtype),
+            "shape": list(array.shape)}
+
+
+class BinaryHttpClient:
+  """Minimal Triton HTTP client sending and receiving tensors without copies.
+
+  Keeps one keep-alive connection and, like tritonclient's clients, must not
+  be used by concurrent requests.
+  """
+
+  def __init__(self, url: str, timeout: float = 60.0):
+    host, _, port = url.rpartition(":")
+    self._connection = _Connection(host, int(port), timeout=timeout)
+
+  def infer(self, model_name: str, inputs: Dict[str, np.ndarray],
+            outputs: Optional[Sequence[str]] = None) -> DecodedResult:
+    """Runs inference on input arrays by name.
+
+    Raises:
+      InferenceServerException: If Triton answers with an error.
+    """
+    buffers, header_length = encode_request(inputs, outputs)
+    path = f"/v2/models/{model_name}/infer"
+    try:
+      response = self._post(path, buffers, header_length)
+    except ConnectionError:
+      # Triton may have closed the idle keep-alive connection.
+      self._connection.close()
+      response = self._post(path, buffers, header_length)
+
+    body = bytearray(int(response.getheader("Content-Length", 0)))
+    if body:
+      view = memoryview(body)
+      read = 0
+      while read < len(body):
+        count = response.readinto(view[read:])
+        if not count:
+          raise http.client.IncompleteRead(bytes(view[:read]),
+                                           len(body) - read)
+        read += count
+    else:
+      body = response.read()
+    if response.status != 200:
+      try:
+        message = json.loads(bytes(body))["error"]
+      except (ValueError, KeyError):
+        message = bytes(body).decode(errors="replace")
+      raise InferenceServerException(msg=message, status=str(response.status))
+    header = response.getheader(HEADER_LENGTH)
+    return DecodedResult(decode_response(
+        body, int(header) if header is not None else None))
+
+  def close(self):
+    self._connection.close()
+
+  def _post(self, path, buffers, header_length):
+    connection = self._connection
+    connection.putrequest("POST", path, skip_accept_encoding=True)
+    connection.putheader("Content-Type", "application/octet-stream")
+    connection.putheader(HEADER_LENGTH, str(header_length))
+    connection.putheader("Content-Length", str(sum(len(b) for b in buffers)))
+    connection.endheaders()
+    _send_all(connection.sock, buffers)
+    return connection.getresponse()
+
+
+class _Connection(http.client.HTTPConnection):
+  """HTTP connection that sends the body right after the headers."""
+
+  def connect(self):
+    super().connect()
+    # The headers and body are separate writes, which must not wait for the
+    # acknowledgement of the headers.
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _send_all(sock, buffers: List[memoryview]):
+  """Writes all buffers with as few scatter/gather calls as possible."""
+  buffers = [b for b in buffers if len(b)]
+  while buffers:
+    sent = sock.sendmsg(buffers)
+    while buffers and sent >= len(buffers[0]):
+      sent -= len(buffers.pop(0))
+    if sent:
+      buffers[0] = buffers[0][sent:]
+
+
+def _byte_view(array: np.ndarray) -> memoryview:
+  return memoryview(array).cast("B")
@@ -15,28 +15,181 @@
 
 Simple Flask prediction for a model using FasterTransformer_Triton..
 """
+import asyncio
+import collections
+from concurrent import futures
+import contextlib
+import itertools
 import json
+import os
 import struct
+import threading
 
 import numpy as np
 import torch
 from transformers import AutoTokenizer
+import tritonclient.grpc as grpcclient
+import tritonclient.grpc.aio as grpcclient_aio
 import tritonclient.http as httpclient
+import tritonclient.http.aio as httpclient_aio
 from tritonclient.utils import np_to_triton_dtype
+from tritonclient.utils import shared_memory
+from tritonclient.utils import triton_to_np_dtype
 
+import instrumentation
 import time
+from triton_codec import BinaryHttpClient
+
+# Default number of tokens generated for an instance.
+MAX_OUTPUT_LEN = 128
+
+# Generation parameters an instance can set, with the fastertransformer input
+# each is sent as, its dtype and its range. FasterTransformer applies the
+# values of the first row to the whole batch, so instances sent in one Triton
+# request must agree on them. Stop words, "stop", are set per instance.
+GENERATION_PARAMETERS = {
+    "max_output_len": ("max_output_len", np.uint32, 1, 1024),
+    "beam_width": ("beam_width", np.uint32, 1, 8),
+    "top_k": ("runtime_top_k", np.uint32, 0, 1024),
+    "top_p": ("runtime_top_p", np.float32, 0.0, 1.0),
+    "temperature": ("temperature", np.float32, 1e-6, 100.0),
+    "len_penalty": ("len_penalty", np.float32, -100.0, 100.0),
+    "repetition_penalty": ("repetition_penalty", np.float32, 1e-6, 100.0),
+    "random_seed": ("random_seed", np.uint64, 0, 2**64 - 1),
+}
+
+# Ways of exchanging tensors with Triton: HTTP with tensors in the body, gRPC,
+# HTTP with tensors in system shared memory, for a Triton on this host, or
+# HTTP with binary tensors sent and received without copies.
+TRANSPORTS = ("http", "grpc", "shm", "binary")
+
+# Minimum size of a shared memory region, so small requests do not regrow it.
+_MIN_REGION_BYTES = 1 << 16
+
+
+def parse_parameters(config):
+  """Validates the generation parameters of an instance.
+
+  Args:
+    config: Parameters by name, from GENERATION_PARAMETERS or "stop", a list
+      of stop words.
+
+  Returns:
+    The parameters with integer and float values normalized.
+
+  Raises:
+    ValueError: If a parameter is unknown or out of its range.
+  """
+  if not isinstance(config, dict):
+    raise ValueError(f"Expected generation parameters as an object, got "
+                     f"{config!r}.")
+  parameters = {}
+  for name, value in config.items():
+    if name == "stop":
+      if (not isinstance(value, list) or
+          not all(isinstance(word, str) and word for word in value)):
+        raise ValueError("stop must be a list of non empty strings.")
+      if value:
+        parameters[name] = list(value)
+      continue
+    if name not in GENERATION_PARAMETERS:
+      raise ValueError(f"Unknown generation parameter {name!r}.")
+    _, dtype, low, high = GENERATION_PARAMETERS[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+      raise ValueError(f"{name} must be a number, got {value!r}.")
+    if np.issubdtype(dtype, np.integer):
+      if value != int(value):
+        raise ValueError(f"{name} must be an integer, got {value!r}.")
+      value = int(value)
+    else:
+      value = float(value)
+    if not low <= value <= high:
+      raise ValueError(f"{name} must be in [{low}, {high}], got {value}.")
+    parameters[name] = value
+  return parameters
+
+
+def batch_key(parameters):
+  """Returns a key equal for parameters that can share a Triton request."""
+  return tuple(sorted(
+      (name, value) for name, value in parameters.items() if name != "stop"))
+
+
+def output_tokens(parameters):
+  """Returns the tokens an instance may generate with `parameters`."""
+  return (parameters.get("max_output_len", MAX_OUTPUT_LEN) *
+          parameters.get("beam_width", 1))
+
+
+def is_sampling(parameters):
+  """Whether predictions with `parameters` are random."""
+  return (parameters.get("top_k", 1) > 1 or parameters.get("top_p", 0) > 0)
+
 
 class TritonProcessorBase:
   """Base Processor class for any FasterTransformer Triton Backend model."""
 
-  def __init__(self, model_path, host, port):
-    self.client = httpclient.InferenceServerClient(
-        f"{host}:{port}", verbose=True
-    )
+  def __init__(self, model_path, host, port, tokenizer=None, client=None,
+               transport="http"):
+    if transport not in TRANSPORTS:
+      raise ValueError(f"Unknown transport {transport!r}.")
+    self.transport = transport
+    self.protocol = grpcclient if transport == "grpc" else httpclient
+    if client is None and transport == "binary":
+      client = BinaryHttpClient(f"{host}:{port}")
+    elif client is None:
+      client = self.protocol.InferenceServerClient(f"{host}:{port}")
+    self.client = client
+    self.shared_memory = None
+    if transport == "shm":
+      self.shared_memory = SharedMemoryTensors(client)
 
     # Initialize tokenizers from HuggingFace to do pre and post processings
     # (convert text into tokens and backward) at the client side
-    self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if tokenizer is None:
+      tokenizer = AutoTokenizer.from_pretrained(model_path)
+    self.tokenizer = tokenizer
+
+  def close(self):
+    """Unregisters the shared memory regions and closes the client."""
+    if self.shared_memory is not None:
+      self.shared_memory.close()
+    self.client.close()
+
+  def _make_inputs(self, arrays):
+    """Creates the inputs of a request from a dict of numpy arrays."""
+    if self.transport == "binary":
+      return arrays
+    inputs = [
+        self.protocol.InferInput(name, array.shape,
+                                 np_to_triton_dtype(array.dtype))
+        for name, array in arrays.items()
+    ]
+    if self.shared_memory is not None:
+      self.shared_memory.set_inputs(inputs, list(arrays.values()))
+    elif self.protocol is httpclient:
+      for infer_input, array in zip(inputs, arrays.values()):
+        infer_input.set_data_from_numpy(array, False)
+    else:
+      for infer_input, array in zip(inputs, arrays.values()):
+        infer_input.set_data_from_numpy(array)
+    return inputs
+
+  def _make_outputs(self, output_bytes):
+    """Returns the requested outputs, or None to receive all in the body.
+
+    Args:
+      output_bytes: Maximum size of each output by name. Only needed with
+        shared memory, where outputs are written to a preallocated region.
+    """
+    if self.shared_memory is None:
+      return None
+    return self.shared_memory.request_outputs(output_bytes)
+
+  def _as_numpy(self, result, name):
+    if self.shared_memory is not None:
+      return self.shared_memory.get_output(result, name)
+    return result.as_numpy(name)
 
   def _get_payload(
       self,
@@ -145,31 +298,49 @@ class TritonProcessorBase:
 class T5TritonProcessor(TritonProcessorBase):
   """Processor for the T5 model family."""
 
-  def __init__(self, hf_model_path="t5-base", host="localhost", port=8000):
-    super().__init__(hf_model_path, host, port)
+  def __init__(self, hf_model_path="t5-base", host="localhost", port=8000,
+               tokenizer=None, client=None, transport="http"):
+    super().__init__(hf_model_path, host, port, tokenizer, client, transport)
 
-  def infer(self, task=None, text=None):
-    """Run inferencing on a series of inputs.
+  def infer(self, task=None, text=None, parameters=None):
+    """Run inferencing on a single input.
 
        Returns tuple of <inferencing_result:str, metrics:Dictionary<str>>
     """
+    results, metrics = self.infer_batch(
+        [text], task=task,
+        parameters=None if parameters is None else [parameters])
+    return results[0], metrics
+
+  def infer_batch(self, texts, task=None, parameters=None):
+    """Run inferencing on a list of inputs in a single Triton request.
+
+       `parameters` optionally lists the generation parameters of every text,
+       as returned by parse_parameters, which must have equal batch_key.
+
+       Returns tuple of <inferencing_results:List[str], metrics:Dictionary<str>>
+       with the timings of the whole batch.
+    """
     if task is not None:
-      text = f"{task}: {text}"
+      texts = [f"{task}: {text}" for text in texts]
     start_time = time.perf_counter()
-    inputs = self._preprocess(text)
+    inputs = self._preprocess(texts, parameters)
+    shared = parameters[0] if parameters else {}
+    sequences = len(texts) * shared.get("beam_width", 1)
+    outputs = self._make_outputs({
+        "output_ids": len(texts) * output_tokens(shared) * 4,
+        "sequence_length": sequences * 4,
+    })
     preprocess_end_time = time.perf_counter()
-    result = self.client.infer("fastertransformer", inputs)
+    result = self.client.infer("fastertransformer", inputs, outputs=outputs)
     infer_end_time = time.perf_counter()
-    processed_result = self._postprocess(result)
+    processed_results = self._postprocess(result)
     end_time = time.perf_counter()
+    metrics = _record_timings(start_time, preprocess_end_time, infer_end_time,
+                              end_time)
+    return processed_results, metrics
 
-    metrics = {"preprocess": f"{(1000 * (preprocess_end_time - start_time)):0.5f}",
-               "prediction": f"{(1000 * (infer_end_time - preprocess_end_time)):0.5f}",
-               "postprocess": f"{(1000 * (end_time - infer_end_time)):0.5f}",
-               "unit": "ms"}
-    return processed_result, metrics
-
-  def _preprocess(self, string_input):
+  def _preprocess(self, string_input, parameters=None):
     """Implement the function that takes text, converts it into the tokens using HFtokenizer and prepares tensorts for sending to Triton."""
     input_token = self.tokenizer(
         string_input, return_tensors="pt", padding=True, truncation=True
@@ -180,43 +351,407 @@ class T5TritonProcessor(TritonProcessorBase):
         torch.sum(input_token.attention_mask, dim=1).numpy().astype(np.uint32)
     )
     mem_seq_len = mem_seq_len.reshape([mem_seq_len.shape[0], 1])
-    max_output_len = np.array([[128]], dtype=np.uint32)
-    runtime_top_k = (1.0 * np.ones([input_ids.shape[0], 1])).astype(np.uint32)
+    instrumentation.count_tokens(input_tokens=int(mem_seq_len.sum()))
 
-    inputs = [
-        httpclient.InferInput(
-            "input_ids", input_ids.shape, np_to_triton_dtype(input_ids.dtype)
-        ),
-        httpclient.InferInput(
-            "sequence_length",
-            mem_seq_len.shape,
-            np_to_triton_dtype(mem_seq_len.dtype),
-        ),
-        httpclient.InferInput(
-            "max_output_len",
-            max_output_len.shape,
-            np_to_triton_dtype(mem_seq_len.dtype),
-        ),
-        httpclient.InferInput(
-            "runtime_top_k",
-            runtime_top_k.shape,
-            np_to_triton_dtype(runtime_top_k.dtype),
-        ),
-    ]
-    inputs[0].set_data_from_numpy(input_ids, False)
-    inputs[1].set_data_from_numpy(mem_seq_len, False)
-    inputs[2].set_data_from_numpy(max_output_len, False)
-    inputs[3].set_data_from_numpy(runtime_top_k, False)
+    parameters = parameters or [{}] * input_ids.shape[0]
+    if len({batch_key(p) for p in parameters}) > 1:
+      raise ValueError("Instances of a batch must have equal generation "
+                       "parameters, except stop words.")
+    # Top-p sampling draws from all tokens unless top_k is also given.
+    values = {"max_output_len": MAX_OUTPUT_LEN,
+              "top_k": 0 if "top_p" in parameters[0] else 1}
+    values.update(batch_key(parameters[0]))
+    arrays = {
+        "input_ids": input_ids,
+        "sequence_length": mem_seq_len,
+    }
+    for name, value in values.items():
+      input_name, dtype, _, _ = GENERATION_PARAMETERS[name]
+      arrays[input_name] = np.full([input_ids.shape[0], 1], value, dtype=dtype)
+    if any("stop" in p for p in parameters):
+      arrays["stop_words_list"] = self._stop_words_list(
+          [p.get("stop", []) for p in parameters])
+    return self._make_inputs(arrays)
 
-    return inputs
+  def _stop_words_list(self, stop_words):
+    """Encodes the stop words of every row as FasterTransformer expects.
+
+    Row i of the [batch, 2, width] result holds the concatenated tokens of
+    the stop words of instance i, and the end offset of each word, padded
+    with 0 and -1 respectively.
+    """
+    rows = []
+    for words in stop_words:
+      ids = []
+      offsets = []
+      for word in words:
+        ids.extend(self.tokenizer.encode(word, add_special_tokens=False))
+        offsets.append(len(ids))
+      rows.append((ids, offsets))
+    width = max(max(len(ids), len(offsets)) for ids, offsets in rows)
+    stop_words_list = np.zeros([len(rows), 2, width], dtype=np.int32)
+    stop_words_list[:, 1, :] = -1
+    for row, (ids, offsets) in zip(stop_words_list, rows):
+      row[0, :len(ids)] = ids
+      row[1, :len(offsets)] = offsets
+    return stop_words_list
 
   # Implement function that takes tokens from Triton's response and converts
-  # them into text
+  # them into text, one text per row of the batch
   def _postprocess(self, result):
-    ft_decoding_outputs = result.as_numpy("output_ids")
-    ft_decoding_seq_lens = result.as_numpy("sequence_length")
-    tokens = self.tokenizer.decode(
-        ft_decoding_outputs[0][0][: ft_decoding_seq_lens[0][0]],
-        skip_special_tokens=True,
-    )
-    return tokens
+    ft_decoding_outputs = self._as_numpy(result, "output_ids")
+    ft_decoding_seq_lens = self._as_numpy(result, "sequence_length")
+    instrumentation.count_tokens(
+        output_tokens=int(ft_decoding_seq_lens[:, 0].sum()))
+    return [
+        self.tokenizer.decode(
+            output_ids[0][:seq_lens[0]],
+            skip_special_tokens=True,
+        )
+        for output_ids, seq_lens in zip(ft_decoding_outputs,
+                                        ft_decoding_seq_lens)
+    ]
+
+
+def _record_timings(start_time, preprocess_end_time, infer_end_time, end_time):
+  """Observes the stages of a request and returns its metrics."""
+  instrumentation.observe("tokenize", preprocess_end_time - start_time)
+  instrumentation.observe("model", infer_end_time - preprocess_end_time)
+  instrumentation.observe("decode", end_time - infer_end_time)
+
+  return {"preprocess": f"{(1000 * (preprocess_end_time - start_time)):0.5f}",
+          "prediction": f"{(1000 * (infer_end_time - preprocess_end_time)):0.5f}",
+          "postprocess": f"{(1000 * (end_time - infer_end_time)):0.5f}",
+          "unit": "ms"}
+
+
+class AsyncT5TritonProcessor(T5TritonProcessor):
+  """T5 processor on the asyncio clients of tritonclient.
+
+  Concurrent requests share the client. Tokenization and decoding run on
+  `executor`, so they overlap with the Triton calls in flight. Must be
+  created and used on the same event loop.
+  """
+
+  def __init__(self, hf_model_path="t5-base", host="localhost", port=8000,
+               tokenizer=None, client=None, transport="http", executor=None):
+    if transport not in ("http", "grpc"):
+      raise ValueError(
+          f"The asyncio clients do not support the {transport} transport.")
+    if client is None:
+      aio = grpcclient_aio if transport == "grpc" else httpclient_aio
+      client = aio.InferenceServerClient(f"{host}:{port}")
+    super().__init__(hf_model_path, host, port, tokenizer, client, transport)
+    self._executor = executor
+
+  async def infer_batch_async(self, texts, task=None, parameters=None):
+    """Run inferencing on a list of inputs in a single Triton request.
+
+       `parameters` is as in infer_batch.
+
+       Returns tuple of <inferencing_results:List[str], metrics:Dictionary<str>>
+       with the timings of the whole batch.
+    """
+    if task is not None:
+      texts = [f"{task}: {text}" for text in texts]
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+    inputs = await loop.run_in_executor(self._executor, self._preprocess, texts,
+                                        parameters)
+    preprocess_end_time = time.perf_counter()
+    result = await self.client.infer("fastertransformer", inputs)
+    infer_end_time = time.perf_counter()
+    processed_results = await loop.run_in_executor(
+        self._executor, self._postprocess, result)
+    end_time = time.perf_counter()
+    metrics = _record_timings(start_time, preprocess_end_time, infer_end_time,
+                              end_time)
+    return processed_results, metrics
+
+  async def close_async(self):
+    await self.client.close()
+
+
+class AsyncProcessorRunner:
+  """Runs an AsyncT5TritonProcessor for synchronous callers.
+
+  The processor lives on an event loop in a background thread. Callers from
+  any thread submit batches, which are sent to Triton concurrently, so
+  Triton's dynamic batcher can interleave them with other requests.
+  """
+
+  def __init__(self, hf_model_path, host="localhost", port=8000,
+               tokenizer=None, transport="http", client_factory=None,
+               max_workers=8, balancer=None):
+    """Starts the event loop and creates the processors on it.
+
+    Args:
+      hf_model_path: Path of the tokenizer.
+      host: Triton host.
+      port: Triton HTTP port, or gRPC port for the "grpc" transport.
+      tokenizer: Optional tokenizer to share instead of loading one.
+      transport: "http" or "grpc".
+      client_factory: Optional callable creating the asyncio client.
+      max_workers: Threads tokenizing and decoding concurrently.
+      balancer: Optional triton_balancer.EndpointBalancer routing every batch
+        to one of its endpoints, instead of to `host` and `port`.
+    """
+    self._loop = asyncio.new_event_loop()
+    self._thread = threading.Thread(
+        target=self._loop.run_forever, name="triton-aio", daemon=True)
+    self._thread.start()
+    self._executor = futures.ThreadPoolExecutor(
+        max_workers, thread_name_prefix="triton-aio-codec")
+
+    self._balancer = balancer
+    addresses = balancer.addresses if balancer else [f"{host}:{port}"]
+
+    async def create():
+      processors = {}
+      shared_tokenizer = tokenizer
+      for address in addresses:
+        address_host, _, address_port = address.rpartition(":")
+        client = client_factory() if client_factory else None
+        processors[address] = AsyncT5TritonProcessor(
+            hf_model_path, address_host, int(address_port),
+            tokenizer=shared_tokenizer, client=client, transport=transport,
+            executor=self._executor)
+        shared_tokenizer = processors[address].tokenizer
+      return processors
+
+    self._processors = self._run(create())
+    self.tokenizer = next(iter(self._processors.values())).tokenizer
+
+  def infer_batches(self, batches, parameters=None):
+    """Sends each list of texts in `batches` as a concurrent Triton request.
+
+    Args:
+      batches: Lists of texts.
+      parameters: Optional generation parameters of the texts of every batch,
+        as in infer_batch.
+
+    Returns:
+      List with the tuple of infer_batch_async of every batch.
+    """
+    if parameters is None:
+      parameters = [None] * len(batches)
+
+    async def infer(texts, batch_parameters):
+      if self._balancer is None:
+        processor, = self._processors.values()
+        return await processor.infer_batch_async(
+            texts, parameters=batch_parameters)
+      with self._balancer.acquire() as address:
+        return await self._processors[address].infer_batch_async(
+            texts, parameters=batch_parameters)
+
+    async def infer_all():
+      return await asyncio.gather(
+          *(infer(texts, batch_parameters)
+            for texts, batch_parameters in zip(batches, parameters)))
+
+    return self._run(infer_all())
+
+  def close(self):
+    """Closes the clients and stops the event loop."""
+    for processor in self._processors.values():
+      self._run(processor.close_async())
+    self._loop.call_soon_threadsafe(self._loop.stop)
+    self._thread.join()
+    self._executor.shutdown()
+
+  def _run(self, coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+
+class SharedMemoryTensors:
+  """Exchanges the tensors of a client's requests through shared memory.
+
+  One region for inputs and one for outputs are registered with Triton on
+  first use and reused by every request of the client, which must not send
+  requests concurrently. A region is recreated larger when a request does
+  not fit.
+  """
+
+  _ids = itertools.count()
+
+  def __init__(self, client):
+    self._client = client
+    self._prefix = f"llm_server_{os.getpid()}_{next(self._ids)}"
+    # Handle and size of the regions by name.
+    self._regions = {}
+    self._output_offsets = {}
+
+  def set_inputs(self, inputs, arrays):
+    """Copies `arrays` to the input region and points `inputs` at them."""
+    name, handle = self._region("input", sum(a.nbytes for a in arrays))
+    offset = 0
+    for infer_input, array in zip(inputs, arrays):
+      shared_memory.set_shared_memory_region(
+          handle, [np.ascontiguousarray(array)], offset)
+      infer_input.set_shared_memory(name, array.nbytes, offset)
+      offset += array.nbytes
+
+  def request_outputs(self, output_bytes):
+    """Returns outputs written to the output region, see get_output."""
+    name, _ = self._region("output", sum(output_bytes.values()))
+    outputs = []
+    offset = 0
+    self._output_offsets = {}
+    for output_name, size in output_bytes.items():
+      output = httpclient.InferRequestedOutput(output_name)
+      output.set_shared_memory(name, size, offset)
+      outputs.append(output)
+      self._output_offsets[output_name] = offset
+      offset += size
+    return outputs
+
+  def get_output(self, result, name):
+    """Returns a copy of an output of the last request."""
+    output = result.get_output(name)
+    handle, _ = self._regions["output"]
+    array = shared_memory.get_contents_as_numpy(
+        handle, triton_to_np_dtype(output["datatype"]), output["shape"],
+        self._output_offsets[name])
+    # Copy, since the next request overwrites the region.
+    return array.copy()
+
+  def close(self):
+    for kind in list(self._regions):
+      self._destroy(kind)
+
+  def _region(self, kind, byte_size):
+    """Returns the name and handle of a region of at least `byte_size`."""
+    name = f"{self._prefix}_{kind}"
+    if kind in self._regions:
+      handle, size = self._regions[kind]
+      if byte_size <= size:
+        return name, handle
+      self._destroy(kind)
+      byte_size = max(byte_size, 2 * size)
+    byte_size = max(byte_size, _MIN_REGION_BYTES)
+    handle = shared_memory.create_shared_memory_region(
+        name, "/" + name, byte_size, create_only=True)
+    self._client.register_system_shared_memory(name, "/" + name, byte_size)
+    self._regions[kind] = (handle, byte_size)
+    return name, handle
+
+  def _destroy(self, kind):
+    handle, _ = self._regions.pop(kind)
+    self._client.unregister_system_shared_memory(f"{self._prefix}_{kind}")
+    shared_memory.destroy_shared_memory_region(handle)
+
+
+class ProcessorPool:
+  """Process-wide pool of T5TritonProcessors sharing one tokenizer.
+
+  InferenceServerClient is not thread safe, so every processor keeps its own
+  keep-alive connection to Triton and is used by one request at a time.
+  Processors are created on demand, up to `size`. The gevent based HTTP
+  client only works in the thread that created it, so a processor is only
+  reused by its thread. At `size`, an idle processor of another thread is
+  replaced.
+  """
+
+  def __init__(self, hf_model_path, host="localhost", port=8000, size=8,
+               client_factory=None, transport="http", tokenizer=None):
+    """Creates the pool and loads the tokenizer.
+
+    Args:
+      hf_model_path: Path of the tokenizer.
+      host: Triton host.
+      port: Triton HTTP port.
+      size: Maximum number of processors, usually the number of requests
+        served concurrently.
+      client_factory: Optional callable creating the client of a processor.
+      transport: One of TRANSPORTS. `port` is the gRPC port for "grpc".
+      tokenizer: Optional tokenizer to share instead of loading one.
+    """
+    if tokenizer is None:
+      tokenizer = AutoTokenizer.from_pretrained(hf_model_path)
+    self.tokenizer = tokenizer
+    self._hf_model_path = hf_model_path
+    self._host = host
+    self._port = port
+    self._size = size
+    self._client_factory = client_factory
+    self._transport = transport
+    self._cond = threading.Condition()
+    # Stacks of idle processors by the thread that created them, so the most
+    # recently used connection is reused first. Threads are keys rather than
+    # their identifiers, which are reused once a thread exits.
+    self._idle = collections.OrderedDict()
+    self._created = 0
+
+  @contextlib.contextmanager
+  def processor(self):
+    """Yields an idle processor, waiting for one if all are in use.
+
+    A processor whose request failed is closed and replaced, since its
+    connection may be broken.
+    """
+    thread = threading.current_thread()
+    processor = self._checkout(thread)
+    try:
+      yield processor
+    except BaseException:
+      self._discard(processor)
+      raise
+    with self._cond:
+      self._idle.setdefault(thread, []).append(processor)
+      self._idle.move_to_end(thread)
+      self._cond.notify_all()
+
+  def close(self):
+    """Closes the connections of the idle processors."""
+    with self._cond:
+      idle, self._idle = self._idle, collections.OrderedDict()
+    for processors in idle.values():
+      for processor in processors:
+        self._discard(processor)
+
+  def _checkout(self, thread):
+    replaced = None
+    with self._cond:
+      while True:
+        if thread in self._idle:
+          processors = self._idle[thread]
+          processor = processors.pop()
+          if not processors:
+            del self._idle[thread]
+          return processor
+        if self._created < self._size:
+          self._created += 1
+          break
+        replaced = self._pop_idle()
+        if replaced is not None:
+          # The new processor takes the place of the replaced one.
+          break
+        self._cond.wait()
+    if replaced is not None:
+      replaced.close()
+    try:
+      client = self._client_factory() if self._client_factory else None
+      return T5TritonProcessor(self._hf_model_path, self._host, self._port,
+                               tokenizer=self.tokenizer, client=client,
+                               transport=self._transport)
+    except BaseException:
+      with self._cond:
+        self._created -= 1
+        self._cond.notify()
+      raise
+
+  def _pop_idle(self):
+    """Returns the least recently used idle processor of any thread."""
+    for thread, processors in self._idle.items():
+      processor = processors.pop(0)
+      if not processors:
+        del self._idle[thread]
+      return processor
+    return None
+
+  def _discard(self, processor):
+    with self._cond:
+      self._created -= 1
+      self._cond.notify()
+    processor.close()
@@ -0,0 +1,156 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Readiness tracking and warmup shared by the prediction servers.
+
+The model is loaded and warmed up in the background while the server already
+answers liveness probes. Readiness is only reported once warmup completed.
+"""
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional
+
+from absl import flags
+from absl import logging
+from flask import request
+
+import instrumentation
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+    "warmup_seq_lengths", ["16", "128", "512"],
+    "Approximate input lengths in words of the synthetic batches run before "
+    "the server reports ready. Empty disables warmup.")
+flags.DEFINE_integer(
+    "warmup_batch_size", 4, "Number of instances in each warmup batch.")
+
+STARTING = "starting"
+WARMING_UP = "warming_up"
+READY = "ready"
+FAILED = "failed"
+
+# Routes served before the model is ready.
+_PROBE_ENDPOINTS = frozenset(["live", "ready", "health", "metrics", "startup",
+                              "ui", "static"])
+
+_WORDS = ("the quick brown fox jumps over a lazy dog while seven wizards "
+          "box and quietly judge every sphinx of black quartz").split()
+
+_lock = threading.Lock()
+_phase = STARTING
+
+
+def phase() -> str:
+  """Returns the startup phase of this process."""
+  with _lock:
+    return _phase
+
+
+def is_ready() -> bool:
+  return phase() == READY
+
+
+def _set_phase(value):
+  global _phase
+  with _lock:
+    _phase = value
+  logging.info("Server phase: %s", value)
+
+
+def synthetic_text(num_words: int) -> str:
+  """Returns an input text of `num_words` words."""
+  return " ".join(itertools.islice(itertools.cycle(_WORDS), num_words))
+
+
+def run_warmup(warmup_fn: Callable[[List[str]], object]) -> float:
+  """Runs a synthetic batch for each of --warmup_seq_lengths.
+
+  Args:
+    warmup_fn: Called with a list of input texts. Should go through the same
+      path as inference requests.
+
+  Returns:
+    The warmup duration in seconds.
+  """
+  start = time.perf_counter()
+  for length in FLAGS.warmup_seq_lengths:
+    batch_start = time.perf_counter()
+    warmup_fn([synthetic_text(int(length))] * FLAGS.warmup_batch_size)
+    logging.info("Warmup batch of %d x %s words took %.2fs",
+                 FLAGS.warmup_batch_size, length,
+                 time.perf_counter() - batch_start)
+  seconds = time.perf_counter() - start
+  logging.info("Warmup took %.2fs", seconds)
+  instrumentation.record_warmup(seconds)
+  return seconds
+
+
+def start(init_fn: Optional[Callable[[], None]] = None,
+          warmup_fn: Optional[Callable[[List[str]], object]] = None):
+  """Initializes and warms up the model in a background thread.
+
+  Args:
+    init_fn: Loads the model.
+    warmup_fn: Runs a batch of input texts, see run_warmup.
+
+  Returns:
+    The started thread.
+  """
+
+  def run():
+    try:
+      if init_fn is not None:
+        init_fn()
+      if warmup_fn is not None and FLAGS.warmup_seq_lengths:
+        _set_phase(WARMING_UP)
+        run_warmup(warmup_fn)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Server initialization failed")
+      _set_phase(FAILED)
+      return
+    _set_phase(READY)
+
+  thread = threading.Thread(target=run, name="warmup", daemon=True)
+  thread.start()
+  return thread
+
+
+def register(app):
+  """Adds liveness and readiness routes to `app`.
+
+  /live succeeds unless initialization failed, so the container is restarted
+  in that case. /ready and /health succeed once the model is warmed up. Other
+  routes answer 503 until then.
+  """
+
+  @app.route("/live")
+  def live():  # pylint: disable=unused-variable
+    if phase() == FAILED:
+      return {"live": False, "phase": FAILED}, 500
+    return {"live": True, "phase": phase()}
+
+  @app.route("/ready")
+  @app.route("/health", endpoint="health")
+  def ready():  # pylint: disable=unused-variable
+    if not is_ready():
+      return {"health": phase()}, 503
+    return {"health": "ok"}
+
+  @app.before_request
+  def reject_until_ready():  # pylint: disable=unused-variable
+    if request.endpoint in _PROBE_ENDPOINTS or is_ready():
+      return None
+    return ({"error": f"Model is not ready ({phase()})"}, 503,
+            {"Retry-After": "5"})
@@ -0,0 +1,59 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Makes the flat modules of src/ importable and shares test fixtures."""
+import os
+import sys
+
+from absl import flags
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture
+def parsed_flags():
+  """Parses the flags of the imported modules, keeping their defaults."""
+  if not flags.FLAGS.is_parsed():
+    flags.FLAGS(["test"])
+  return flags.FLAGS
+
+
+# Corpus of the word level tokenizer of the stub models.
+_STUB_TEXTS = [
+    "translate English to German: the house is wonderful",
+    "summarize: the quick brown fox jumps over the lazy dog",
+    "a request with some more words than the others in this batch",
+]
+
+
+@pytest.fixture(scope="session")
+def stub_model_dir(tmp_path_factory):
+  """Directory of a tiny T5 model with a tokenizer of _STUB_TEXTS."""
+  from stub_backend import save_stub_model  # pylint: disable=g-import-not-at-top
+
+  output_dir = str(tmp_path_factory.mktemp("stub_model"))
+  save_stub_model(output_dir, _STUB_TEXTS)
+  return output_dir
+
+
+@pytest.fixture
+def triton_server():
+  """A fake Triton server without latency on a free port."""
+  import fake_triton  # pylint: disable=g-import-not-at-top
+
+  server = fake_triton.start(
+      port=0, model=fake_triton.FakeModel(latency_ms=0, per_token_ms=0))
+  yield server
+  server.shutdown()
+  server.server_close()
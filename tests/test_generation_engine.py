@@ -0,0 +1,124 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Greedy parity of GenerationEngine with `generate` on tiny local models."""
+import random
+
+from absl.testing import flagsaver
+import pytest
+import torch
+from transformers import GenerationConfig
+
+from benchmark_utils import build_tiny_model
+from generation_engine import GenerationEngine
+from generation_engine import unsupported_fields
+import predict
+from stub_backend import save_stub_model
+
+
+@pytest.fixture(params=["t5", "gpt2"])
+def model(request):
+  return build_tiny_model(request.param)
+
+
+@pytest.fixture
+def engine(model):
+  engine = GenerationEngine(model, max_batch_size=4)
+  yield engine
+  engine.close()
+
+
+def _prompts(count, seed=0):
+  rng = random.Random(seed)
+  return [[rng.randint(2, 511) for _ in range(rng.randint(3, 24))]
+          for _ in range(count)]
+
+
+def _generate(model, input_ids, max_new_tokens=None):
+  """Returns the new tokens of `generate` on a single unpadded prompt."""
+  kwargs = {} if max_new_tokens is None else {"max_new_tokens": max_new_tokens}
+  with torch.no_grad():
+    row = model.generate(torch.tensor([input_ids]), do_sample=False,
+                         num_beams=1, **kwargs)[0].tolist()
+  return row[1:] if model.config.is_encoder_decoder else row[len(input_ids):]
+
+
+def _strip_eos(tokens, model):
+  eos = model.generation_config.eos_token_id
+  return tokens[:tokens.index(eos) + 1] if eos in tokens else tokens
+
+
+def _assert_parity(model, prompts, budgets, outputs):
+  for ids, budget, output in zip(prompts, budgets, outputs):
+    assert _strip_eos(output, model) == _strip_eos(
+        _generate(model, ids, budget), model)
+
+
+def test_mixed_lengths_match_generate(model, engine):
+  prompts = _prompts(10)
+  budgets = [random.Random(i).randint(2, 24) for i in range(len(prompts))]
+  futures = [engine.submit(ids, budget) for ids, budget in zip(prompts, budgets)]
+  _assert_parity(model, prompts, budgets, [f.result() for f in futures])
+
+
+def test_staggered_joins_match_generate(model, engine):
+  prompts = _prompts(6, seed=1)
+  budgets = [24, 3, 24, 16, 8, 12]
+  # The later prompts join while the first long one is still decoding.
+  first = [engine.submit(ids, budget)
+           for ids, budget in zip(prompts[:2], budgets[:2])]
+  first[1].result()
+  later = [engine.submit(ids, budget)
+           for ids, budget in zip(prompts[2:], budgets[2:])]
+  _assert_parity(model, prompts, budgets,
+                 [f.result() for f in first + later])
+
+
+def test_default_budget_matches_generate(model, engine):
+  prompts = _prompts(3, seed=2)
+  outputs = [f.result() for f in [engine.submit(ids) for ids in prompts]]
+  _assert_parity(model, prompts, [None] * len(prompts), outputs)
+  assert all(outputs)
+
+
+def test_unsupported_fields():
+  assert unsupported_fields(GenerationConfig()) == []
+  assert unsupported_fields(GenerationConfig(
+      num_beams=1, repetition_penalty=1.0, suppress_tokens=[])) == []
+  assert unsupported_fields(GenerationConfig(
+      no_repeat_ngram_size=1, repetition_penalty=5.0)) == [
+          "repetition_penalty", "no_repeat_ngram_size"]
+
+
+def test_logits_processors_match_generate(tmp_path, parsed_flags):
+  texts = ["the quick brown fox", "jumps over the lazy dog again"]
+  save_stub_model(str(tmp_path), texts, architecture="gpt2")
+  config = GenerationConfig.from_pretrained(tmp_path)
+  config.update(no_repeat_ngram_size=1, repetition_penalty=5.0)
+  config.save_pretrained(tmp_path)
+  with flagsaver.flagsaver(continuous_batching=True):
+    served = predict.load_served_model(predict.DEFAULT_MODEL, str(tmp_path))
+  try:
+    # The engine would ignore the penalties, the requests go to generate.
+    assert served.engine is None
+    predictions = predict.predict(served, texts, {"max_new_tokens": 12})
+    for text, prediction in zip(texts, predictions):
+      inputs = served.tokenizer([text], return_tensors="pt")
+      with torch.no_grad():
+        row = served.model.generate(**inputs, max_new_tokens=12)[0].tolist()
+      new_tokens = row[inputs["input_ids"].shape[1]:]
+      assert len(set(new_tokens)) == len(new_tokens)
+      assert prediction == [
+          served.tokenizer.decode(row, skip_special_tokens=True)]
+  finally:
+    served.close()
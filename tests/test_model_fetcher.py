@@ -0,0 +1,110 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ModelFetcher against an in-memory fsspec filesystem."""
+from concurrent import futures
+import os
+import threading
+import time
+
+import fsspec
+import pytest
+
+from model_fetcher import ModelFetcher
+
+
+@pytest.fixture
+def fs():
+  fs = fsspec.filesystem("memory")
+  yield fs
+  fs.rm("/bucket", recursive=True)
+
+
+def test_version_changes_when_a_file_is_rewritten(fs, tmp_path):
+  fs.pipe("/bucket/model/weights.bin", b"old weights")
+  fetcher = ModelFetcher(str(tmp_path), fs=fs)
+  old = fetcher.version("memory://bucket/model")
+  assert os.path.basename(fetcher.fetch("memory://bucket/model")) == old
+  assert fetcher.version("memory://bucket/model") == old
+
+  fs.pipe("/bucket/model/weights.bin", b"new weights!")
+  assert fetcher.version("memory://bucket/model") != old
+
+
+def _counting(fs, monkeypatch, delay=0.0):
+  """Counts the whole file and byte range reads of `fs`."""
+  calls = {"get_file": 0, "cat_file": 0}
+  lock = threading.Lock()
+  for name in calls:
+    method = getattr(fs, name)
+
+    def counted(*args, name=name, method=method, **kwargs):
+      with lock:
+        calls[name] += 1
+      time.sleep(delay)
+      return method(*args, **kwargs)
+
+    monkeypatch.setattr(fs, name, counted)
+  return calls
+
+
+def test_chunked_download_is_byte_for_byte(fs, tmp_path, monkeypatch):
+  large = os.urandom(10_500)
+  fs.pipe("/bucket/model/weights.bin", large)
+  fs.pipe("/bucket/model/sub/config.json", b"{}")
+  calls = _counting(fs, monkeypatch)
+  fetcher = ModelFetcher(str(tmp_path), max_workers=4, chunk_size=1000, fs=fs)
+
+  local = fetcher.fetch("memory://bucket/model", recursive=True)
+
+  with open(os.path.join(local, "weights.bin"), "rb") as f:
+    assert f.read() == large
+  with open(os.path.join(local, "sub", "config.json"), "rb") as f:
+    assert f.read() == b"{}"
+  assert calls == {"get_file": 1, "cat_file": 11}
+
+
+def test_second_fetch_skips_download(fs, tmp_path, monkeypatch):
+  fs.pipe("/bucket/model/weights.bin", b"weights")
+  calls = _counting(fs, monkeypatch)
+  first = ModelFetcher(str(tmp_path), fs=fs).fetch("memory://bucket/model")
+  second = ModelFetcher(str(tmp_path), fs=fs).fetch("memory://bucket/model")
+  assert first == second
+  assert calls["get_file"] == 1
+
+
+def test_concurrent_fetchers_share_one_download(fs, tmp_path, monkeypatch):
+  fs.pipe("/bucket/model/weights.bin", b"weights")
+  calls = _counting(fs, monkeypatch, delay=0.2)
+  with futures.ThreadPoolExecutor(4) as pool:
+    paths = list(pool.map(
+        lambda _: ModelFetcher(str(tmp_path), fs=fs).fetch(
+            "memory://bucket/model"), range(4)))
+  assert len(set(paths)) == 1
+  assert calls["get_file"] == 1
+
+
+def test_old_versions_are_pruned(fs, tmp_path):
+  fetcher = ModelFetcher(str(tmp_path), fs=fs, keep_versions=2)
+  fs.pipe("/bucket/other/weights.bin", b"other model")
+  other = fetcher.fetch("memory://bucket/other")
+  paths = []
+  for i in range(3):
+    fs.pipe("/bucket/model/weights.bin", b"weights" * (i + 1))
+    paths.append(fetcher.fetch("memory://bucket/model"))
+
+  assert not os.path.exists(paths[0])
+  assert os.path.isdir(paths[1])
+  assert os.path.isdir(paths[2])
+  # The versions of other URLs are kept.
+  assert os.path.isdir(other)
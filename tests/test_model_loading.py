@@ -0,0 +1,109 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Loading and int8 dynamic quantization of tiny local models."""
+import os
+
+import pytest
+from safetensors.torch import load_file
+from safetensors.torch import save_file
+import torch
+from transformers import AutoModelForCausalLM
+from transformers import AutoModelForSeq2SeqLM
+from transformers import ViTConfig
+
+from benchmark_utils import build_tiny_model
+from model_loading import _convert_conv1d  # pylint: disable=protected-access
+from model_loading import load_mmap
+from model_loading import model_size_bytes
+from model_loading import quantize_dynamic_int8
+from model_loading import resolve_autoclass
+
+_AUTOCLASSES = {"t5": AutoModelForSeq2SeqLM, "gpt2": AutoModelForCausalLM}
+
+
+def _save(architecture, path):
+  build_tiny_model(architecture).save_pretrained(path)
+  return str(path)
+
+
+def _weights_file(path):
+  return os.path.join(path, "model.safetensors")
+
+
+@pytest.mark.parametrize("architecture", ["t5", "gpt2"])
+def test_resolve_autoclass_reads_the_config(architecture, tmp_path):
+  path = _save(architecture, tmp_path)
+  assert resolve_autoclass(path) is _AUTOCLASSES[architecture]
+
+
+def test_resolve_autoclass_of_unsupported_models(tmp_path):
+  ViTConfig().save_pretrained(tmp_path)
+  assert resolve_autoclass(str(tmp_path)) is None
+
+
+@pytest.mark.parametrize("architecture", ["t5", "gpt2"])
+def test_load_mmap_matches_from_pretrained(architecture, tmp_path):
+  path = _save(architecture, tmp_path)
+  autoclass = resolve_autoclass(path)
+  expected = autoclass.from_pretrained(path).eval()
+  model = load_mmap(autoclass, path)
+
+  assert model is not None
+  expected_state = expected.state_dict()
+  state = model.state_dict()
+  assert state.keys() == expected_state.keys()
+  for name, tensor in state.items():
+    torch.testing.assert_close(tensor, expected_state[name], rtol=0, atol=0)
+  input_ids = torch.tensor([[5, 6, 7, 8, 9], [10, 11, 12, 0, 0]])
+  attention_mask = (input_ids != 0).long()
+  with torch.no_grad():
+    outputs = [m.generate(input_ids, attention_mask=attention_mask,
+                          max_new_tokens=8, do_sample=False)
+               for m in (model, expected)]
+  assert outputs[0].tolist() == outputs[1].tolist()
+
+
+def test_load_mmap_without_a_tensor_of_the_model(tmp_path):
+  path = _save("t5", tmp_path)
+  tensors = load_file(_weights_file(path))
+  del tensors["decoder.final_layer_norm.weight"]
+  save_file(tensors, _weights_file(path), metadata={"format": "pt"})
+  assert load_mmap(AutoModelForSeq2SeqLM, path) is None
+
+
+def test_load_mmap_without_safetensors(tmp_path):
+  path = _save("gpt2", tmp_path)
+  tensors = load_file(_weights_file(path))
+  os.remove(_weights_file(path))
+  torch.save(tensors, os.path.join(path, "pytorch_model.bin"))
+  assert load_mmap(AutoModelForCausalLM, path) is None
+
+
+@pytest.mark.parametrize("architecture", ["t5", "gpt2"])
+def test_quantization_shrinks_the_model(architecture):
+  model = build_tiny_model(architecture)
+  size = model_size_bytes(model)
+  quantized = quantize_dynamic_int8(model)
+  assert model_size_bytes(quantized) < 0.7 * size
+
+
+def test_conv1d_conversion_keeps_outputs():
+  model = build_tiny_model("gpt2")
+  input_ids = torch.tensor([[5, 6, 7, 8, 9]])
+  with torch.no_grad():
+    expected = model(input_ids).logits
+    _convert_conv1d(model)
+    actual = model(input_ids).logits
+  assert not any(type(m).__name__ == "Conv1D" for m in model.modules())
+  torch.testing.assert_close(actual, expected)
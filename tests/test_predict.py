@@ -0,0 +1,56 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The Flask endpoints of predict.py on tiny stub models."""
+import json
+
+from absl.testing import flagsaver
+import pytest
+
+import predict
+from stub_backend import save_stub_model
+import warmup
+
+_TEXTS = ["the quick brown fox", "jumps over the lazy dog"]
+# Fills the vocabulary of the tokenizer, so every generated id is a word.
+_CORPUS = _TEXTS + [" ".join(f"word{i}" for i in range(512))]
+# Stub models mostly predict padding, which is suppressed to generate text.
+_CONFIG = {"max_new_tokens": 6, "suppress_tokens": [0, 1]}
+
+
+@pytest.fixture(params=["t5", "gpt2"])
+def client(request, tmp_path, parsed_flags):
+  del parsed_flags
+  save_stub_model(str(tmp_path), _CORPUS, architecture=request.param)
+  with flagsaver.flagsaver(model_path=str(tmp_path), warmup_seq_lengths=[]):
+    warmup.start(predict.init_model).join()
+    assert warmup.is_ready()
+    yield predict.app.test_client()
+  with predict.app.registry.use(predict.DEFAULT_MODEL) as served:
+    served.close()
+
+
+def test_stream_predictions_match_infer(client):
+  payload = {"instances": [_TEXTS[0]], "config": _CONFIG}
+  infer = client.post("/infer", json=payload)
+  assert infer.status_code == 200
+
+  stream = client.post("/infer_stream", json=payload)
+  assert stream.status_code == 200
+  lines = [json.loads(line) for line in stream.data.decode().splitlines()]
+  tokens = [line["token"] for line in lines[:-1]]
+  assert tokens
+  assert lines[-1] == {"predictions": infer.get_json()["predictions"]}
+  # Tokens only hold the generated text, without the prompt of decoder-only
+  # models.
+  assert not "".join(tokens).strip().startswith(_TEXTS[0])
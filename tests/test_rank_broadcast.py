@@ -0,0 +1,201 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""RankBroadcaster across two CPU processes over gloo."""
+import json
+import os
+import socket
+import threading
+import time
+import types
+
+from absl import flags
+import torch
+from torch import distributed as dist
+import torch.multiprocessing as mp
+
+from rank_broadcast import RankBroadcaster
+import warmup
+
+_WORLD_SIZE = 2
+_HEARTBEAT_INTERVAL = 0.2
+
+
+def _batch(texts):
+  """Tokenizes texts as one id per word, right padded with 0."""
+  width = max(len(text.split()) for text in texts)
+  lengths = [len(text.split()) for text in texts]
+  input_ids = torch.tensor(
+      [[i + 2 for i in range(n)] + [0] * (width - n) for n in lengths])
+  return {"input_ids": input_ids, "attention_mask": (input_ids != 0).long()}
+
+
+def _init(rank, port):
+  os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+  flags.FLAGS(["test", "--warmup_seq_lengths=4,8", "--warmup_batch_size=2"])
+  dist.init_process_group("gloo", rank=rank, world_size=_WORLD_SIZE)
+
+
+def _write(out_dir, rank, result):
+  with open(os.path.join(out_dir, f"rank{rank}.json"), "w") as f:
+    json.dump(result, f)
+  dist.destroy_process_group()
+
+
+def _read(out_dir):
+  results = []
+  for rank in range(_WORLD_SIZE):
+    with open(os.path.join(out_dir, f"rank{rank}.json")) as f:
+      results.append(json.load(f))
+  return results
+
+
+def _run(rank, port, out_dir):
+  _init(rank, port)
+  batches = []
+  commands = []
+
+  def generate(inputs, config):
+    batches.append([inputs["input_ids"].tolist(),
+                    inputs["attention_mask"].tolist(), config])
+    if config.get("fail_rank") in (rank, "all"):
+      raise ValueError(f"Failure on rank {rank}")
+    return inputs["input_ids"] + 1
+
+  broadcast_object_list = dist.broadcast_object_list
+
+  def recording_broadcast(objects, *args, **kwargs):
+    broadcast_object_list(objects, *args, **kwargs)
+    commands.append(objects[0][0])
+
+  dist.broadcast_object_list = recording_broadcast
+  broadcaster = RankBroadcaster(generate,
+                                heartbeat_interval=_HEARTBEAT_INTERVAL)
+  result = {}
+  if rank == 0:
+    # Warmup and a request share the broadcast, as in predict_deepspeed.
+    warmup_thread = warmup.start(
+        None, lambda texts: broadcaster.generate(_batch(texts), {}))
+    broadcaster.generate(_batch(["a request"]), {"max_new_tokens": 3})
+    warmup_thread.join()
+    result["ready"] = warmup.is_ready()
+    result["batches_when_ready"] = len(batches)
+    time.sleep(5 * _HEARTBEAT_INTERVAL)
+    broadcaster.generate(_batch(["fails on rank one"]), {"fail_rank": 1})
+    try:
+      broadcaster.generate(_batch(["fails everywhere"]), {"fail_rank": "all"})
+    except ValueError:
+      result["raised"] = True
+    output = broadcaster.generate(_batch(["last", "batch of two"]), {})
+    result["output"] = output.tolist()
+    broadcaster.stop()
+  else:
+    serve = threading.Thread(target=broadcaster.serve)
+    serve.start()
+    serve.join(timeout=60)
+    result["served"] = not serve.is_alive()
+  result["batches"] = batches
+  result["commands"] = commands
+  _write(out_dir, rank, result)
+
+
+def _tokenizer():
+  """Builds a word level tokenizer of the warmup words and a few more."""
+  # Imported here, like predict_deepspeed, in the spawned processes only.
+  from tokenizers import Tokenizer  # pylint: disable=g-import-not-at-top
+  from tokenizers import models  # pylint: disable=g-import-not-at-top
+  from tokenizers import pre_tokenizers  # pylint: disable=g-import-not-at-top
+  from transformers import PreTrainedTokenizerFast  # pylint: disable=g-import-not-at-top
+
+  words = warmup.synthetic_text(64).split() + ["a", "request"]
+  vocab = {"<pad>": 0, "</s>": 1, "<unk>": 2}
+  for word in words:
+    vocab.setdefault(word, len(vocab))
+  tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+  tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+  return PreTrainedTokenizerFast(
+      tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>",
+      unk_token="<unk>")
+
+
+def _run_server(rank, port, out_dir):
+  import predict_deepspeed  # pylint: disable=g-import-not-at-top
+  from benchmark_utils import build_tiny_model  # pylint: disable=g-import-not-at-top
+
+  _init(rank, port)
+  app = predict_deepspeed.app
+  app.device = torch.device("cpu")
+  app.local_rank = rank
+  app.tokenizer = _tokenizer()
+  app.ds_engine = types.SimpleNamespace(module=build_tiny_model("t5"))
+  outputs = []
+
+  def generate_batch(inputs, config):
+    output = predict_deepspeed._generate_batch(inputs, config)  # pylint: disable=protected-access
+    outputs.append([inputs["input_ids"].tolist(), config, output.tolist()])
+    return output
+
+  app.broadcaster = RankBroadcaster(generate_batch,
+                                    heartbeat_interval=_HEARTBEAT_INTERVAL)
+  result = {}
+  if rank == 0:
+    warmup_thread = warmup.start(None, predict_deepspeed.generate)
+    result["predictions"] = predict_deepspeed.generate(
+        ["a request"], {"max_new_tokens": 3})
+    warmup_thread.join()
+    result["ready"] = warmup.is_ready()
+    app.broadcaster.stop()
+  else:
+    app.broadcaster.serve()
+  result["outputs"] = outputs
+  _write(out_dir, rank, result)
+
+
+def _free_port():
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+def test_ranks_run_the_batches_of_rank_zero(tmp_path):
+  mp.spawn(_run, args=(_free_port(), str(tmp_path)), nprocs=_WORLD_SIZE)
+  rank0, rank1 = _read(tmp_path)
+
+  # The warmup batches of two lengths and the request batch ran on both
+  # ranks before ready, followed by the three batches after the idle time.
+  assert rank0["ready"]
+  assert rank0["batches_when_ready"] == 3
+  assert len(rank0["batches"]) == 6
+  assert rank1["batches"] == rank0["batches"]
+  # A failure on a single rank or on all of them keeps the ranks in step.
+  assert rank0["raised"]
+  assert rank0["output"] == [[3, 1, 1], [3, 4, 5]]
+  assert rank1["served"]
+  assert rank1["commands"].count("heartbeat") >= 2
+  assert rank1["commands"][-1] == "stop"
+  assert rank1["commands"] == rank0["commands"]
+
+
+def test_warmup_of_predict_deepspeed_runs_on_all_ranks(tmp_path):
+  mp.spawn(_run_server, args=(_free_port(), str(tmp_path)),
+           nprocs=_WORLD_SIZE)
+  rank0, rank1 = _read(tmp_path)
+
+  # Two warmup batches and the request, generated by the tiny model of
+  # every rank on the same inputs.
+  assert rank0["ready"]
+  assert len(rank0["predictions"]) == 1
+  assert len(rank0["outputs"]) == 3
+  assert rank1["outputs"] == rank0["outputs"]
+  assert [config for _, config, _ in rank0["outputs"]].count(
+      {"max_new_tokens": 3}) == 1
@@ -0,0 +1,143 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Memory and disk tiers of ResponseCache."""
+import os
+
+import pytest
+
+import response_cache
+from response_cache import ResponseCache
+
+
+class _Clock:
+  """Replaces time.time of the cache module."""
+
+  def __init__(self, monkeypatch):
+    self.now = 1000.0
+    monkeypatch.setattr(response_cache.time, "time", lambda: self.now)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  return _Clock(monkeypatch)
+
+
+def _key(i):
+  return ResponseCache.key(f"text {i}", "v1", {})
+
+
+def _disk_files(disk_dir):
+  return sorted(name for _, _, names in os.walk(disk_dir) for name in names)
+
+
+def _age(cache_dir, key, seconds_ago, now):
+  """Sets the write time of the file of `key` to `seconds_ago`."""
+  path = os.path.join(cache_dir, key[:2], key + ".json")
+  os.utime(path, (now - seconds_ago, now - seconds_ago))
+
+
+def test_key_normalizes_whitespace_and_orders_config():
+  assert ResponseCache.key(" a  b\n", "v1", {"x": 1, "y": 2}) == (
+      ResponseCache.key("a b", "v1", {"y": 2, "x": 1}))
+  assert ResponseCache.key("a b", "v1", {}) != ResponseCache.key(
+      "a b", "v2", {})
+
+
+def test_memory_tier_evicts_least_recently_used(clock):
+  del clock
+  cache = ResponseCache(max_entries=2)
+  cache.put(_key(0), ["zero"])
+  cache.put(_key(1), ["one"])
+  assert cache.get(_key(0)) == ["zero"]
+  cache.put(_key(2), ["two"])
+  assert cache.get(_key(1)) is None
+  assert cache.get(_key(0)) == ["zero"]
+  assert cache.get(_key(2)) == ["two"]
+  assert cache.stats() == {"hits": 3, "misses": 1, "memory_hits": 3,
+                           "disk_hits": 0, "disk_evictions": 0, "entries": 2}
+
+
+def test_entries_expire_after_ttl(clock, tmp_path):
+  cache = ResponseCache(max_entries=2, ttl_seconds=10, disk_dir=str(tmp_path))
+  cache.put(_key(0), ["zero"])
+  clock.now += 9
+  assert cache.get(_key(0)) == ["zero"]
+  clock.now += 2
+  # Expired in memory and on disk, whose file is removed.
+  assert cache.get(_key(0)) is None
+  assert not _disk_files(tmp_path)
+  assert cache.stats()["entries"] == 0
+
+
+def test_disk_tier_is_shared_by_instances(clock, tmp_path):
+  del clock
+  writer = ResponseCache(max_entries=2, disk_dir=str(tmp_path))
+  writer.put(_key(0), ["zero"])
+  reader = ResponseCache(max_entries=2, disk_dir=str(tmp_path))
+  assert reader.get(_key(0)) == ["zero"]
+  # The entry is promoted to the memory of the reader.
+  assert reader.get(_key(0)) == ["zero"]
+  assert reader.stats()["disk_hits"] == 1
+  assert reader.stats()["memory_hits"] == 1
+  assert reader.get(_key(1)) is None
+
+
+def test_disk_only_cache(clock, tmp_path):
+  del clock
+  cache = ResponseCache(max_entries=0, disk_dir=str(tmp_path))
+  assert cache.enabled
+  cache.put(_key(0), ["zero"])
+  assert cache.get(_key(0)) == ["zero"]
+  assert cache.stats()["entries"] == 0
+  assert not ResponseCache(max_entries=0).enabled
+
+
+def test_writes_remove_expired_files(clock, tmp_path):
+  cache = ResponseCache(max_entries=0, ttl_seconds=10, disk_dir=str(tmp_path))
+  cache.put(_key(0), ["zero"])
+  _age(tmp_path, _key(0), 11, clock.now)
+  clock.now += 11
+  # The next write sweeps once the sweep interval passed, without a read of
+  # the expired entry.
+  cache.put(_key(1), ["one"])
+  assert len(_disk_files(tmp_path)) == 2
+  clock.now += response_cache._SWEEP_INTERVAL  # pylint: disable=protected-access
+  cache.put(_key(2), ["two"])
+  assert _disk_files(tmp_path) == sorted(
+      [_key(1) + ".json", _key(2) + ".json"])
+  assert cache.stats()["disk_evictions"] == 1
+
+
+def test_disk_tier_is_limited_to_its_size(clock, tmp_path):
+  cache = ResponseCache(max_entries=0, disk_dir=str(tmp_path))
+  cache.put(_key(0), ["x" * 100])
+  _age(tmp_path, _key(0), 100, clock.now)
+  entry_bytes = os.path.getsize(
+      os.path.join(tmp_path, _key(0)[:2], _key(0) + ".json"))
+
+  # Room for four entries, of which a sweep keeps three.
+  cache = ResponseCache(max_entries=0, disk_dir=str(tmp_path),
+                        disk_max_bytes=4 * entry_bytes + entry_bytes // 3)
+  for i in range(1, 5):
+    cache.put(_key(i), ["x" * 100])
+    _age(tmp_path, _key(i), 100 - i, clock.now)
+  # Five entries exceed the limit and the oldest two are removed.
+  assert len(_disk_files(tmp_path)) == 3
+  assert cache.get(_key(0)) is None
+  assert cache.get(_key(1)) is None
+  assert cache.get(_key(2)) == ["x" * 100]
+  assert cache.stats()["disk_evictions"] == 2
+
+  cache.put(_key(5), ["x" * 100])
+  assert len(_disk_files(tmp_path)) == 4
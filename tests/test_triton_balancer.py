@@ -0,0 +1,150 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""EndpointBalancer and BalancedProcessorPool across fake_triton servers."""
+import functools
+import socket
+
+import pytest
+import tritonclient.http as httpclient
+from tritonclient.utils import InferenceServerException
+
+import fake_triton
+from triton_balancer import BalancedProcessorPool
+from triton_balancer import EndpointBalancer
+from triton_balancer import NoHealthyEndpoint
+from triton_processor import ProcessorPool
+
+_TEXTS = ["the house is wonderful", "a request"]
+
+
+def _model_ready(address):
+  client = httpclient.InferenceServerClient(address)
+  try:
+    return client.is_model_ready("fastertransformer")
+  except (OSError, InferenceServerException):
+    return False
+  finally:
+    client.close()
+
+
+def _free_port():
+  with socket.socket() as s:
+    s.bind(("localhost", 0))
+    return s.getsockname()[1]
+
+
+def _balanced_pool(stub_model_dir, addresses, ejection_failures=2):
+  balancer = EndpointBalancer(addresses, _model_ready, check_interval=60,
+                              ejection_failures=ejection_failures)
+  pool = BalancedProcessorPool(
+      balancer, functools.partial(ProcessorPool, stub_model_dir, size=2,
+                                  transport="binary"))
+  return balancer, pool
+
+
+def _infer(pool):
+  with pool.processor() as processor:
+    predictions, _ = processor.infer_batch(_TEXTS)
+  return predictions
+
+
+def test_failing_endpoint_is_ejected_and_readmitted(stub_model_dir,
+                                                    triton_server):
+  good = f"localhost:{triton_server.server_address[1]}"
+  # Nothing listens on the second endpoint until it recovers.
+  down_port = _free_port()
+  down = f"localhost:{down_port}"
+  balancer, pool = _balanced_pool(stub_model_dir, [good, down])
+  recovered = None
+  try:
+    # Requests alternate between the idle endpoints, the refused ones count
+    # as failures of the endpoint until it is ejected.
+    failures = 0
+    for _ in range(6):
+      try:
+        assert _infer(pool) == ["the house is wonderful", "a request"]
+      except OSError:
+        failures += 1
+    assert failures == 2
+    stats = balancer.stats()
+    assert not stats[down]["healthy"]
+    assert stats[down]["ejections"] == 1
+    assert stats[good]["healthy"]
+    assert stats[good]["failures"] == 0
+    assert stats[good]["requests"] == 4
+
+    # Health checks keep it ejected while it is down.
+    assert balancer.check_all()
+    assert not balancer.stats()[down]["healthy"]
+
+    recovered = fake_triton.start(
+        port=down_port,
+        model=fake_triton.FakeModel(latency_ms=0, per_token_ms=0))
+    assert balancer.check_all()
+    assert balancer.stats()[down]["healthy"]
+    for _ in range(4):
+      _infer(pool)
+    # The two refused requests, then half of the requests since.
+    assert balancer.stats()[down]["requests"] == 2 + 2
+    assert balancer.stats()[down]["failures"] == 2
+  finally:
+    pool.close()
+    balancer.close()
+    if recovered is not None:
+      recovered.shutdown()
+      recovered.server_close()
+
+
+def test_all_endpoints_ejected(stub_model_dir):
+  down = f"localhost:{_free_port()}"
+  balancer, pool = _balanced_pool(stub_model_dir, [down], ejection_failures=1)
+  try:
+    with pytest.raises(OSError):
+      _infer(pool)
+    with pytest.raises(NoHealthyEndpoint):
+      _infer(pool)
+    assert not balancer.check_all()
+  finally:
+    pool.close()
+
+
+def test_invalid_requests_do_not_eject(stub_model_dir, triton_server):
+  address = f"localhost:{triton_server.server_address[1]}"
+  balancer, pool = _balanced_pool(stub_model_dir, [address],
+                                  ejection_failures=1)
+  try:
+    with pytest.raises(InferenceServerException):
+      with pool.processor() as processor:
+        processor.client.infer("unknown", {})
+    assert balancer.stats()[address]["healthy"]
+    assert balancer.stats()[address]["failures"] == 0
+  finally:
+    pool.close()
+
+
+def test_close_closes_the_pool_of_every_endpoint():
+  closed = []
+
+  class _Pool:
+
+    def __init__(self, host, port):
+      self.address = f"{host}:{port}"
+      self.tokenizer = None
+
+    def close(self):
+      closed.append(self.address)
+
+  balancer = EndpointBalancer(["a:1", "b:2"], _model_ready)
+  BalancedProcessorPool(balancer, _Pool).close()
+  assert closed == ["a:1", "b:2"]
@@ -0,0 +1,93 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Binary tensor codec of the Triton HTTP protocol against fake_triton."""
+import json
+
+import numpy as np
+import pytest
+from tritonclient.utils import InferenceServerException
+
+from stub_backend import echo_outputs
+from triton_codec import BinaryHttpClient
+from triton_codec import decode_request
+from triton_codec import decode_response
+from triton_codec import encode_request
+
+
+def _inputs():
+  input_ids = np.arange(24, dtype=np.uint32).reshape(4, 6)
+  return {
+      # A transposed view, which is copied to be sent contiguously.
+      "input_ids": input_ids.T.copy().T,
+      "sequence_length": np.array([[6], [5], [3], [1]], dtype=np.uint32),
+      "max_output_len": np.full([4, 1], 4, dtype=np.uint32),
+      "runtime_top_p": np.full([4, 1], 0.5, dtype=np.float32),
+      "random_seed": np.zeros([4, 1], dtype=np.uint64),
+  }
+
+
+def test_request_round_trip():
+  inputs = _inputs()
+  buffers, header_length = encode_request(
+      inputs, outputs=["output_ids"], parameters={"priority": 1})
+  body = b"".join(bytes(buffer) for buffer in buffers)
+  header, arrays = decode_request(body, header_length)
+
+  assert header["parameters"] == {"priority": 1}
+  assert header["outputs"] == [
+      {"name": "output_ids", "parameters": {"binary_data": True}}]
+  assert list(arrays) == list(inputs)
+  for name, array in inputs.items():
+    assert arrays[name].dtype == array.dtype
+    np.testing.assert_array_equal(arrays[name], array)
+
+
+def test_request_without_outputs_asks_for_binary_outputs():
+  buffers, header_length = encode_request(_inputs())
+  header = json.loads(bytes(buffers[0]))
+  assert len(buffers[0]) == header_length
+  assert header["parameters"] == {"binary_data_output": True}
+  assert "outputs" not in header
+
+
+def test_json_tensors_are_decoded():
+  body = json.dumps({"outputs": [
+      {"name": "sequence_length", "datatype": "UINT32", "shape": [2, 1],
+       "data": [3, 4]}]}).encode()
+  arrays = decode_response(body)
+  np.testing.assert_array_equal(
+      arrays["sequence_length"], np.array([[3], [4]], dtype=np.uint32))
+
+
+def test_object_inputs_are_rejected():
+  with pytest.raises(ValueError):
+    encode_request({"text": np.array([b"a"], dtype=np.object_)})
+
+
+def test_binary_client_matches_echo_outputs(triton_server):
+  client = BinaryHttpClient(f"localhost:{triton_server.server_address[1]}")
+  inputs = _inputs()
+  try:
+    result = client.infer("fastertransformer", inputs)
+    for name, expected in echo_outputs(inputs).items():
+      assert result.as_numpy(name).dtype == expected.dtype
+      np.testing.assert_array_equal(result.as_numpy(name), expected)
+    # Only the requested outputs are returned, on the same connection.
+    result = client.infer("fastertransformer", inputs, outputs=["output_ids"])
+    assert result.as_numpy("sequence_length") is None
+    with pytest.raises(InferenceServerException) as e:
+      client.infer("unknown", inputs)
+    assert e.value.status() == "404"
+  finally:
+    client.close()
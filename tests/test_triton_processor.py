@@ -0,0 +1,134 @@
+# Copyright 2022 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""T5TritonProcessor and ProcessorPool against fake_triton."""
+import pytest
+import tritonclient.http as httpclient
+
+from triton_processor import batch_key
+from triton_processor import parse_parameters
+from triton_processor import ProcessorPool
+
+_TEXTS = [
+    "the house is wonderful",
+    "the quick brown fox jumps over the lazy dog",
+    "a request",
+]
+
+
+def _pool(stub_model_dir, server, transport, size=2):
+  return ProcessorPool(stub_model_dir, "localhost", server.server_address[1],
+                       size=size, transport=transport)
+
+
+@pytest.mark.parametrize("transport", ["shm", "binary"])
+def test_transports_match_http(stub_model_dir, triton_server, transport):
+  parameters = [parse_parameters({"max_output_len": 8})] * len(_TEXTS)
+  predictions = {}
+  for name in ("http", transport):
+    pool = _pool(stub_model_dir, triton_server, name)
+    try:
+      with pool.processor() as processor:
+        predictions[name], _ = processor.infer_batch(
+            _TEXTS, task="summarize", parameters=parameters)
+    finally:
+      pool.close()
+  assert predictions[transport] == predictions["http"]
+  # The fake model echoes the input tokens, truncated to max_output_len, and
+  # the word level tokenizer splits the task from its colon.
+  assert predictions["http"][0] == "summarize : the house is wonderful"
+  assert predictions["http"][1] == "summarize : the quick brown fox jumps over"
+
+
+def test_parse_parameters_normalizes_values():
+  assert parse_parameters({"max_output_len": 16.0, "top_p": 1,
+                           "stop": ["."]}) == {
+                               "max_output_len": 16, "top_p": 1.0,
+                               "stop": ["."]}
+  assert parse_parameters({"stop": []}) == {}
+
+
+@pytest.mark.parametrize("config", [
+    {"max_tokens": 16},
+    {"max_output_len": 0},
+    {"max_output_len": 1.5},
+    {"top_p": "0.5"},
+    {"beam_width": True},
+    {"stop": "."},
+    ["max_output_len"],
+])
+def test_parse_parameters_rejects_invalid_configs(config):
+  with pytest.raises(ValueError):
+    parse_parameters(config)
+
+
+def test_batch_key_groups_mixed_configs(stub_model_dir, triton_server):
+  configs = [{"max_output_len": 4}, {"max_output_len": 4, "stop": ["fox"]},
+             {"max_output_len": 16}]
+  parameters = [parse_parameters(config) for config in configs]
+  groups = {}
+  for text, p in zip(_TEXTS, parameters):
+    groups.setdefault(batch_key(p), []).append((text, p))
+  # Stop words are per instance and do not split a batch.
+  assert [len(group) for group in groups.values()] == [2, 1]
+
+  pool = _pool(stub_model_dir, triton_server, "http")
+  try:
+    with pool.processor() as processor:
+      for group in groups.values():
+        texts, group_parameters = zip(*group)
+        predictions, _ = processor.infer_batch(
+            list(texts), parameters=list(group_parameters))
+        assert len(predictions) == len(texts)
+    with pytest.raises(ValueError):
+      with pool.processor() as processor:
+        processor.infer_batch(_TEXTS, parameters=parameters)
+  finally:
+    pool.close()
+
+
+def test_pool_close_releases_shared_memory(stub_model_dir, triton_server):
+  pool = _pool(stub_model_dir, triton_server, "shm")
+  with pool.processor() as processor:
+    processor.infer_batch(_TEXTS)
+  client = httpclient.InferenceServerClient(
+      f"localhost:{triton_server.server_address[1]}")
+  try:
+    assert client.get_system_shared_memory_status()
+    pool.close()
+    assert not client.get_system_shared_memory_status()
+  finally:
+    client.close()
+
+
+def test_pool_replaces_failed_processors(stub_model_dir, triton_server):
+  closed = []
+  pool = _pool(stub_model_dir, triton_server, "http", size=1)
+  with pool.processor() as first:
+    pass
+  close = first.close
+
+  def record_close():
+    closed.append(first)
+    close()
+
+  first.close = record_close
+  with pytest.raises(RuntimeError):
+    with pool.processor() as processor:
+      assert processor is first
+      raise RuntimeError("request failed")
+  assert closed == [first]
+  # The failed processor freed its place for a new one.
+  with pool.processor() as processor:
+    assert processor is not first
+  pool.close()